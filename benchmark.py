@@ -0,0 +1,332 @@
+import sys
+import os
+import re
+import time
+import tempfile
+import xml.etree.ElementTree as ET
+from collections import Counter
+
+from inv_index_generator import get_configuration, read_dump_pages, WikiPageHandler, tokenizers
+from search import load_search_context, refresh_search_context, analyze_query, calculate_rank, calculate_champion_rank, PostingListCache
+
+SAMPLE_DUMP = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'samples', 'wiki_sample.xml')
+FIELD_NAMES = ['info', 'category', 'links', 'body']
+
+def load_pages(xml_dump_file, page_limit=None):
+    #returns [wiki_id, title, text] of the pages in the dump
+    pages = []
+    for _, content in read_dump_pages(xml_dump_file, 4<<20):
+        root = ET.fromstring(b'<pages>' + content + b'</pages>')
+        for page in root.iter('page'):
+            text = page.find('revision/text')
+            pages.append([page.findtext('id', ''), page.findtext('title', ''), '' if text is None or text.text is None else text.text])
+            if page_limit is not None and len(pages) >= page_limit:
+                return pages
+    return pages
+
+def create_page_handler():
+    cfg = get_configuration(tempfile.gettempdir())
+    cfg['process_id'] = 1
+    return WikiPageHandler(cfg, {})
+
+#the field extraction of WikiPageHandler before WikiTextCleaner, the reference the cleaner is checked against
+class ReferencePageCleaner(object):
+    def __init__(self, handler):
+        self.handler = handler
+        self.wiki_pattern_matching = handler.wiki_pattern_matching
+
+    #postprocessing of the text returned after the parsing, tokenized by the handler
+    def post_processing(self, content, wiki_id, debugMode=False):
+        page_info, page_category, page_links, page_body = self.extract_page_fields(content, wiki_id, debugMode=debugMode)
+        return self.handler.final_text_processing(page_info), self.handler.final_text_processing(page_category), self.handler.final_text_processing(page_links), self.handler.final_text_processing(page_body)
+
+    def extract_page_fields(self, content, wiki_id, debugMode=False):
+        page_info = []
+        page_category = []
+        page_links = []
+        page_body = []
+
+        #setting up the page information
+        result, content = self.extract_information(content, wiki_id, debugMode=debugMode)
+        page_info.append(result)
+        result, content = self.extract_infobox(content, wiki_id, debugMode=debugMode)
+        page_info.append(result)
+        #setting up page category
+        result, content = self.extract_category(content, wiki_id, debugMode=debugMode)
+        page_category.append(result)
+        #setting up the page links
+        result, content = self.extract_wiki_links(content, wiki_id, debugMode=debugMode)
+        page_links.append(result)
+        # insert the body in page_body
+        page_body.append(self.get_content_body(content, wiki_id, debugMode=debugMode))
+        return page_info, page_category, page_links, page_body
+
+    # just clean the extra data 
+    def get_content_body(self, wiki_content, wiki_id, debugMode=False):
+        regex = re.compile(self.wiki_pattern_matching["comments"])
+        new_content = re.sub(regex, ' ', wiki_content)
+        regex = re.compile(self.wiki_pattern_matching["styles"])
+        new_content = re.sub(regex, ' ', new_content)
+        regex = re.compile(self.wiki_pattern_matching["references"])
+        new_content = re.sub(regex, ' ', new_content)
+        new_content = self.remove_all_tags(new_content)
+        regex = re.compile(self.wiki_pattern_matching["curly_braces"])
+        new_content = re.sub(regex, ' ', new_content)
+        regex = re.compile(self.wiki_pattern_matching["square_braces"])
+        new_content = re.sub(regex, ' ', new_content)
+        #remove links
+        new_content = self.remove_all_urls(new_content)
+        #remove footers
+        new_content = self.strip_footers(new_content)
+        return new_content
+
+    def strip_footers(self, content):
+        labels = ["References", "Further reading", "See also", "Notes"]
+        for l in labels:
+            regex = "==%s==" % (labels)
+            found = re.search(regex, content)
+            if found is not None:
+                # get the index of the search
+                content = content[0:found.start()-1]
+        return content 
+
+    #only extract infobox from the wiki page
+    def extract_infobox(self, wiki_content, wiki_id, debugMode=False):
+        start_index = wiki_content.find(self.wiki_pattern_matching["infobox"])
+        result_string = ''
+        if start_index < 0:
+            return result_string, wiki_content
+        end = len(wiki_content)
+        bracket_match_count = 2
+        start_index += len(self.wiki_pattern_matching["infobox"])
+        index = start_index
+        while(index < end):
+            if wiki_content[index] == '}':
+                bracket_match_count -= 1
+            if wiki_content[index] == '{':
+                bracket_match_count += 1
+            if bracket_match_count == 0:
+                break
+            index += 1
+        if bracket_match_count !=0 and debugMode:
+            print("extract_infobox_warning : malformed infobox found for wiki id %s" % (wiki_id))
+            return result_string, wiki_content
+        result_string = wiki_content[start_index:index-1]
+        result_string = self.remove_all_urls(result_string)
+        new_wiki_content = wiki_content[0:start_index-1] + wiki_content[index+1:-1]
+        return self.remove_all_tags(self.filter_content(result_string)), new_wiki_content
+
+    #only extract information from the wiki page
+    def extract_information(self, wiki_content, wiki_id, debugMode=False):
+        start_index = wiki_content.find(self.wiki_pattern_matching["information"])
+        result_string = ''
+        if start_index < 0:
+            return result_string, wiki_content
+        end = len(wiki_content)
+        bracket_match_count = 2
+        start_index += len(self.wiki_pattern_matching["information"])
+        index = start_index
+        while(index < end):
+            if wiki_content[index] == '}':
+                bracket_match_count -= 1
+            if wiki_content[index] == '{':
+                bracket_match_count += 1
+            if bracket_match_count == 0:
+                break
+            index += 1
+        if bracket_match_count !=0 and debugMode:
+            print("extract_information_warning : malformed information found for wiki id %s" % (wiki_id))
+            return result_string, wiki_content
+        result_string = wiki_content[start_index:index-1]
+        result_string = self.remove_all_urls(result_string)
+        new_wiki_content = wiki_content[0:start_index-1] + wiki_content[index+1:-1]
+        return self.remove_all_tags(self.filter_content(result_string)), new_wiki_content
+
+    #only extract the category body
+    def extract_category(self, wiki_content, wiki_id, debugMode=False):
+        category_regex = re.compile(self.wiki_pattern_matching["category"], re.IGNORECASE)
+        result_string = re.findall(category_regex, wiki_content)
+        result_string = ''.join(result_string)
+        result_string = self.remove_all_urls(result_string)
+        new_wiki_content = re.sub(category_regex, '', wiki_content)
+        return self.remove_all_tags(self.filter_content(result_string)), new_wiki_content
+
+    def extract_wiki_links(self, wiki_content, wiki_id, debugMode=False):
+        wiki_links_regex = re.compile(self.wiki_pattern_matching["wiki_links"], re.IGNORECASE)
+        temp_string = re.findall(wiki_links_regex, wiki_content)
+        result_string = []
+        for value in temp_string:
+            if ':' not in value:
+                result_string.append(value)
+        result_string = ''.join(result_string)
+        result_string = self.remove_all_urls(result_string)
+        new_wiki_content = re.sub(wiki_links_regex, '', wiki_content)
+        return self.remove_all_tags(self.filter_content(result_string)), new_wiki_content
+
+    def remove_all_tags(self, wiki_content):
+        tag_regex = re.compile("<.*?>")
+        return re.sub(tag_regex, '', wiki_content)
+
+    def remove_all_urls(self, wiki_content):
+        #remove links
+        regex = re.compile(self.wiki_pattern_matching["url"])
+        wiki_content = re.sub(regex, ' ', wiki_content)
+        regex = re.compile(self.wiki_pattern_matching["www"])
+        wiki_content = re.sub(regex, ' ', wiki_content)
+        return wiki_content
+
+    def filter_content(self, content):
+        filters = set(['(', '{', '[', ']', '}', ')', '=', '|', '?', ',', '+', '\'', '\\', '*', '#', ';', '!', '\"', '%'])
+        content = content.strip()
+        if len(content) == 0:
+            return content
+        if len(set(content).intersection(filters)) == 0:
+            return content
+        for elem in filters:
+            content = content.replace(elem, ' ')
+        return content
+
+def time_per_page(function, pages):
+    start = time.perf_counter()
+    for wiki_id, _, text in pages:
+        function(text, wiki_id)
+    return (time.perf_counter() - start) * 1000.0 / max(len(pages), 1)
+
+def benchmark_cleaner(xml_dump_file, page_limit=None):
+    pages = load_pages(xml_dump_file, page_limit)
+    handler = create_page_handler()
+    reference = ReferencePageCleaner(handler)
+    print('[INFO] comparing WikiTextCleaner with post_processing on %d pages of %s' % (len(pages), xml_dump_file))
+    #field level comparison of the tokens that end up in the index
+    mismatches = [0]*len(FIELD_NAMES)
+    mismatched_pages = 0
+    for wiki_id, title, text in pages:
+        expected = reference.post_processing(text, wiki_id)
+        actual = handler.clean_page(text, wiki_id)
+        page_ok = True
+        for index in range(len(FIELD_NAMES)):
+            if sorted(expected[index]) != sorted(actual[index]):
+                mismatches[index] += 1
+                page_ok = False
+                print('[MISMATCH] %s (%s) field %s\n    post_processing : %s\n    cleaner         : %s' % (title, wiki_id, FIELD_NAMES[index], sorted(expected[index]), sorted(actual[index])))
+        if not page_ok:
+            mismatched_pages += 1
+    for index in range(len(FIELD_NAMES)):
+        print('    %s : %d mismatching pages' % (FIELD_NAMES[index], mismatches[index]))
+    print('[INFO] %d of %d pages produce identical fields' % (len(pages) - mismatched_pages, len(pages)))
+
+    #per page cost of splitting the page into fields, and of the full field pipeline
+    legacy_split = time_per_page(lambda text, wiki_id: reference.extract_page_fields(text, wiki_id), pages)
+    cleaner_split = time_per_page(handler.cleaner.split_page, pages)
+    legacy_total = time_per_page(reference.post_processing, pages)
+    cleaner_total = time_per_page(handler.clean_page, pages)
+    print('[INFO] field extraction : post_processing %.3f ms/page, cleaner %.3f ms/page, speedup %.2fx' % (legacy_split, cleaner_split, legacy_split / max(cleaner_split, 1e-9)))
+    print('[INFO] with tokenization : post_processing %.3f ms/page, cleaner %.3f ms/page, speedup %.2fx' % (legacy_total, cleaner_total, legacy_total / max(cleaner_total, 1e-9)))
+    return mismatched_pages
+
+def benchmark_tokenizer(xml_dump_file, page_limit=None, report_file=None):
+    pages = load_pages(xml_dump_file, page_limit)
+    handler = create_page_handler()
+    #the tokenizers see the same cleaned, filtered and case folded text as in the indexer
+    texts = []
+    for wiki_id, title, text in pages:
+        for field in [title] + list(handler.cleaner.split_page(text, wiki_id)):
+            texts.append(handler.cleaner.filter_content(field).lower())
+    print('[INFO] comparing tokenizers on %d fields of %d pages of %s' % (len(texts), len(pages), xml_dump_file))
+    tokens = {}
+    for tokenizer_name in sorted(tokenizers.keys()):
+        tokenize = tokenizers[tokenizer_name]
+        start = time.perf_counter()
+        tokens[tokenizer_name] = [tokenize(text) for text in texts]
+        time_delta = time.perf_counter() - start
+        token_count = sum(len(entry) for entry in tokens[tokenizer_name])
+        print('    %s : %.3f ms/page, %d tokens' % (tokenizer_name, time_delta * 1000.0 / max(len(pages), 1), token_count))
+
+    #token level diff between the nltk and the regex tokenizer, per field
+    only_nltk = Counter()
+    only_regex = Counter()
+    identical_fields = 0
+    identical_terms = 0
+    stop_words = set(handler.stop_words)
+    for nltk_tokens, regex_tokens in zip(tokens['nltk'], tokens['regex']):
+        nltk_count = Counter(nltk_tokens)
+        regex_count = Counter(regex_tokens)
+        if nltk_count == regex_count:
+            identical_fields += 1
+        only_nltk.update(nltk_count - regex_count)
+        only_regex.update(regex_count - nltk_count)
+        #what actually ends up in the index after stop word removal and stemming
+        nltk_terms = set(handler.stemmer.stem(w) for w in set(nltk_tokens).difference(stop_words))
+        regex_terms = set(handler.stemmer.stem(w) for w in set(regex_tokens).difference(stop_words))
+        if nltk_terms == regex_terms:
+            identical_terms += 1
+    print('[INFO] identical tokens in %d of %d fields, identical index terms in %d fields' % (identical_fields, len(texts), identical_terms))
+    print('[INFO] most common tokens only produced by nltk  : %s' % only_nltk.most_common(20))
+    print('[INFO] most common tokens only produced by regex : %s' % only_regex.most_common(20))
+    if report_file is not None:
+        with open(report_file, 'w', encoding='utf-8') as txt_file:
+            txt_file.write('#token nltk_only_count regex_only_count\n')
+            for token in sorted(set(only_nltk.keys()).union(only_regex.keys())):
+                txt_file.write('%s %d %d\n' % (token, only_nltk[token], only_regex[token]))
+        print('[INFO] token level diff report written to %s' % report_file)
+
+def benchmark_recall(index_folder, query_file, result_count=10):
+    #recall of the champion list ranking against the exact ranking, and the latency of both
+    context = load_search_context(index_folder, debug=False)
+    #every query reads its posting lists, as the first query of a term would
+    context['posting_cache'] = PostingListCache(0)
+    with open(query_file, 'r', encoding='utf-8') as txt_file:
+        queries = [line.strip() for line in txt_file if len(line.strip()) > 0]
+    print('[INFO] comparing champion lists with exact ranking on %d queries of %s, top %d' % (len(queries), query_file, result_count))
+    exact_time = 0.0
+    champion_time = 0.0
+    recalls = []
+    fallbacks = 0
+    for query in queries:
+        index = refresh_search_context(context)
+        word_desc = analyze_query(context, query)
+        start = time.perf_counter()
+        exact_results = calculate_rank(context, index, word_desc, threshold=result_count)
+        exact_time += time.perf_counter() - start
+        rank_stats = {}
+        start = time.perf_counter()
+        champion_results = calculate_champion_rank(context, index, word_desc, threshold=result_count, rank_stats=rank_stats)
+        champion_time += time.perf_counter() - start
+        fallbacks += rank_stats['fallback']
+        if len(exact_results) == 0:
+            continue
+        exact_ids = set([doc_id for doc_id, _ in exact_results])
+        recalls.append(len(exact_ids.intersection([doc_id for doc_id, _ in champion_results])) / float(len(exact_ids)))
+    query_count = max(len(queries), 1)
+    print('[INFO] exact : %.3f ms/query, champion lists : %.3f ms/query, speedup %.2fx' % (exact_time * 1000.0 / query_count, champion_time * 1000.0 / query_count, exact_time / max(champion_time, 1e-9)))
+    print('[INFO] recall@%d %.4f over %d queries with results, %d queries fell back to the full posting lists' % (result_count, sum(recalls) / max(len(recalls), 1), len(recalls), fallbacks))
+    return sum(recalls) / max(len(recalls), 1)
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] not in ['cleaner', 'tokenizer', 'recall']:
+        print("error : usage : benchmark.py cleaner|tokenizer [path to xml dump file] [page limit] [tokenizer diff report file]")
+        print("                benchmark.py recall <path to index folder> <query file> [result count]")
+        return -1
+    if sys.argv[1] == 'recall':
+        if len(sys.argv) < 4:
+            print("error : usage : benchmark.py recall <path to index folder> <query file> [result count]")
+            return -1
+        result_count = int(sys.argv[4]) if len(sys.argv) > 4 else 10
+        benchmark_recall(os.path.abspath(sys.argv[2]), os.path.abspath(sys.argv[3]), result_count)
+        return 0
+    xml_dump_file = SAMPLE_DUMP
+    if len(sys.argv) > 2:
+        xml_dump_file = os.path.abspath(sys.argv[2])
+    page_limit = None
+    if len(sys.argv) > 3:
+        page_limit = int(sys.argv[3])
+    if sys.argv[1] == 'cleaner':
+        benchmark_cleaner(xml_dump_file, page_limit)
+    elif sys.argv[1] == 'tokenizer':
+        report_file = None
+        if len(sys.argv) > 4:
+            report_file = os.path.abspath(sys.argv[4])
+        benchmark_tokenizer(xml_dump_file, page_limit, report_file)
+
+if __name__ == '__main__':
+    main()
@@ -5,16 +5,210 @@ from nltk import word_tokenize
 from nltk.corpus import stopwords
 from nltk.stem import PorterStemmer
 # from functools import reduce
+from functools import lru_cache
 import heapq
+import math
+import bisect
 from collections import defaultdict
 
 import numpy as np
 import sys
 import os
+import bz2
+import struct
+import mmap
 import shutil
+import fcntl
+from contextlib import contextmanager
+import json
 import multiprocessing
+import queue
+from array import array
+import psutil
 
 
+#fast tokenizer, words with inner hyphens or dots (trans-boundary, u.s) are kept whole
+#and punctuation is dropped instead of being emitted as separate tokens
+word_token_regex = re.compile(r"\w+(?:[-.]\w+)*")
+
+def regex_tokenize(text):
+   return word_token_regex.findall(text)
+
+#tokenizers selectable with the 'tokenizer' configuration, the index and the
+#search have to use the same one
+tokenizers = {
+   'nltk': word_tokenize,
+   'regex': regex_tokenize,
+}
+
+def get_tokenizer(tokenizer_name):
+   if tokenizer_name not in tokenizers:
+      raise ValueError("unknown tokenizer : %s, available tokenizers : %s" % (tokenizer_name, sorted(tokenizers.keys())))
+   return tokenizers[tokenizer_name]
+
+#memoizes the stemmer, wikipedia vocabulary is zipfian so most stem calls are repeats.
+#used by both the indexer and the search so both sides produce identical stems
+class CachedStemmer(object):
+   def __init__(self, stemmer, max_size):
+      self.stemmer = stemmer
+      self.max_size = max_size
+      #least recently used stems are evicted once max_size stems are cached
+      self.stem = lru_cache(maxsize=max_size)(stemmer.stem)
+
+   def cache_stats(self):
+      info = self.stem.cache_info()
+      return info.hits, info.misses, info.currsize
+
+   #the lru cache can't be pickled, rebuild it empty on the other side
+   def __getstate__(self):
+      return {'stemmer': self.stemmer, 'max_size': self.max_size}
+
+   def __setstate__(self, state):
+      self.__init__(state['stemmer'], state['max_size'])
+
+#splits the wikitext of a page into its infobox, category, links and body fields.
+#it produces the same fields as the extraction chain it replaced, kept as benchmark.ReferencePageCleaner,
+#but every pattern is compiled once per worker and each field is cut out in a single scan of the page
+class WikiTextCleaner(object):
+   def __init__(self, wiki_pattern_matching, debug_mode=False):
+      self.debug_mode = debug_mode
+      self.template_markers = [wiki_pattern_matching["information"], wiki_pattern_matching["infobox"]]
+      self.braces_regex = re.compile('[{}]')
+      self.category_regex = re.compile(wiki_pattern_matching["category"], re.IGNORECASE)
+      self.wiki_links_regex = re.compile(wiki_pattern_matching["wiki_links"], re.IGNORECASE)
+      #body patterns with the substring that has to be present for them to match
+      self.body_regex = [
+         (re.compile(wiki_pattern_matching["comments"]), '<--', ' '),
+         (re.compile(wiki_pattern_matching["styles"]), '[|', ' '),
+         (re.compile(wiki_pattern_matching["references"]), '<ref>', ' '),
+         (re.compile("<.*?>"), '<', ''),
+         (re.compile(wiki_pattern_matching["curly_braces"]), '{{', ' '),
+         (re.compile(wiki_pattern_matching["square_braces"]), '[[', ' '),
+      ]
+      self.tag_regex = re.compile("<.*?>")
+      self.url_regex = re.compile("%s|%s" % (wiki_pattern_matching["url"], wiki_pattern_matching["www"]))
+      self.footer_regex = re.compile("==%s==" % (["References", "Further reading", "See also", "Notes"]))
+      self.filter_table = str.maketrans(dict.fromkeys('({[]})=|?,+\'\\*#;!"%', ' '))
+
+   #returns the raw (info, category, links, body) text of the page
+   def split_page(self, content, wiki_id):
+      info = []
+      for marker in self.template_markers:
+         result, content = self.extract_template(content, marker, wiki_id)
+         info.append(result)
+      #the matches are collected while they are removed from the page
+      category = []
+      def collect_category(match):
+         category.append(match.group(1))
+         return ''
+      content = self.category_regex.sub(collect_category, content)
+      links = []
+      def collect_link(match):
+         #namespaced links like File: or Category: are not wiki links
+         if ':' not in match.group(1):
+            links.append(match.group(1))
+         return ''
+      content = self.wiki_links_regex.sub(collect_link, content)
+      return ''.join(info), self.clean_field(''.join(category)), self.clean_field(''.join(links)), self.get_content_body(content)
+
+   #cuts the {{marker ... }} template out of the page by matching the braces
+   def extract_template(self, content, marker, wiki_id):
+      start_index = content.find(marker)
+      if start_index < 0:
+         return '', content
+      end = len(content)
+      bracket_match_count = 2
+      start_index += len(marker)
+      index = end
+      for brace in self.braces_regex.finditer(content, start_index):
+         if brace.group() == '}':
+            bracket_match_count -= 1
+         else:
+            bracket_match_count += 1
+         if bracket_match_count == 0:
+            index = brace.start()
+            break
+      if bracket_match_count != 0 and self.debug_mode:
+         print("extract_template_warning : malformed %s found for wiki id %s" % (marker, wiki_id))
+         return '', content
+      result_string = content[start_index:index-1]
+      new_content = content[0:start_index-1] + content[index+1:-1]
+      return self.clean_field(result_string), new_content
+
+   def clean_field(self, content):
+      return self.tag_regex.sub('', self.filter_content(self.url_regex.sub(' ', content)))
+
+   def get_content_body(self, content):
+      for regex, marker, replacement in self.body_regex:
+         if marker in content:
+            content = regex.sub(replacement, content)
+      content = self.url_regex.sub(' ', content)
+      #strip the footers
+      for _ in range(4):
+         found = self.footer_regex.search(content)
+         if found is not None:
+            content = content[0:found.start()-1]
+      return content
+
+   def filter_content(self, content):
+      return content.strip().translate(self.filter_table)
+
+#python object cost of a term id and a title map entry, on top of the string itself
+dict_entry_bytes = sys.getsizeof(1<<20) + 3*8
+
+class PostingAccumulator(object):
+   #in-memory inverted index of a block. terms are interned to ids, the postings live in flat typed
+   #arrays : term id, doc id and the counts of the fields in field_alias order
+   def __init__(self):
+      self.term_ids = {}
+      self.terms = []
+      self.total_counts = array('Q')
+      self.posting_terms = array('I')
+      self.posting_docs = array('I')
+      self.posting_counts = array('I')
+      self.term_bytes = 0
+
+   def __len__(self):
+      return len(self.terms)
+
+   def add_posting(self, word, doc_id, total_count, field_counts):
+      term_id = self.term_ids.get(word, None)
+      if term_id is None:
+         term_id = len(self.terms)
+         self.term_ids[word] = term_id
+         self.terms.append(word)
+         self.total_counts.append(0)
+         self.term_bytes += sys.getsizeof(word) + dict_entry_bytes + 8
+      self.total_counts[term_id] += total_count
+      self.posting_terms.append(term_id)
+      self.posting_docs.append(doc_id)
+      self.posting_counts.extend(field_counts)
+
+   def memory_bytes(self):
+      arrays = [self.total_counts, self.posting_terms, self.posting_docs, self.posting_counts]
+      return self.term_bytes + sum([len(values)*values.itemsize for values in arrays])
+
+   def sorted_postings(self):
+      #yields (term, total count, doc ids, field counts) in term order, the postings of a term stay in
+      #the order they were added, which is doc id order
+      if len(self.posting_terms) == 0:
+         return
+      term_order = sorted(range(len(self.terms)), key=self.terms.__getitem__)
+      term_rank = np.empty(len(self.terms), dtype=np.int64)
+      term_rank[term_order] = np.arange(len(self.terms))
+      posting_terms = np.frombuffer(self.posting_terms, dtype=np.uintc)
+      posting_order = np.argsort(term_rank[posting_terms], kind='stable')
+      doc_ids = np.frombuffer(self.posting_docs, dtype=np.uintc).astype(np.int64)[posting_order]
+      field_counts = np.frombuffer(self.posting_counts, dtype=np.uintc).astype(np.int64).reshape(-1, len(field_alias))[posting_order]
+      term_ends = np.cumsum(np.bincount(posting_terms, minlength=len(self.terms))[term_order]).tolist()
+      start = 0
+      for term_id, end in zip(term_order, term_ends):
+         if end - start < varint_numpy_threshold:
+            yield self.terms[term_id], self.total_counts[term_id], doc_ids[start:end].tolist(), field_counts[start:end].tolist()
+         else:
+            yield self.terms[term_id], self.total_counts[term_id], doc_ids[start:end], field_counts[start:end]
+         start = end
+
 class WikiPageHandler(xml.sax.ContentHandler):
    def __init__(self, process_configuration, process_stat):
       self.allowed_tags = ['title', 'id', 'text']
@@ -22,6 +216,7 @@ class WikiPageHandler(xml.sax.ContentHandler):
       self.data = {}
       self.enable_read = False
       self.activate_read = False
+      #doc id of the next page, set by the worker for every dispatched batch
       self.doc_id = 1
       #read the configuration
       #process
@@ -30,6 +225,12 @@ class WikiPageHandler(xml.sax.ContentHandler):
       self.debug_mode = process_configuration['debug_mode']
       #index
       self.offline_block_size = process_configuration['offline_block_size']
+      self.memory_budget = process_configuration['worker_memory_budget']
+      self.memory_check_interval = process_configuration['memory_check_interval']
+      self.title_map_bytes = 0
+      self.block_rss_peak = 0
+      self.process_info = psutil.Process()
+      self.block_sample_interval = process_configuration['block_sample_interval']
       self.offline_index_counter = self.process_id
       #storage
       self.doc_parse_count = 0
@@ -40,13 +241,33 @@ class WikiPageHandler(xml.sax.ContentHandler):
       self.wiki_pattern_matching = process_configuration['wiki_pattern_matching']
       self.stemmer = process_configuration['stemmer']
       self.stop_words = process_configuration['stop_words']
+      self.stop_word_set = set(self.stop_words)
+      self.tokenize = get_tokenizer(process_configuration['tokenizer'])
+      self.cleaner = WikiTextCleaner(self.wiki_pattern_matching, debug_mode=self.debug_mode)
       #stats
       self.process_statistics = process_stat
       self.process_statistics['index_start_time'] = datetime.utcnow()
       self.process_statistics['start_index'] = self.process_id
       self.process_statistics['end_index'] = self.process_id
-      self.process_statistics['inverted_index'] = {}
+      self.process_statistics['index_blocks'] = []
+      #[block id, pages, estimated index bytes, rss high-water mark] of every block
+      self.process_statistics['block_memory'] = []
+      self.process_statistics['inverted_index'] = PostingAccumulator()
       self.process_statistics['doc_id_title_hash'] = {}
+      #[doc id, token count of every field] of the pages of the block
+      self.process_statistics['doc_field_lengths'] = []
+      self.field_lengths_name = process_configuration['doc_field_lengths_name']
+      #checkpoint : the blocks, title maps and doc id ranges on disk after the last flush. every run of a
+      #build writes its own title map per worker, a resumed build skips the pages of skip_doc_ranges
+      self.checkpoint_file = os.path.join(self.offline_index_storage, process_configuration['checkpoint_name']+'-'+str(self.process_id))
+      self.title_map_id = self.process_id + process_configuration['build_run']*self.offset
+      self.title_maps = []
+      self.doc_ranges = []
+      self.block_doc_ranges = []
+      self.skip_doc_ranges = process_configuration['skip_doc_ranges']
+      self.skip_doc_starts = [doc_range[0] for doc_range in self.skip_doc_ranges]
+      if process_configuration['worker_checkpoint'] is not None:
+         self.restore_checkpoint(process_configuration['worker_checkpoint'])
 
    # Call when an element starts
    def startElement(self, tag, attributes):
@@ -56,40 +277,93 @@ class WikiPageHandler(xml.sax.ContentHandler):
          self.data = {}
          for tag_name in self.allowed_tags:
             self.data[tag_name] = []
-         self.enable_read = False
-         if (self.doc_id - self.process_id) % self.offset == 0:
-            self.enable_read = True
+         #every page handed to this worker belongs to it
+         self.enable_read = True
 
    # Call when an elements ends
    def endElement(self, tag):
       self.activate_read = False
       if tag == "page":
          self.enable_read = False
+         if len(self.skip_doc_ranges) > 0 and in_doc_ranges(self.skip_doc_ranges, self.skip_doc_starts, self.doc_id, self.doc_id):
+            self.doc_id += 1
+            return
          #assemble the string
-         if (self.doc_id - self.process_id) % self.offset == 0:
-            for tag_name in self.allowed_tags:
-               result = str(''.join(self.data.get(tag_name, ''))).strip()
-               if tag_name == 'text':
-                  info, category, links, body = self.post_processing(result, self.data['id'], debugMode=self.debug_mode)
-                  title_tokens = self.final_text_processing(self.data['title'])
-                  self.populate_inverted_index(self.doc_id, title_tokens, info, category, links, body)
-               self.data[tag_name] = result
-            self.process_statistics['doc_id_title_hash'][self.doc_id] = self.data['title']
-            self.doc_parse_count += 1
-
-         #store the indexes offline to save memory
-         if self.doc_parse_count % self.offline_block_size == 0 and self.doc_parse_count!=0:
-            time_elapsed = (datetime.utcnow() - self.process_statistics['index_start_time']).total_seconds()
-            print(">process_id[%s] : [%s] processed the block with %d words in %.2f seconds" % (self.process_id, self.offline_index_counter, len(self.process_statistics['inverted_index']), time_elapsed))
-            store_partial_index_offline(self.process_id, self.process_statistics['inverted_index'], self.offline_index_storage, self.secondary_index_file_name, self.offline_index_counter)
-            store_partial_title_map_offline(self.process_id, self.offline_index_counter, self.process_statistics['doc_id_title_hash'], self.offline_index_storage, self.title_map_name)
-            self.process_statistics['inverted_index'] = {}
-            self.process_statistics['doc_id_title_hash'] = {}
-            self.process_statistics['end_index'] = self.offline_index_counter
-            self.offline_index_counter += self.offset
-            self.doc_parse_count = 0
-            self.process_statistics['index_start_time'] = datetime.utcnow()
+         for tag_name in self.allowed_tags:
+            result = str(''.join(self.data.get(tag_name, ''))).strip()
+            if tag_name == 'text':
+               field_tokens = [self.text_tokens(self.data['title'])] + self.page_tokens(result, self.data['id'])
+               title_tokens, info, category, links, body = [self.stem_terms(tokens) for tokens in field_tokens]
+               self.populate_inverted_index(self.doc_id, title_tokens, info, category, links, body)
+               #the postings only hold the distinct terms of a field, its length counts all of its tokens
+               self.process_statistics['doc_field_lengths'].append([self.doc_id] + [len(tokens) for tokens in field_tokens])
+            self.data[tag_name] = result
+         self.process_statistics['doc_id_title_hash'][self.doc_id] = self.data['title']
+         self.title_map_bytes += sys.getsizeof(self.data['title']) + dict_entry_bytes
+         self.doc_parse_count += 1
+         if len(self.block_doc_ranges) > 0 and self.block_doc_ranges[-1][1] == self.doc_id - 1:
+            self.block_doc_ranges[-1][1] = self.doc_id
+         else:
+            self.block_doc_ranges.append([self.doc_id, self.doc_id])
+
+         if self.doc_parse_count % self.memory_check_interval == 0:
+            self.sample_memory()
+         #store the indexes offline once they reach the memory budget, or the optional page limit
+         if self.index_memory_bytes() >= self.memory_budget or (self.offline_block_size is not None and self.doc_parse_count >= self.offline_block_size):
+            self.flush_block()
          self.doc_id += 1
+
+   def index_memory_bytes(self):
+      return self.process_statistics['inverted_index'].memory_bytes() + self.title_map_bytes
+
+   def sample_memory(self):
+      self.block_rss_peak = max(self.block_rss_peak, self.process_info.memory_info().rss)
+
+   #writes the in-memory inverted index and title map as the next block of this process,
+   #its memory high-water mark goes to the process stats
+   def flush_block(self):
+      if self.doc_parse_count == 0:
+         return
+      time_elapsed = (datetime.utcnow() - self.process_statistics['index_start_time']).total_seconds()
+      self.sample_memory()
+      print(">process_id[%s] : [%s] processed the block with %d words of %d pages in %.2f seconds -- [%.2f MB estimated index, %.2f MB rss]" % (self.process_id, self.offline_index_counter, len(self.process_statistics['inverted_index']), self.doc_parse_count, time_elapsed, self.index_memory_bytes()/float(1<<20), self.block_rss_peak/float(1<<20)))
+      self.process_statistics['block_memory'].append([self.offline_index_counter, self.doc_parse_count, self.index_memory_bytes(), self.block_rss_peak])
+      store_partial_index_offline(self.process_id, self.process_statistics['inverted_index'], self.offline_index_storage, self.secondary_index_file_name, self.offline_index_counter, self.block_sample_interval)
+      title_map_size = store_partial_title_map_offline(self.process_id, self.offline_index_counter, self.process_statistics['doc_id_title_hash'], self.offline_index_storage, self.title_map_name, self.title_map_id)
+      field_lengths_size = store_partial_field_lengths_offline(self.process_statistics['doc_field_lengths'], self.offline_index_storage, self.field_lengths_name, self.title_map_id)
+      self.process_statistics['inverted_index'] = PostingAccumulator()
+      self.process_statistics['doc_id_title_hash'] = {}
+      self.process_statistics['doc_field_lengths'] = []
+      if len(self.process_statistics['index_blocks']) == 0:
+         self.process_statistics['start_index'] = self.offline_index_counter
+      self.process_statistics['index_blocks'].append(self.offline_index_counter)
+      self.process_statistics['end_index'] = self.offline_index_counter
+      self.offline_index_counter += self.offset
+      self.doc_parse_count = 0
+      self.title_map_bytes = 0
+      self.block_rss_peak = 0
+      #the block and its titles are synced to disk, a restarted build continues after them
+      self.doc_ranges = merge_doc_ranges(self.doc_ranges + self.block_doc_ranges)
+      self.block_doc_ranges = []
+      self.title_maps = [title_map for title_map in self.title_maps if title_map[0] != self.title_map_id] + [[self.title_map_id, title_map_size, field_lengths_size]]
+      write_checkpoint(self.checkpoint_file, {
+         'next_block_id': self.offline_index_counter,
+         'blocks': self.process_statistics['block_memory'],
+         'title_maps': self.title_maps,
+         'doc_ranges': self.doc_ranges,
+      })
+      self.process_statistics['index_start_time'] = datetime.utcnow()
+
+   def restore_checkpoint(self, checkpoint):
+      #continues the block numbering and the statistics of the interrupted build
+      self.offline_index_counter = checkpoint['next_block_id']
+      self.title_maps = checkpoint['title_maps']
+      self.doc_ranges = checkpoint['doc_ranges']
+      self.process_statistics['block_memory'] = checkpoint['blocks']
+      self.process_statistics['index_blocks'] = [block[0] for block in checkpoint['blocks']]
+      if len(self.process_statistics['index_blocks']) > 0:
+         self.process_statistics['start_index'] = self.process_statistics['index_blocks'][0]
+         self.process_statistics['end_index'] = self.process_statistics['index_blocks'][-1]
    
    # Call when a character is read
    def characters(self, content):
@@ -135,404 +409,968 @@ class WikiPageHandler(xml.sax.ContentHandler):
          combined_words[word] += 1
          body_map[word] += 1
 
-      field_alias = ['t', 'i', 'c', 'l', 'b']
-
+      inverted_index = self.process_statistics['inverted_index']
       for word, total_freq in combined_words.items():
-         index_string = ''
-         for field_index in range(len(field_alias)):
-            field_count = field_count_manager[field_index][word]
-            if field_count != 0:
-               index_string += field_alias[field_index]+str(field_count)
-         total_word_count = total_freq
-
-         isPresent = self.process_statistics['inverted_index'].get(word, None)
-         #create a new entry if entry is not present
-         if isPresent is None:
-            self.process_statistics['inverted_index'][word] = {'total_count': 0, 'posting_list': []}
-         self.process_statistics['inverted_index'][word]['total_count'] += total_word_count
-         self.process_statistics['inverted_index'][word]['posting_list'].append([doc_id, index_string])
-
-   #postprocessing of the text returned after the parsing
-   def post_processing(self, content, wiki_id, debugMode=False):
-      
-      page_info = []
-      page_category = []
-      page_links = []
-      page_body = []
-
-      #setting up the page information
-      result, content = self.extract_information(content, wiki_id, debugMode=debugMode)
-      page_info.append(result)
-      result, content = self.extract_infobox(content, wiki_id, debugMode=debugMode)
-      page_info.append(result)
-      #setting up page category
-      result, content = self.extract_category(content, wiki_id, debugMode=debugMode)
-      page_category.append(result)
-      #setting up the page links
-      result, content = self.extract_wiki_links(content, wiki_id, debugMode=debugMode)
-      page_links.append(result)
-      # insert the body in page_body
-      page_body.append(self.get_content_body(content, wiki_id, debugMode=debugMode))
-      return self.final_text_processing(page_info), self.final_text_processing(page_category), self.final_text_processing(page_links), self.final_text_processing(page_body)
-
-   # just clean the extra data 
-   def get_content_body(self, wiki_content, wiki_id, debugMode=False):
-      regex = re.compile(self.wiki_pattern_matching["comments"])
-      new_content = re.sub(regex, ' ', wiki_content)
-      regex = re.compile(self.wiki_pattern_matching["styles"])
-      new_content = re.sub(regex, ' ', new_content)
-      regex = re.compile(self.wiki_pattern_matching["references"])
-      new_content = re.sub(regex, ' ', new_content)
-      new_content = self.remove_all_tags(new_content)
-      regex = re.compile(self.wiki_pattern_matching["curly_braces"])
-      new_content = re.sub(regex, ' ', new_content)
-      regex = re.compile(self.wiki_pattern_matching["square_braces"])
-      new_content = re.sub(regex, ' ', new_content)
-      #remove links
-      new_content = self.remove_all_urls(new_content)
-      #remove footers
-      new_content = self.strip_footers(new_content)
-      return new_content
-
-   def strip_footers(self, content):
-      labels = ["References", "Further reading", "See also", "Notes"]
-      for l in labels:
-         regex = "==%s==" % (labels)
-         found = re.search(regex, content)
-         if found is not None:
-            # get the index of the search
-            content = content[0:found.start()-1]
-      return content 
+         #counts of the word in each field, in field_alias order
+         field_counts = [field_count_manager[field_index][word] for field_index in range(len(field_alias))]
+         inverted_index.add_posting(word, doc_id, total_freq, field_counts)
 
-   #only extract infobox from the wiki page
-   def extract_infobox(self, wiki_content, wiki_id, debugMode=False):
-      start_index = wiki_content.find(self.wiki_pattern_matching["infobox"])
-      result_string = ''
-      if start_index < 0:
-         return result_string, wiki_content
-      end = len(wiki_content)
-      bracket_match_count = 2
-      start_index += len(self.wiki_pattern_matching["infobox"])
-      index = start_index
-      while(index < end):
-         if wiki_content[index] == '}':
-            bracket_match_count -= 1
-         if wiki_content[index] == '{':
-            bracket_match_count += 1
-         if bracket_match_count == 0:
-            break
-         index += 1
-      if bracket_match_count !=0 and debugMode:
-         print("extract_infobox_warning : malformed infobox found for wiki id %s" % (wiki_id))
-         return result_string, wiki_content
-      result_string = wiki_content[start_index:index-1]
-      result_string = self.remove_all_urls(result_string)
-      new_wiki_content = wiki_content[0:start_index-1] + wiki_content[index+1:-1]
-      return self.remove_all_tags(self.filter_content(result_string)), new_wiki_content
-   
-   #only extract information from the wiki page
-   def extract_information(self, wiki_content, wiki_id, debugMode=False):
-      start_index = wiki_content.find(self.wiki_pattern_matching["information"])
-      result_string = ''
-      if start_index < 0:
-         return result_string, wiki_content
-      end = len(wiki_content)
-      bracket_match_count = 2
-      start_index += len(self.wiki_pattern_matching["information"])
-      index = start_index
-      while(index < end):
-         if wiki_content[index] == '}':
-            bracket_match_count -= 1
-         if wiki_content[index] == '{':
-            bracket_match_count += 1
-         if bracket_match_count == 0:
-            break
-         index += 1
-      if bracket_match_count !=0 and debugMode:
-         print("extract_information_warning : malformed information found for wiki id %s" % (wiki_id))
-         return result_string, wiki_content
-      result_string = wiki_content[start_index:index-1]
-      result_string = self.remove_all_urls(result_string)
-      new_wiki_content = wiki_content[0:start_index-1] + wiki_content[index+1:-1]
-      return self.remove_all_tags(self.filter_content(result_string)), new_wiki_content
-
-   #only extract the category body
-   def extract_category(self, wiki_content, wiki_id, debugMode=False):
-      category_regex = re.compile(self.wiki_pattern_matching["category"], re.IGNORECASE)
-      result_string = re.findall(category_regex, wiki_content)
-      result_string = ''.join(result_string)
-      result_string = self.remove_all_urls(result_string)
-      new_wiki_content = re.sub(category_regex, '', wiki_content)
-      return self.remove_all_tags(self.filter_content(result_string)), new_wiki_content
-
-   def extract_wiki_links(self, wiki_content, wiki_id, debugMode=False):
-      wiki_links_regex = re.compile(self.wiki_pattern_matching["wiki_links"], re.IGNORECASE)
-      temp_string = re.findall(wiki_links_regex, wiki_content)
-      result_string = []
-      for value in temp_string:
-         if ':' not in value:
-            result_string.append(value)
-      result_string = ''.join(result_string)
-      result_string = self.remove_all_urls(result_string)
-      new_wiki_content = re.sub(wiki_links_regex, '', wiki_content)
-      return self.remove_all_tags(self.filter_content(result_string)), new_wiki_content
-
-   def remove_all_tags(self, wiki_content):
-      tag_regex = re.compile("<.*?>")
-      return re.sub(tag_regex, '', wiki_content)
-
-   def remove_all_urls(self, wiki_content):
-      #remove links
-      regex = re.compile(self.wiki_pattern_matching["url"])
-      wiki_content = re.sub(regex, ' ', wiki_content)
-      regex = re.compile(self.wiki_pattern_matching["www"])
-      wiki_content = re.sub(regex, ' ', wiki_content)
-      return wiki_content
+   #tokenized (info, category, links, body) fields of the page text
+   def clean_page(self, content, wiki_id):
+      return [self.stem_terms(tokens) for tokens in self.page_tokens(content, wiki_id)]
+
+   #(info, category, links, body) tokens of the page text before stemming, see text_tokens
+   def page_tokens(self, content, wiki_id):
+      fields = self.cleaner.split_page(content, wiki_id)
+      return [self.text_tokens([field]) for field in fields]
 
    # it process the text_list to execute case_folding, tokenization, stop_word removal
    # and stemming in order
    def final_text_processing(self, text_list):
-      result = self.filter_content(''.join(text_list)).lower()
+      return self.stem_terms(self.text_tokens(text_list))
+
+   #case folded tokens of the text_list without the stop words, repeated tokens included
+   def text_tokens(self, text_list):
+      result = self.cleaner.filter_content(''.join(text_list)).lower()
       #word tokenization
-      result = word_tokenize(result)
+      result = self.tokenize(result)
       # result = result.split()
       #stopword removal
-      result = list(set(result).difference(set(self.stop_words)))
-      #stemming of words and case folding
-      result = [self.stemmer.stem(w) for w in result]
-      return result
+      return [w for w in result if w not in self.stop_word_set]
 
-   def filter_content(self, content):
-      filters = set(['(', '{', '[', ']', '}', ')', '=', '|', '?', ',', '+', '\'', '\\', '*', '#', ';', '!', '\"', '%'])
-      content = content.strip()
-      if len(content) == 0:
-         return content
-      if len(set(content).intersection(filters)) == 0:
-         return content
-      for elem in filters:
-         content = content.replace(elem, ' ')
-      return content
+   #stemming of the distinct tokens
+   def stem_terms(self, tokens):
+      return [self.stemmer.stem(w) for w in set(tokens)]
+
+#fields of a posting, in the order of the field counts
+field_alias = ['t', 'i', 'c', 'l', 'b']
+
+#bm25f : weight and length normalization strength of the t, i, c, l and b field, in the order of
+#field_alias, and the saturation of the weighted term frequency
+bm25f_field_weights = np.array([2.5, 2.0, 1.0, 1.0, 2.5])
+bm25f_field_b = np.array([0.5, 0.75, 0.5, 0.75, 0.75])
+bm25f_k1 = 1.2
+
+def bm25_idf(total_documents, document_count):
+   return math.log(1.0 + (total_documents - document_count + 0.5)/(document_count + 0.5))
+
+def average_field_lengths(page_count, length_totals):
+   #average length of every field over page_count pages, a field without any token averages 1
+   average_lengths = np.ones(len(field_alias))
+   if page_count > 0:
+      average_lengths = np.asarray(length_totals, dtype=np.float64) / page_count
+      average_lengths[average_lengths == 0] = 1.0
+   return average_lengths
+
+def field_length_norms(field_lengths, average_lengths):
+   #float32 (documents x fields) bm25f length norms of the rows of a (documents x fields) length table,
+   #relative to the given average field lengths
+   scale = (bm25f_field_b / average_lengths).astype(np.float32)
+   return field_lengths.astype(np.float32) * scale + (1.0 - bm25f_field_b).astype(np.float32)
+
+def calculate_bm25f_weight(field_activation, field_counts, field_norms):
+   #saturated bm25f term frequency of every row of a (postings x fields) count array over the fields of
+   #the query, field_norms holds the length norms of the documents of the postings
+   columns = [field_alias.index(field) for field in field_activation]
+   weighted = (field_counts[:, columns] * bm25f_field_weights[columns] / field_norms[:, columns]).sum(axis=1)
+   return weighted / (bm25f_k1 + weighted)
+
+def bm25f_upper_bound(field_activation, max_field_counts, average_lengths):
+   #bound of calculate_bm25f_weight over the postings of a term. a field holding a term c times has at
+   #least c tokens, and c over its norm grows with c
+   columns = [field_alias.index(field) for field in field_activation]
+   counts = max_field_counts[columns].astype(np.float64)
+   norms = 1.0 - bm25f_field_b[columns] + bm25f_field_b[columns] * counts / average_lengths[columns]
+   weighted = (counts * bm25f_field_weights[columns] / norms).sum()
+   return weighted / (bm25f_k1 + weighted)
+
+#binary posting list format, shared by the inverted_index_file-* blocks and the prime_index_file-* files.
+#every term is one record :
+#   varint(record length) varint(term length) term varint(total frequency) varint(document count)
+#   varint maximum count of every field over the postings, bounds the score of the term while searching
+#   doc id gaps as varints
+#   one column per field in the order of field_alias : varint(column length) bitmap of the postings with
+#   a non zero count | their varint counts. columns with a zero maximum are left out, so a field restricted
+#   query only decodes its own columns
+#records of more than posting_block_size postings cut the gaps and the columns in blocks of that many
+#postings instead, behind a skip table :
+#   for every block the varints of its last doc id gap from the last doc id of the block before, the byte
+#   length of its gaps and the byte length of every column that is not left out
+#   every block, its doc id gaps (the first one from the last doc id of the block before) followed by its
+#   columns, bitmap | varint counts
+#so an intersection finds the blocks that can hold a doc id from the skip table and only decodes those
+#small lists are coded in plain python, numpy only pays off on longer ones
+varint_numpy_threshold = 64
+#has to be a multiple of 8, so the bitmaps of the blocks are whole bytes
+posting_block_size = 128
 
-def store_partial_index_offline(process_id, inverted_index, offline_index_storage, index_file_name, file_index_id):
+def encode_varint(value):
+   result = bytearray()
+   while value >= 0x80:
+      result.append((value & 0x7f) | 0x80)
+      value >>= 7
+   result.append(value)
+   return bytes(result)
+
+def decode_varint(buffer, position):
+   #returns (value, position after the varint)
+   result = 0
+   shift = 0
+   while True:
+      byte = buffer[position]
+      position += 1
+      result |= (byte & 0x7f) << shift
+      if byte < 0x80:
+         return result, position
+      shift += 7
+
+def varint_lengths(values):
+   #byte length of the varint of every value
+   values = np.asarray(values, dtype=np.uint64)
+   lengths = np.ones(len(values), dtype=np.int64)
+   rest = values >> np.uint64(7)
+   while rest.any():
+      lengths += (rest > 0)
+      rest >>= np.uint64(7)
+   return lengths
+
+def encode_varints(values):
+   if len(values) < varint_numpy_threshold:
+      return b''.join([encode_varint(int(value)) for value in values])
+   values = np.asarray(values, dtype=np.uint64)
+   lengths = varint_lengths(values)
+   starts = np.cumsum(lengths) - lengths
+   result = np.empty(int(lengths.sum()), dtype=np.uint8)
+   for byte_index in range(int(lengths.max())):
+      active = lengths > byte_index
+      byte = (values[active] >> np.uint64(7*byte_index)) & np.uint64(0x7f)
+      #continuation bit on every byte but the last one of a varint
+      byte |= (lengths[active] - 1 > byte_index).astype(np.uint64) << np.uint64(7)
+      result[starts[active] + byte_index] = byte
+   return result.tobytes()
+
+def decode_varints(buffer, position, count):
+   #returns (int64 array of count varints starting at position, position after them)
+   if count < varint_numpy_threshold:
+      values = np.empty(count, dtype=np.int64)
+      for index in range(count):
+         values[index], position = decode_varint(buffer, position)
+      return values, position
+   data = np.frombuffer(buffer, dtype=np.uint8, offset=position)
+   ends = np.flatnonzero(data < 0x80)[:count]
+   used = int(ends[-1]) + 1
+   #the common case, every value fits in a single byte
+   if used == count:
+      return data[:count].astype(np.int64), position + used
+   starts = np.empty(count, dtype=np.int64)
+   starts[0] = 0
+   starts[1:] = ends[:-1] + 1
+   byte_position = np.arange(used, dtype=np.int64) - np.repeat(starts, ends - starts + 1)
+   parts = (data[:used] & 0x7f).astype(np.int64) << (7*byte_position)
+   return np.add.reduceat(parts, starts), position + used
+
+def encode_posting_list(term, total_frequency, doc_ids, field_counts):
+   #doc_ids have to be sorted, field_counts holds the per field counts of every posting
+   if len(doc_ids) < varint_numpy_threshold:
+      gaps = []
+      previous_doc_id = 0
+      for doc_id in doc_ids:
+         gaps.append(doc_id - previous_doc_id)
+         previous_doc_id = doc_id
+      columns = [np.array([posting_counts[field_index] for posting_counts in field_counts], dtype=np.int64) for field_index in range(len(field_alias))]
+      max_counts = [int(column.max()) if len(column) > 0 else 0 for column in columns]
+   else:
+      doc_ids = np.asarray(doc_ids, dtype=np.int64)
+      field_counts = np.asarray(field_counts, dtype=np.int64).reshape(len(doc_ids), len(field_alias))
+      gaps = np.diff(doc_ids, prepend=0)
+      columns = field_counts.T
+      max_counts = field_counts.max(axis=0)
+   term_bytes = term.encode('utf-8')
+   body = [encode_varint(len(term_bytes)), term_bytes, encode_varint(int(total_frequency)), encode_varint(len(doc_ids)), encode_varints(max_counts)]
+   if len(doc_ids) > posting_block_size:
+      body.extend(encode_posting_blocks(doc_ids, gaps, columns, max_counts))
+   else:
+      body.append(encode_varints(gaps))
+      for field_index in range(len(field_alias)):
+         if max_counts[field_index] == 0:
+            continue
+         present = columns[field_index] != 0
+         column = np.packbits(present).tobytes() + encode_varints(columns[field_index][present])
+         body.append(encode_varint(len(column)))
+         body.append(column)
+   body = b''.join(body)
+   return encode_varint(len(body)) + body
+
+def encode_posting_blocks(doc_ids, gaps, columns, max_counts):
+   #skip table and blocks of a long posting list, every section is coded once for the whole list and
+   #then cut at the block boundaries
+   block_starts = np.arange(0, len(doc_ids), posting_block_size)
+   block_ends = np.minimum(block_starts + posting_block_size, len(doc_ids))
+   gap_offsets = np.concatenate(([0], np.cumsum(varint_lengths(gaps))))
+   sections = [[encode_varints(gaps), gap_offsets[block_starts], gap_offsets[block_ends]]]
+   skips = [np.diff(doc_ids[block_ends - 1], prepend=0), gap_offsets[block_ends] - gap_offsets[block_starts]]
+   for field_index in range(len(field_alias)):
+      if max_counts[field_index] == 0:
+         continue
+      present = columns[field_index] != 0
+      counts = columns[field_index][present]
+      count_offsets = np.concatenate(([0], np.cumsum(varint_lengths(counts))))
+      present_before = np.concatenate(([0], np.cumsum(present)))
+      count_starts = count_offsets[present_before[block_starts]]
+      count_ends = count_offsets[present_before[block_ends]]
+      bitmap_starts = block_starts >> 3
+      bitmap_ends = (block_ends + 7) >> 3
+      sections.append([np.packbits(present).tobytes(), bitmap_starts, bitmap_ends])
+      sections.append([encode_varints(counts), count_starts, count_ends])
+      skips.append(bitmap_ends - bitmap_starts + count_ends - count_starts)
+   content = [encode_varints(np.stack(skips, axis=1).ravel())]
+   for block_index in range(len(block_starts)):
+      for section, starts, ends in sections:
+         content.append(section[starts[block_index]:ends[block_index]])
+   return content
+
+def decode_posting_term(record):
+   #only the term of a record body, enough for comparisons while searching
+   term_length, position = decode_varint(record, 0)
+   return bytes(record[position:position+term_length]).decode('utf-8')
+
+def decode_document_count(record):
+   #only the number of postings of a record body
+   term_length, position = decode_varint(record, 0)
+   _, position = decode_varint(record, position+term_length)
+   return decode_varint(record, position)[0]
+
+def decode_posting_header(record):
+   #returns (term, total_frequency, doc_count, max_field_counts, position of the postings) of a record body
+   term_length, position = decode_varint(record, 0)
+   term = bytes(record[position:position+term_length]).decode('utf-8')
+   total_frequency, position = decode_varint(record, position+term_length)
+   doc_count, position = decode_varint(record, position)
+   max_field_counts, position = decode_varints(record, position, len(field_alias))
+   return term, total_frequency, doc_count, max_field_counts, position
+
+def decode_posting_list(record, fields=None):
+   #returns (term, total_frequency, doc_ids, field_counts, max_field_counts) of a record body,
+   #only the columns of the given field aliases are decoded, the others are left as zeros
+   term, total_frequency, doc_count, max_field_counts, position = decode_posting_header(record)
+   if doc_count > posting_block_size:
+      skips = decode_posting_skips(record)
+      doc_ids, field_counts = decode_posting_blocks(record, skips, fields=fields)
+      return term, total_frequency, doc_ids, field_counts, max_field_counts
+   gaps, position = decode_varints(record, position, doc_count)
+   field_counts = np.zeros((doc_count, len(field_alias)), dtype=np.int64)
+   for field_index in range(len(field_alias)):
+      if max_field_counts[field_index] == 0:
+         continue
+      column_length, position = decode_varint(record, position)
+      if fields is None or field_alias[field_index] in fields:
+         bitmap_length = (doc_count + 7) >> 3
+         present = np.unpackbits(np.frombuffer(record, dtype=np.uint8, count=bitmap_length, offset=position), count=doc_count).astype(bool)
+         field_counts[present, field_index], _ = decode_varints(record, position+bitmap_length, int(present.sum()))
+      position += column_length
+   return term, total_frequency, np.cumsum(gaps), field_counts, max_field_counts
+
+def decode_posting_skips(record):
+   #skip table of a record of more than posting_block_size postings, as a dict of the header, the last doc
+   #id and the record offset of every block and the byte lengths of the sections of every block
+   term, total_frequency, doc_count, max_field_counts, position = decode_posting_header(record)
+   columns = np.flatnonzero(max_field_counts)
+   block_count = (doc_count + posting_block_size - 1) // posting_block_size
+   skips, position = decode_varints(record, position, block_count * (2 + len(columns)))
+   skips = skips.reshape(block_count, 2 + len(columns))
+   block_lengths = skips[:, 1:].sum(axis=1)
+   return {
+      'term': term,
+      'total_frequency': total_frequency,
+      'doc_count': doc_count,
+      'max_field_counts': max_field_counts,
+      'columns': columns,
+      'last_doc_ids': np.cumsum(skips[:, 0]),
+      'block_offsets': position + np.cumsum(block_lengths) - block_lengths,
+      'section_lengths': skips[:, 1:],
+   }
+
+def gather_ranges(data, starts, lengths):
+   #concatenation of data[start:start+length] over the starts and lengths
+   ends = np.cumsum(lengths)
+   return data[np.arange(int(ends[-1]) if len(ends) > 0 else 0) + np.repeat(starts - ends + lengths, lengths)]
+
+def decode_posting_blocks(record, skips, blocks=None, fields=None):
+   #returns (doc_ids, field_counts) of the postings in the sorted block indexes of a record, every block by
+   #default. only the columns of the given field aliases are decoded, the others are left as zeros
+   if blocks is None:
+      blocks = np.arange(len(skips['last_doc_ids']))
+   if len(blocks) == 0:
+      return np.empty(0, dtype=np.int64), np.zeros((0, len(field_alias)), dtype=np.int64)
+   data = np.frombuffer(record, dtype=np.uint8)
+   doc_counts = np.minimum(skips['doc_count'] - blocks * posting_block_size, posting_block_size)
+   block_positions = np.cumsum(doc_counts) - doc_counts
+   section_lengths = skips['section_lengths'][blocks]
+   section_offsets = skips['block_offsets'][blocks, None] + np.cumsum(section_lengths, axis=1) - section_lengths
+   gaps, _ = decode_varints(gather_ranges(data, section_offsets[:, 0], section_lengths[:, 0]).tobytes(), 0, int(doc_counts.sum()))
+   #the gaps of every block count on from the last doc id of the block before it
+   doc_ids = np.cumsum(gaps)
+   block_bases = np.where(blocks > 0, skips['last_doc_ids'][np.maximum(blocks - 1, 0)], 0)
+   block_bases -= np.concatenate(([0], doc_ids[block_positions[1:] - 1]))
+   doc_ids += np.repeat(block_bases, doc_counts)
+   field_counts = np.zeros((len(doc_ids), len(field_alias)), dtype=np.int64)
+   bitmap_lengths = (doc_counts + 7) >> 3
+   for column_index, field_index in enumerate(skips['columns']):
+      if fields is not None and field_alias[field_index] not in fields:
+         continue
+      column_offsets = section_offsets[:, 1 + column_index]
+      present = np.unpackbits(gather_ranges(data, column_offsets, bitmap_lengths), count=len(doc_ids)).astype(bool)
+      counts = gather_ranges(data, column_offsets + bitmap_lengths, section_lengths[:, 1 + column_index] - bitmap_lengths)
+      field_counts[present, field_index], _ = decode_varints(counts.tobytes(), 0, int(present.sum()))
+   return doc_ids, field_counts
+
+#the doc_title_map-offset file holds the first doc id followed by the title offset of every doc id from
+#there on, little endian uint64, so a title is found by doc id without a search
+primary_offset_format = '<Q'
+primary_offset_dtype = np.dtype('<u8')
+missing_title_offset = (1<<64) - 1
+
+#the doc_field_lengths file holds a header of the first doc id, the count of pages with any token and the
+#token total of every field, uint64, followed by the token count of every field of every doc id from the
+#first one on in the order of field_alias, little endian uint32. missing pages are zeros, so the average
+#field lengths come from the header and the table is memory mapped.
+#the workers append (doc id, field lengths) records to their doc_field_lengths-* files
+field_length_header_dtype = np.dtype('<u8')
+field_length_header_size = (2 + len(field_alias)) * field_length_header_dtype.itemsize
+field_length_dtype = np.dtype('<u4')
+field_length_record_dtype = np.dtype([('doc_id', '<u8'), ('lengths', '<u4', (len(field_alias),))])
+
+#bm25 idf of a term in the term dictionary, little endian float32
+term_idf_format = '<f'
+
+class TermDictionaryWriter(object):
+   #writes the term_dictionary of the primary index. the sorted terms are front coded in groups of
+   #group_size, every entry is the term followed by the varints of its range, its block of the range, the
+   #offset and length of its record body in the block and its document count, and by its bm25 idf. the
+   #first term of every group and the group offset go to the -sample file, which the search holds in memory
+   def __init__(self, file_path, group_size, buffer_size, checkpoint=None):
+      self.group_size = group_size
+      self.entry_count = 0
+      self.present_offset = 0
+      self.previous_term = b''
+      if checkpoint is not None:
+         #drops the entries written after the checkpoint
+         for file_name, file_size in [[file_path, checkpoint['size']], [file_path + '-sample', checkpoint['sample_size']]]:
+            with open(file_name, 'r+b') as file_ptr:
+               file_ptr.truncate(file_size)
+         self.entry_count = checkpoint['entries']
+         self.present_offset = checkpoint['size']
+         self.previous_term = checkpoint['previous_term'].encode('utf-8')
+      self.dictionary_file = open(file_path, 'ab' if checkpoint is not None else 'wb', buffering=buffer_size)
+      self.sample_file = open(file_path + '-sample', 'a' if checkpoint is not None else 'w', encoding='utf-8')
+
+   def add(self, term, range_id, block_id, offset, length, doc_count, idf):
+      term_bytes = term.encode('utf-8')
+      shared = 0
+      if self.entry_count % self.group_size == 0:
+         self.sample_file.write("%s %d\n" % (term, self.present_offset))
+      else:
+         shared = len(os.path.commonprefix([self.previous_term, term_bytes]))
+      content = encode_varint(shared) + encode_varint(len(term_bytes) - shared) + term_bytes[shared:] + encode_varints([range_id, block_id, offset, length, doc_count]) + struct.pack(term_idf_format, idf)
+      self.dictionary_file.write(content)
+      self.present_offset += len(content)
+      self.previous_term = term_bytes
+      self.entry_count += 1
+
+   def checkpoint(self):
+      #syncs the dictionary, returns the state a resumed merge continues from
+      for file_ptr in [self.dictionary_file, self.sample_file]:
+         file_ptr.flush()
+         os.fsync(file_ptr.fileno())
+      return {'size': self.present_offset, 'sample_size': os.fstat(self.sample_file.fileno()).st_size, 'entries': self.entry_count, 'previous_term': self.previous_term.decode('utf-8')}
+
+   def close(self):
+      self.dictionary_file.close()
+      self.sample_file.close()
+
+def concatenate_term_dictionaries(cfg, range_count):
+   #the dictionaries of the term ranges follow each other in term order, returns the size of the
+   #dictionary and the range dictionary files
+   dictionary_file = os.path.join(cfg['offline_index_storage'], cfg['term_dictionary_name'])
+   present_offset = 0
+   delete_files = []
+   with open(dictionary_file, 'wb') as target_file, open(dictionary_file + '-sample', 'w', encoding='utf-8') as sample_file:
+      for range_id in range(range_count):
+         range_dictionary_file = dictionary_file + '-' + str(range_id)
+         if not os.path.isfile(range_dictionary_file):
+            continue
+         for term, offset in read_block_samples(range_dictionary_file + '-sample'):
+            sample_file.write("%s %d\n" % (term, present_offset + offset))
+         with open(range_dictionary_file, 'rb') as source_file:
+            shutil.copyfileobj(source_file, target_file, 1<<20)
+         present_offset += os.path.getsize(range_dictionary_file)
+         delete_files.extend([os.path.basename(range_dictionary_file), os.path.basename(range_dictionary_file) + '-sample'])
+   return present_offset, delete_files
+
+def read_posting_record(file_ptr):
+   #reads the next record body from a binary index file, None at the end of the file
+   record_length = 0
+   shift = 0
+   while True:
+      byte = file_ptr.read(1)
+      if not byte:
+         return None
+      record_length |= (byte[0] & 0x7f) << shift
+      if byte[0] < 0x80:
+         break
+      shift += 7
+   return file_ptr.read(record_length)
+
+def store_partial_index_offline(process_id, inverted_index, offline_index_storage, index_file_name, file_index_id, sample_interval=128):
    offline_index_file = index_file_name + '-' + str(file_index_id)
    index_dump_file = os.path.join(offline_index_storage, offline_index_file)
    #print("writing inverted index to file -- %s " % index_dump_file)
    start_time = datetime.utcnow()
-   with open(index_dump_file, 'w+', encoding='utf-8') as txt_file:
-      for word in sorted(inverted_index.keys()):
-         posting_list = inverted_index[word] 
-         total_freq_count = posting_list['total_count']
-         txt_file.write("%s %s" % (word, total_freq_count))
-         for entry in posting_list['posting_list']:
-            #value = entry[0] - prev
-            txt_file.write(" %s %s" %(entry[0], entry[1]))
-            #prev = entry[0]
-         txt_file.write("\n")
+   #every sample_interval-th term and its offset go to the -sample file, used to split and seek the merge
+   with open(index_dump_file, 'wb') as index_file, open(index_dump_file + '-sample', 'w', encoding='utf-8') as sample_file:
+      present_offset = 0
+      for word_count, (word, total_freq_count, doc_ids, field_counts) in enumerate(inverted_index.sorted_postings()):
+         content = encode_posting_list(word, total_freq_count, doc_ids, field_counts)
+         index_file.write(content)
+         if word_count % sample_interval == 0:
+            sample_file.write("%s %d\n" % (word, present_offset))
+         present_offset += len(content)
+      for file_ptr in [index_file, sample_file]:
+         file_ptr.flush()
+         os.fsync(file_ptr.fileno())
    time_delta = (datetime.utcnow() - start_time).total_seconds()
    file_size = os.path.getsize(index_dump_file)/float(1<<20)
    print(">process_id[%s] : [%s] saved index block on disk with name : %s in %.2f seconds -- [%.2f MB]" % (process_id, file_index_id, offline_index_file, time_delta, file_size))
    return file_size
 
-def store_partial_title_map_offline(process_id, block_count, doc_id_title_hash, offline_index_storage, title_map_name):
-   #creating doc title map file
-   title_map_file_name = title_map_name+'-'+str(process_id)
+def store_partial_title_map_offline(process_id, block_count, doc_id_title_hash, offline_index_storage, title_map_name, title_map_id=None):
+   #creating doc title map file, returns its size
+   if title_map_id is None:
+      title_map_id = process_id
+   title_map_file_name = title_map_name+'-'+str(title_map_id)
    title_map_file = os.path.join(offline_index_storage, title_map_file_name)
    start_time = datetime.utcnow()
    with open(title_map_file, 'a+', encoding='utf-8') as txt_file:
       for doc_id, title in doc_id_title_hash.items():
          txt_file.write("%d %s\n" % (doc_id, title))
+      txt_file.flush()
+      os.fsync(txt_file.fileno())
+      title_map_size = os.fstat(txt_file.fileno()).st_size
    time_delta = (datetime.utcnow() - start_time).total_seconds()
    print(">process_id[%s] : [%s] title_map_hash written to the disk in %.2f seconds" % (process_id, block_count, time_delta))
    print("----"*25)
+   return title_map_size
+
+def store_partial_field_lengths_offline(doc_field_lengths, offline_index_storage, field_lengths_name, title_map_id):
+   #appends the [doc id, field lengths] of the pages of a block to the field lengths of the title map,
+   #returns the file size
+   records = np.zeros(len(doc_field_lengths), dtype=field_length_record_dtype)
+   if len(doc_field_lengths) > 0:
+      entries = np.array(doc_field_lengths, dtype=np.int64)
+      records['doc_id'] = entries[:, 0]
+      records['lengths'] = entries[:, 1:]
+   with open(os.path.join(offline_index_storage, field_lengths_name+'-'+str(title_map_id)), 'ab') as field_lengths_file:
+      field_lengths_file.write(records.tobytes())
+      field_lengths_file.flush()
+      os.fsync(field_lengths_file.fileno())
+      return os.fstat(field_lengths_file.fileno()).st_size
 
-def merge_title_map_files(cfg):
+def read_field_length_table(file_path):
+   #returns [first doc id, memory mapped (doc ids x fields) lengths, page count, field length totals] of
+   #a doc_field_lengths file, None without one
+   if not os.path.isfile(file_path):
+      return None
+   header = np.fromfile(file_path, dtype=field_length_header_dtype, count=2 + len(field_alias))
+   field_lengths = np.zeros((0, len(field_alias)), dtype=field_length_dtype)
+   if os.path.getsize(file_path) > field_length_header_size:
+      field_lengths = np.memmap(file_path, dtype=field_length_dtype, mode='r', offset=field_length_header_size).reshape(-1, len(field_alias))
+   return [int(header[0]), field_lengths, int(header[1]), header[2:].astype(np.int64)]
+
+def lookup_field_lengths(field_length_table, doc_ids):
+   #(doc ids x fields) lengths of the doc ids in a table of read_field_length_table, zeros for the doc ids
+   #the table doesn't cover
+   first_doc_id, field_lengths = field_length_table[0], field_length_table[1]
+   lengths = np.zeros((len(doc_ids), len(field_alias)), dtype=field_length_dtype)
+   in_table = (doc_ids >= first_doc_id) & (doc_ids < first_doc_id + len(field_lengths))
+   lengths[in_table] = field_lengths[doc_ids[in_table] - first_doc_id]
+   return lengths
+
+def merge_field_length_files(cfg, field_length_files=None, deleted_doc_ids=None):
+   #merges the per worker field lengths, or the given doc_field_lengths tables, leaving out deleted_doc_ids
+   offline_index_storage = cfg['offline_index_storage']
+   doc_ids = [np.empty(0, dtype=np.int64)]
+   field_lengths = [np.empty((0, len(field_alias)), dtype=field_length_dtype)]
+   if field_length_files is None:
+      for title_map_id in list_numbered_files(offline_index_storage, cfg['doc_field_lengths_name']):
+         records = np.fromfile(os.path.join(offline_index_storage, cfg['doc_field_lengths_name']+'-'+str(title_map_id)), dtype=field_length_record_dtype)
+         doc_ids.append(records['doc_id'].astype(np.int64))
+         field_lengths.append(records['lengths'])
+   else:
+      for file_path in field_length_files:
+         table = read_field_length_table(file_path)
+         if table is not None:
+            doc_ids.append(table[0] + np.arange(len(table[1]), dtype=np.int64))
+            field_lengths.append(table[1])
+   doc_ids = np.concatenate(doc_ids)
+   field_lengths = np.concatenate(field_lengths)
+   if deleted_doc_ids is not None and len(deleted_doc_ids) > 0:
+      live = ~np.isin(doc_ids, deleted_doc_ids)
+      doc_ids = doc_ids[live]
+      field_lengths = field_lengths[live]
+   first_doc_id = int(doc_ids.min()) if len(doc_ids) > 0 else cfg['first_doc_id']
+   table = np.zeros((int(doc_ids.max()) - first_doc_id + 1 if len(doc_ids) > 0 else 0, len(field_alias)), dtype=field_length_dtype)
+   table[doc_ids - first_doc_id] = field_lengths
+   header = np.zeros(2 + len(field_alias), dtype=field_length_header_dtype)
+   header[0] = first_doc_id
+   header[1] = np.count_nonzero(field_lengths.any(axis=1))
+   header[2:] = field_lengths.sum(axis=0, dtype=np.uint64)
+   with open(os.path.join(offline_index_storage, cfg['doc_field_lengths_name']), 'wb') as table_file:
+      table_file.write(header.tobytes())
+      table_file.write(table.tobytes())
+   print('[INFO] : field lengths of %d pages written' % len(doc_ids))
+   return len(doc_ids)
+
+def read_title_map_entries(title_map_file):
+   #yields (doc_id, line) from a partial title map, which is already sorted by doc id
+   with open(title_map_file, 'r', encoding='utf-8') as txt_file:
+      for line in txt_file:
+         entry = line.strip()
+         if len(entry) == 0:
+            continue
+         yield int(entry.split(' ', 1)[0]), entry
+
+def merge_title_map_files(cfg, title_map_files=None, deleted_doc_ids=None):
+   #merges the per worker title maps, or the given title map files, leaving out deleted_doc_ids
    merged_title_file = os.path.join(cfg['offline_index_storage'], cfg['doc_title_map'])
    offset_file_name = os.path.join(cfg['offline_index_storage'], cfg['doc_title_map']+'-offset')
    
    delete_temporary_index_files(cfg['offline_index_storage'], [cfg['doc_title_map'], cfg['doc_title_map']+'-offset'], verbose=True)
-   merged_title_offset_file = open(offset_file_name, 'a+')
+   merged_title_offset_file = open(offset_file_name, 'wb')
    title_counter = 0
    present_offset = 0
+   next_doc_id = None
    print('[INFO] : merging the partial title map files..')
    start_time = datetime.utcnow()
    with open(merged_title_file, 'a+', encoding='utf-8') as txt_file:
-      temp_file_handler = []
-      temp_file_open_status = []
-      for index in range(1, cfg['offset']+1):
-         temp_file_name = cfg['doc_title_map']+'-'+str(index)
-         temp_file_handler.append(open(os.path.join(cfg['offline_index_storage'], temp_file_name), 'r', encoding='utf-8'))
-         temp_file_open_status.append(True)
-      #merge the title files
-      while any(temp_file_open_status):
-         file_index = title_counter % cfg['offset']
-         temp_entry = temp_file_handler[file_index].readline().strip()
-         #close the empty file
-         title_counter += 1
-         if not temp_file_open_status[file_index] or not temp_entry or len(temp_entry)==0:
-            temp_file_open_status[file_index] = False
-            temp_file_handler[file_index].close()
+      if title_map_files is None:
+         #one title map per worker and build run
+         title_map_files = [os.path.join(cfg['offline_index_storage'], cfg['doc_title_map']+'-'+str(index)) for index in list_numbered_files(cfg['offline_index_storage'], cfg['doc_title_map'])]
+      title_streams = []
+      for temp_file_name in title_map_files:
+         if os.path.isfile(temp_file_name):
+            title_streams.append(read_title_map_entries(temp_file_name))
+      #pages are handed out to the workers in batches, so merge the title files on doc id
+      for doc_id, temp_entry in heapq.merge(*title_streams):
+         if deleted_doc_ids is not None and doc_id in deleted_doc_ids:
             continue
          final_content = '%s\n' % temp_entry
          txt_file.write(final_content)
-         merged_title_offset_file.write('%d\n' % present_offset)
-         present_offset += (len(final_content.strip().encode())+len(os.linesep))
+         if next_doc_id is None:
+            merged_title_offset_file.write(struct.pack(primary_offset_format, doc_id))
+            next_doc_id = doc_id
+         #deleted pages leave gaps in the doc ids
+         merged_title_offset_file.write(struct.pack(primary_offset_format, missing_title_offset)*(doc_id - next_doc_id))
+         merged_title_offset_file.write(struct.pack(primary_offset_format, present_offset))
+         next_doc_id = doc_id + 1
+         present_offset += len(final_content.encode('utf-8'))
+         title_counter += 1
    #finally close the merged_offset_file
    merged_title_offset_file.close()
    time_delta = (datetime.utcnow() - start_time).total_seconds()
    print('[INFO] : merged title map files in %.2f seconds, total titles : %s' % (time_delta, title_counter))
    return title_counter
 
-def merge_all_index_files(cfg, delete_temp_files=False):
-   offline_index_counter = cfg['offline_index_counter']
-   stats_file_name = cfg['primary_stats_file_name']
-   index_file_name = cfg['inverted_index_file']
+class IndexBlockReader(object):
+   #sequential reader of the records of an inverted_index_file-* block, or of a series of
+   #prime_index_file-* files read one after the other. reads in large chunks and cuts the
+   #records out of the buffer
+   def __init__(self, file_paths, buffer_size):
+      self.file_paths = file_paths
+      self.file_index = 0
+      self.file_ptr = open(file_paths[0], 'rb', buffering=0)
+      self.buffer_size = buffer_size
+      self.buffer = b''
+      self.position = 0
+
+   def next_record(self):
+      #returns the next record body, None at the end of the block
+      while True:
+         end = self.position
+         while end < len(self.buffer) and self.buffer[end] >= 0x80:
+            end += 1
+         if end < len(self.buffer):
+            record_length, start = decode_varint(self.buffer, self.position)
+            if start + record_length <= len(self.buffer):
+               self.position = start + record_length
+               return self.buffer[start:self.position]
+         #the record is not complete in the buffer, append the next chunk
+         data = self.file_ptr.read(self.buffer_size)
+         if not data:
+            if self.file_index + 1 == len(self.file_paths):
+               return None
+            #records never span files, move on to the next file of the series
+            self.file_ptr.close()
+            self.file_index += 1
+            self.file_ptr = open(self.file_paths[self.file_index], 'rb', buffering=0)
+            self.buffer = b''
+            self.position = 0
+            continue
+         self.buffer = self.buffer[self.position:] + data
+         self.position = 0
+
+   def seek(self, offset, file_index=0):
+      #offset within the file_index-th file of the series
+      if file_index != self.file_index:
+         self.file_ptr.close()
+         self.file_index = file_index
+         self.file_ptr = open(self.file_paths[self.file_index], 'rb', buffering=0)
+      self.file_ptr.seek(offset, 0)
+      self.buffer = b''
+      self.position = 0
+
+   def close(self):
+      self.file_ptr.close()
+
+def read_block_samples(sample_file):
+   #returns the sampled [term, offset] of an inverted_index_file-* block, sorted on term
+   samples = []
+   if not os.path.isfile(sample_file):
+      return samples
+   with open(sample_file, 'r', encoding='utf-8') as txt_file:
+      for line in txt_file:
+         data = line.rstrip('\n').rsplit(' ', 1)
+         samples.append([data[0], int(data[1])])
+   return samples
+
+def read_merge_seek_points(cfg, input_id):
+   #sampled [term, file of the series, record offset in the file] of a merge input, sorted on term. the
+   #inverted_index_file-* blocks have -sample files, a series of prime_index_file-* files is sampled
+   #through the first terms of the groups of its term dictionary
+   input_files = cfg['merge_input_files'][input_id]
+   if cfg['merge_input_dictionaries'] is None:
+      return [[term, 0, offset] for term, offset in read_block_samples(input_files[0] + '-sample')]
+   dictionary_file = cfg['merge_input_dictionaries'][input_id]
+   file_ids = dict((os.path.basename(file_path), file_id) for file_id, file_path in enumerate(input_files))
+   seek_points = []
+   if os.path.getsize(dictionary_file) == 0:
+      return seek_points
+   with open(dictionary_file, 'rb') as dictionary_ptr:
+      data = mmap.mmap(dictionary_ptr.fileno(), 0, access=mmap.ACCESS_READ)
+      for term, group_offset in read_block_samples(dictionary_file + '-sample'):
+         #the first entry of a group is not front coded
+         _, position = decode_varint(data, group_offset)
+         suffix_length, position = decode_varint(data, position)
+         range_id, block_id, offset, length, _ = [int(value) for value in decode_varints(data, position + suffix_length, 5)[0]]
+         file_id = file_ids.get('%s-%d-%d' % (cfg['primary_index_file_name'], range_id, block_id), None)
+         if file_id is not None:
+            seek_points.append([term, file_id, offset - len(encode_varint(length))])
+      data.close()
+   return seek_points
+
+def plan_merge_ranges(cfg, range_count):
+   #splits the vocabulary into range_count [start token, end token) ranges of about the same number
+   #of sampled terms, None stands for an open end
+   sampled_terms = []
+   for input_id in range(len(cfg['merge_input_files'])):
+      sampled_terms.extend([seek_point[0] for seek_point in read_merge_seek_points(cfg, input_id)])
+   sampled_terms.sort()
+   split_tokens = []
+   for i in range(1, range_count):
+      if len(sampled_terms) == 0:
+         break
+      token = sampled_terms[(i*len(sampled_terms))//range_count]
+      if len(split_tokens) == 0 or split_tokens[-1] < token:
+         split_tokens.append(token)
+   bounds = [None] + split_tokens + [None]
+   return [[bounds[i], bounds[i+1]] for i in range(len(bounds)-1)]
+
+def merge_index_range(cfg, range_id, start_token, end_token, result_queue=None, checkpoint=None):
+   #k-way merge of the [start_token, end_token) terms of every input into prime_index_file-<range_id>-* files,
+   #the postings of the documents in cfg['merge_tombstones'] are dropped on the way. every completed
+   #block is checkpointed, a merge resumed from checkpoint continues after its last term
+   merge_input_files = cfg['merge_input_files']
+   offline_index_counter = len(merge_input_files)
+   tombstones = cfg['merge_tombstones']
    offline_index_storage = cfg['offline_index_storage']
-   primary_index_file_name = cfg['primary_index_file_name']
-   primary_index_offset_name = cfg['primary_index_offset_name']
+   primary_index_file_name = cfg['primary_index_file_name'] + '-' + str(range_id)
    primary_index_size = cfg['primary_index_size']
+   checkpoint_file = os.path.join(offline_index_storage, cfg['checkpoint_name'] + '-merge-' + str(range_id))
+   dictionary_file = os.path.join(offline_index_storage, cfg['term_dictionary_name'] + '-' + str(range_id))
+   total_unique_tokens = 0
+   primary_index_counter = 0
    total_primary_index_size = 0
-
-   #clean the primary index files and primary index offset
-   delete_files = []
-   for target_file_name in os.listdir(offline_index_storage):
-      if stats_file_name in target_file_name or primary_index_file_name in target_file_name or primary_index_offset_name in target_file_name:
-         delete_files.append(target_file_name)
-   #actually deletes the files
-   delete_temporary_index_files(offline_index_storage, delete_files, verbose=True)
-
-   index_file_pointer = [None]*offline_index_counter
-   primary_heap = []
-   present_token = ['']*offline_index_counter
-   present_freq = [0]*offline_index_counter
-   present_content = ['']*offline_index_counter
-   present_token_count = [0]*offline_index_counter
-   index_file_open_status = [False]*offline_index_counter
    primary_index_offset = []
+   resume_token = None
+   if checkpoint is not None:
+      primary_index_offset = checkpoint['primary_index_offset']
+      total_unique_tokens = checkpoint['tokens']
+      primary_index_counter = len(primary_index_offset)
+      total_primary_index_size = checkpoint['size']
+      if len(primary_index_offset) > 0:
+         resume_token = primary_index_offset[-1][2]
+   term_dictionary = TermDictionaryWriter(dictionary_file, cfg['term_dictionary_group_size'], cfg['merge_write_buffer_size'], None if checkpoint is None else checkpoint['term_dictionary'])
+   seek_token = start_token if resume_token is None else resume_token
+   merge_start_time = datetime.utcnow()
 
-   delete_files = []
+   #the heap holds one (token, block) entry per block that still has terms of the range
+   index_readers = [None]*offline_index_counter
+   present_record = [None]*offline_index_counter
+   primary_heap = []
    for i in range(offline_index_counter):
-      offline_index_file = index_file_name + '-' + str(i+1) 
-      index_dump_file = os.path.join(offline_index_storage, offline_index_file)
-      index_file_pointer[i] = open(index_dump_file, 'r', encoding='utf-8')
-      temp_entry = index_file_pointer[i].readline().strip()
-      delete_files.append(index_file_name+'-'+str(i+1))
+      index_readers[i] = IndexBlockReader(merge_input_files[i], cfg['merge_read_buffer_size'])
+      present_token = None
+      if seek_token is not None:
+         #seek to the last sampled term before the range, then skip to the range
+         seek_points = read_merge_seek_points(cfg, i)
+         sample_index = bisect.bisect_left([seek_point[0] for seek_point in seek_points], seek_token) - 1
+         if sample_index >= 0:
+            index_readers[i].seek(seek_points[sample_index][2], seek_points[sample_index][1])
+      while True:
+         present_record[i] = index_readers[i].next_record()
+         if present_record[i] is None:
+            break
+         present_token = decode_posting_term(present_record[i])
+         if (start_token is None or present_token >= start_token) and (resume_token is None or present_token > resume_token):
+            break
       #close the empty file
-      if not temp_entry or len(temp_entry)==0:
-         # print(">> closing the file : %s after processing %s words" % ((index_file_name+'-'+str(i), present_token_count[i])))
-         index_file_pointer[i].close()
+      if present_record[i] is None or (end_token is not None and present_token >= end_token):
+         index_readers[i].close()
          continue
-      temp_entry = temp_entry.split(' ', 2)
-      if len(temp_entry) != 3:
-         print(">> wrongly formatted index entries for index file %s : %s" % ((index_file_name+'-'+str(i+1)), temp_entry))
-         continue
-      #initializing the head pointer values for each index files
-      present_token[i] = temp_entry[0].strip()
-      present_freq[i] = int(temp_entry[1].strip())
-      present_content[i] = temp_entry[2].strip()
-      present_token_count[i] += 1
-      #setting file open status
-      index_file_open_status[i] = True
-
-      if present_token[i] not in primary_heap:
-         heapq.heappush(primary_heap, present_token[i])
+      primary_heap.append((present_token, i))
+   heapq.heapify(primary_heap)
 
-   total_unique_tokens = 0
-   primary_index_counter = 0
-
-   final_index_file_name = primary_index_file_name + '-' + str(primary_index_counter)
-   final_index_offset_file_name = final_index_file_name + '-offset'
-   primary_index_file = open(os.path.join(offline_index_storage, final_index_file_name), 'w+', encoding='utf-8')
-   primary_index_offset_file = open(os.path.join(offline_index_storage, final_index_offset_file_name), 'w+', encoding='utf-8')
+   block_token_count = 0
+   primary_index_file = None
    start_time = datetime.utcnow()
-   start_token = 0
-   prev_token = 0
+   block_start_token = None
+   prev_token = None
    present_offset = 0
-   start_flag = True
 
-   while(any(index_file_open_status)):
-      target_word = heapq.heappop(primary_heap)
-      total_unique_tokens +=1
-      if total_unique_tokens % primary_index_size == 0:
+   while len(primary_heap) > 0:
+      target_word = primary_heap[0][0]
+      #pops the entries of every block holding the token and moves those blocks ahead
+      target_records = []
+      while len(primary_heap) > 0 and primary_heap[0][0] == target_word:
+         _, i = primary_heap[0]
+         target_records.append(present_record[i])
+         present_record[i] = index_readers[i].next_record()
+         present_token = None if present_record[i] is None else decode_posting_term(present_record[i])
+         if present_token is None or (end_token is not None and present_token >= end_token):
+            index_readers[i].close()
+            heapq.heappop(primary_heap)
+         else:
+            heapq.heapreplace(primary_heap, (present_token, i))
+
+      if len(target_records) == 1 and tombstones is None:
+         #a token of a single block is already coded the way the primary index stores it
+         final_write_content = encode_varint(len(target_records[0])) + target_records[0]
+      else:
+         target_freq = 0
+         target_doc_ids = []
+         target_field_counts = []
+         for record in target_records:
+            _, total_frequency, doc_ids, field_counts, _ = decode_posting_list(record)
+            target_freq += total_frequency
+            target_doc_ids.append(doc_ids)
+            target_field_counts.append(field_counts)
+         #blocks of different workers interleave, so the merged postings are sorted on doc id again
+         doc_ids = np.concatenate(target_doc_ids)
+         field_counts = np.concatenate(target_field_counts)
+         if tombstones is not None:
+            live = ~np.isin(doc_ids, tombstones)
+            doc_ids = doc_ids[live]
+            field_counts = field_counts[live]
+            #the frequency of a posting is the sum of its field counts
+            target_freq = int(field_counts.sum())
+         doc_order = np.argsort(doc_ids, kind='stable')
+         final_write_content = None
+         if len(doc_ids) > 0:
+            final_write_content = encode_posting_list(target_word, target_freq, doc_ids[doc_order], field_counts[doc_order])
+
+      #a token left without postings is dropped
+      if final_write_content is not None:
+         if primary_index_file is None:
+            final_index_file_name = primary_index_file_name + '-' + str(primary_index_counter)
+            primary_index_file = open(os.path.join(offline_index_storage, final_index_file_name), 'wb', buffering=cfg['merge_write_buffer_size'])
+            start_time = datetime.utcnow()
+            block_start_token = target_word
+            present_offset = 0
+         primary_index_file.write(final_write_content)
+         #the search reads the record body straight from the offset in the dictionary
+         record_length, record_start = decode_varint(final_write_content, 0)
+         doc_count = decode_document_count(memoryview(final_write_content)[record_start:])
+         term_dictionary.add(target_word, range_id, primary_index_counter, present_offset + record_start, record_length, doc_count, bm25_idf(cfg['merge_document_count'], doc_count))
+         present_offset += len(final_write_content)
+         prev_token = target_word
+         total_unique_tokens += 1
+         block_token_count += 1
+
+      #closes the block once it is full, and the last block
+      if block_token_count == primary_index_size or (len(primary_heap) == 0 and primary_index_file is not None):
          time_elapsed = (datetime.utcnow() - start_time).total_seconds()
+         primary_index_file.flush()
+         os.fsync(primary_index_file.fileno())
          primary_index_file.close()
-         primary_index_offset_file.close()
-         present_offset = 0
-         primary_index_offset.append([final_index_file_name, start_token, prev_token])
+         primary_index_file = None
+         block_token_count = 0
+         primary_index_offset.append([final_index_file_name, block_start_token, prev_token])
          file_size = os.path.getsize(os.path.join(offline_index_storage, final_index_file_name))/float(1<<20)
          total_primary_index_size += file_size
          print(">> [primary index : %s] saved primary index block on disk with name : %s in %.2f seconds -- [%.2f MB]" % (primary_index_counter, final_index_file_name, time_elapsed, file_size))
          print("===="*32)
          primary_index_counter += 1
-         final_index_file_name = primary_index_file_name + '-' + str(primary_index_counter)
-         final_index_offset_file_name = final_index_file_name + '-offset'
-         primary_index_file = open(os.path.join(offline_index_storage, final_index_file_name), 'w+', encoding='utf-8')
-         primary_index_offset_file = open(os.path.join(offline_index_storage, final_index_offset_file_name), 'w+', encoding='utf-8')
-         start_time = datetime.utcnow()
-         start_flag = True
-      #only to mark the starting token of the index block
-      if start_flag:
-         start_token = target_word
-         start_flag = False
-      
-      target_freq = 0
-      target_content = []
-      for i in range(offline_index_counter):
-         if not index_file_open_status[i]:
-            continue
-         #it's a match
-         if present_token[i] == target_word:
-            target_freq+=present_freq[i]
-            target_content.append(present_content[i])
-            #now update the read pointer
-            temp_entry = index_file_pointer[i].readline().strip()
-            #close the empty file
-            if not temp_entry or len(temp_entry)==0:
-               # print(">> closing the file : %s after processing %s words" % ((index_file_name+'-'+str(i)), present_token_count[i]))
-               index_file_open_status[i] = False
-               index_file_pointer[i].close()
-               continue
-            temp_entry = temp_entry.split(' ', 2)
-            #close wrongly formatted file
-            if len(temp_entry) != 3:
-               print(">> wrongly formatted index entries for index file %s : %s. closing it" % ((index_file_name+'-'+str(i+1)), temp_entry))
-               index_file_open_status[i] = False
-               index_file_pointer[i].close()
-               continue 
-            #everything is fine, now update the head pointer values for each index files
-            present_token[i] = temp_entry[0].strip()
-            present_freq[i] = int(temp_entry[1].strip())
-            present_content[i] = temp_entry[2].strip()
-            present_token_count[i] += 1
-            if present_token[i] not in primary_heap:
-               heapq.heappush(primary_heap, present_token[i])
-      final_write_content = "%s %s %s\n" %(target_word, target_freq, ' '.join(target_content))      
-      primary_index_file.write(final_write_content)
-      primary_index_offset_file.write('%d\n'% present_offset)
-      present_offset += (len(final_write_content.strip().encode())+len(os.linesep))
-      prev_token = target_word
-   #closes the last block 
-   if total_unique_tokens % primary_index_size !=0:
-      time_elapsed = (datetime.utcnow() - start_time).total_seconds()
-      primary_index_file.close()
-      primary_index_offset_file.close()
-      file_size = os.path.getsize(os.path.join(offline_index_storage, final_index_file_name))/float(1<<20)
-      total_primary_index_size += file_size
-      print(">> [primary index : %s] saved primary index block on disk with name : %s in %.2f seconds -- [%.2f MB]" % (primary_index_counter, final_index_file_name, time_elapsed, file_size))
-      print("===="*32)
-      primary_index_offset.append([final_index_file_name, start_token, prev_token])
-      primary_index_counter += 1
-   
-   #populate the primary index offset
+         write_checkpoint(checkpoint_file, {'primary_index_offset': primary_index_offset, 'tokens': total_unique_tokens, 'size': total_primary_index_size, 'term_dictionary': term_dictionary.checkpoint()})
+
+   term_dictionary.close()
+   time_delta = (datetime.utcnow() - merge_start_time).total_seconds()
+   print("[INFO] merge range %d [%s, %s) : %d tokens in %.2f seconds" % (range_id, start_token, end_token, total_unique_tokens, time_delta))
+   result = [range_id, total_unique_tokens, primary_index_counter, total_primary_index_size, primary_index_offset]
+   if result_queue is not None:
+      result_queue.put(result)
+   return result
+
+def merge_all_index_files(cfg, delete_temp_files=False, resume=False):
+   #cfg['merge_input_files'] lists the sorted inputs, each a series of files read one after the other.
+   #with resume, the term ranges of an interrupted merge continue after their last completed block
+   secondary_index_blocks = cfg['secondary_index_blocks']
+   stats_file_name = cfg['primary_stats_file_name']
+   index_file_name = cfg['inverted_index_file']
+   offline_index_storage = cfg['offline_index_storage']
+   primary_index_file_name = cfg['primary_index_file_name']
+   primary_index_offset_name = cfg['primary_index_offset_name']
+
+   merge_checkpoint_file = os.path.join(offline_index_storage, cfg['checkpoint_name'] + '-merge')
+   merge_checkpoint = None
+   if resume:
+      merge_checkpoint = read_checkpoint(merge_checkpoint_file)
+   if merge_checkpoint is None:
+      merge_ranges = plan_merge_ranges(cfg, cfg['merge_processes'])
+      range_checkpoints = [None]*len(merge_ranges)
+   else:
+      merge_ranges = merge_checkpoint['merge_ranges']
+      range_checkpoints = [read_checkpoint(merge_checkpoint_file + '-' + str(range_id)) for range_id in range(len(merge_ranges))]
+   #the blocks of the checkpoints are kept
+   completed_files = set()
+   for checkpoint in range_checkpoints:
+      if checkpoint is not None:
+         for data in checkpoint['primary_index_offset']:
+            completed_files.add(data[0])
+   if len(completed_files) > 0:
+      print('[INFO] resuming the merge with %d completed primary index blocks' % len(completed_files))
+
+   #clean the primary index files and primary index offset
+   delete_files = []
+   for target_file_name in os.listdir(offline_index_storage):
+      if target_file_name in completed_files:
+         continue
+      if stats_file_name in target_file_name or primary_index_file_name in target_file_name or primary_index_offset_name in target_file_name:
+         delete_files.append(target_file_name)
+      elif merge_checkpoint is None and (target_file_name.startswith(cfg['checkpoint_name'] + '-merge') or target_file_name.startswith(cfg['term_dictionary_name'])):
+         delete_files.append(target_file_name)
+   #actually deletes the files
+   delete_temporary_index_files(offline_index_storage, delete_files, verbose=True)
+   write_checkpoint(merge_checkpoint_file, {'merge_ranges': merge_ranges})
+
+   total_secondary_index_size = 0
+   for input_files in cfg['merge_input_files']:
+      total_secondary_index_size += sum([os.path.getsize(input_file) for input_file in input_files])
+   delete_files = []
+   for block_id in secondary_index_blocks:
+      offline_index_file = index_file_name + '-' + str(block_id)
+      delete_files.append(offline_index_file)
+      delete_files.append(offline_index_file + '-sample')
+
+   #every term range is merged by its own process into its own prime_index_file-<range>-* files
+   print('[INFO] merging %d sorted inputs in %d term ranges' % (len(cfg['merge_input_files']), len(merge_ranges)))
+   if len(merge_ranges) == 1:
+      range_results = [merge_index_range(cfg, 0, None, None, checkpoint=range_checkpoints[0])]
+   else:
+      result_queue = multiprocessing.Queue()
+      process_handlers = []
+      for range_id, (start_token, end_token) in enumerate(merge_ranges):
+         prc = multiprocessing.Process(target=merge_index_range, args=(cfg, range_id, start_token, end_token, result_queue, range_checkpoints[range_id]))
+         process_handlers.append(prc)
+      for prc in process_handlers:
+         prc.start()
+      #the results are collected before joining, a process only exits once its result is consumed
+      range_results = []
+      while len(range_results) < len(process_handlers):
+         try:
+            range_results.append(result_queue.get(timeout=1))
+         except queue.Empty:
+            if not any([prc.is_alive() for prc in process_handlers]):
+               failed_ranges = [range_id for range_id, prc in enumerate(process_handlers) if prc.exitcode != 0]
+               raise RuntimeError('merge of the term ranges %s failed, resume the build to continue after their last completed block' % failed_ranges)
+      for prc in process_handlers:
+         prc.join()
+      range_results.sort(key=lambda result: result[0])
+
+   #the ranges are disjoint and ordered, so their offsets concatenate into the primary index offset
+   total_unique_tokens = 0
+   primary_index_counter = 0
+   total_primary_index_size = 0
    offset_file = os.path.join(offline_index_storage, primary_index_offset_name)
    with open(offset_file, 'w+', encoding='utf-8') as o_file:
-      for data in primary_index_offset:
-         o_file.write("%s %s %s\n" % (data[0], data[1], data[2]))
+      for _, range_tokens, range_index_counter, range_index_size, primary_index_offset in range_results:
+         total_unique_tokens += range_tokens
+         primary_index_counter += range_index_counter
+         total_primary_index_size += range_index_size
+         for data in primary_index_offset:
+            o_file.write("%s %s %s\n" % (data[0], data[1], data[2]))
    
+   term_dictionary_size, range_dictionary_files = concatenate_term_dictionaries(cfg, len(merge_ranges))
+   print('[INFO] term dictionary of %d terms written, %.2f MB' % (total_unique_tokens, term_dictionary_size/float(1<<20)))
+   #the range dictionaries are only needed by a resumed merge
+   delete_temporary_index_files(offline_index_storage, [cfg['checkpoint_name'] + '-merge'] + [cfg['checkpoint_name'] + '-merge-' + str(range_id) for range_id in range(len(merge_ranges))])
+   delete_temporary_index_files(offline_index_storage, range_dictionary_files)
    #finally delete the secondary index files
    if delete_temp_files:
       delete_temporary_index_files(offline_index_storage, delete_files, verbose=True)
 
-   return total_unique_tokens, primary_index_counter, total_primary_index_size              
+   return total_unique_tokens, primary_index_counter, total_primary_index_size, total_secondary_index_size/float(1<<20)
+
+def build_champion_index(cfg):
+   #champion tier of the primary index : every posting list of more than champion_list_size postings
+   #gets a champion list of its champion_list_size best postings by field weight over all the fields,
+   #in doc id order. the lists go to champion_index_file-0-0 and are found through the champion
+   #dictionary, whose document counts are the ones of the full lists
+   offline_index_storage = cfg['offline_index_storage']
+   champion_list_size = cfg['champion_list_size']
+   start_time = datetime.utcnow()
+   primary_files = segment_primary_files(offline_index_storage, ['.'], cfg)
+   champion_file_name = cfg['champion_index_file_name'] + '-0-0'
+   #the champions are the postings with the best bm25f term frequency
+   field_length_table = read_field_length_table(os.path.join(offline_index_storage, cfg['doc_field_lengths_name']))
+   if field_length_table is None:
+      field_length_table = [cfg['first_doc_id'], np.zeros((0, len(field_alias)), dtype=field_length_dtype), 0, np.zeros(len(field_alias), dtype=np.int64)]
+   average_lengths = average_field_lengths(field_length_table[2], field_length_table[3])
+   dictionary = TermDictionaryWriter(os.path.join(offline_index_storage, cfg['champion_dictionary_name']), cfg['term_dictionary_group_size'], cfg['merge_write_buffer_size'])
+   champion_count = 0
+   present_offset = 0
+   with open(os.path.join(offline_index_storage, champion_file_name), 'wb', buffering=cfg['merge_write_buffer_size']) as champion_file:
+      reader = IndexBlockReader(primary_files, cfg['merge_read_buffer_size']) if len(primary_files) > 0 else None
+      while reader is not None:
+         record = reader.next_record()
+         if record is None:
+            reader.close()
+            break
+         doc_count = decode_document_count(record)
+         if doc_count <= champion_list_size:
+            continue
+         term, _, doc_ids, field_counts, _ = decode_posting_list(record)
+         norms = field_length_norms(lookup_field_lengths(field_length_table, doc_ids), average_lengths)
+         champions = np.argpartition(-calculate_bm25f_weight(field_alias, field_counts, norms), champion_list_size - 1)[:champion_list_size]
+         champions.sort()
+         content = encode_posting_list(term, int(field_counts[champions].sum()), doc_ids[champions], field_counts[champions])
+         champion_file.write(content)
+         record_length, record_start = decode_varint(content, 0)
+         dictionary.add(term, 0, 0, present_offset + record_start, record_length, doc_count, bm25_idf(cfg['merge_document_count'], doc_count))
+         present_offset += len(content)
+         champion_count += 1
+   dictionary.close()
+   time_delta = (datetime.utcnow() - start_time).total_seconds()
+   print('[INFO] champion lists of %d terms written in %.2f seconds -- [%.2f MB]' % (champion_count, time_delta, present_offset/float(1<<20)))
+   return champion_count
 
 def delete_temporary_index_files(offline_index_storage, file_list, verbose=False):
    success = True
@@ -550,8 +1388,137 @@ def delete_temporary_index_files(offline_index_storage, file_list, verbose=False
    if len(file_list)>0 and success and verbose:
       print("[INFO] successfully deleted the local file : %s" % (file_list))
 
-def create_secondary_index(xml_dump_file, process_configuration, process_stats):
-   # create an XMLReader
+def open_dump_file(xml_dump_file):
+   #compressed dumps are decompressed on the fly, never written back to disk
+   if xml_dump_file.endswith('.bz2'):
+      return bz2.open(xml_dump_file, 'rb')
+   return open(xml_dump_file, 'rb')
+
+def extract_page_elements(content):
+   #returns (page_count, content) trimmed to the whole <page> elements it holds
+   start = content.find(b'<page>')
+   end = content.rfind(b'</page>')
+   if start < 0 or end < 0:
+      return 0, b''
+   content = content[start:end+len(b'</page>')]
+   return content.count(b'<page>'), content
+
+def read_dump_pages(xml_dump_file, chunk_size):
+   #yields (page_count, raw bytes of whole <page> elements) read sequentially from the dump
+   page_start_tag = b'<page>'
+   page_end_tag = b'</page>'
+   pending = b''
+   header_skipped = False
+   with open_dump_file(xml_dump_file) as dump_file:
+      while True:
+         chunk = dump_file.read(chunk_size)
+         if not chunk:
+            break
+         pending += chunk
+         if not header_skipped:
+            start = pending.find(page_start_tag)
+            if start < 0:
+               continue
+            #drop the <mediawiki> and <siteinfo> header
+            pending = pending[start:]
+            header_skipped = True
+         end = pending.rfind(page_end_tag)
+         if end < 0:
+            continue
+         end += len(page_end_tag)
+         pages = pending[:end]
+         pending = pending[end:]
+         yield pages.count(page_start_tag), pages
+
+def find_multistream_index(xml_dump_file):
+   #enwiki-*-pages-articles-multistream.xml.bz2 ships with enwiki-*-pages-articles-multistream-index.txt.bz2
+   if not xml_dump_file.endswith('.xml.bz2'):
+      return None
+   index_file = xml_dump_file[:-len('.xml.bz2')] + '-index.txt.bz2'
+   if os.path.isfile(index_file):
+      return index_file
+   return None
+
+def read_multistream_index(xml_dump_file, multistream_index_file, streams_per_batch):
+   #yields (page_count, (start, end)) byte ranges of consecutive bz2 streams holding whole pages.
+   #index lines look like <stream offset>:<page id>:<page title>
+   batch_start = -1
+   batch_streams = 0
+   batch_pages = 0
+   present_offset = -1
+   with bz2.open(multistream_index_file, 'rt', encoding='utf-8') as index_file:
+      for line in index_file:
+         stream_offset = int(line.split(':', 1)[0])
+         if stream_offset != present_offset:
+            if batch_streams == streams_per_batch:
+               yield batch_pages, (batch_start, stream_offset)
+               batch_start = -1
+               batch_streams = 0
+               batch_pages = 0
+            if batch_start < 0:
+               batch_start = stream_offset
+            present_offset = stream_offset
+            batch_streams += 1
+         batch_pages += 1
+   #the last batch runs till the end of file, the trailing </mediawiki> stream is trimmed by the worker
+   if batch_pages > 0:
+      yield batch_pages, (batch_start, os.path.getsize(xml_dump_file))
+
+def read_multistream_pages(dump_file, stream_range):
+   #decompresses the concatenated bz2 streams stored in the byte range of the dump
+   start, end = stream_range
+   dump_file.seek(start)
+   return extract_page_elements(bz2.decompress(dump_file.read(end - start)))[1]
+
+def put_task(task_queue, task, process_handlers=None):
+   #waits for room in the queue, gives up once no worker is left to take the task
+   while True:
+      try:
+         task_queue.put(task, timeout=1)
+         return True
+      except queue.Full:
+         if process_handlers is not None and not any([prc.is_alive() for prc in process_handlers]):
+            return False
+
+def dispatch_dump_pages(xml_dump_file, task_queue, cfg, multistream_index_file=None, process_handlers=None):
+   #the only reader of the dump, it hands out batches of pages to the worker processes.
+   #with a multistream index the reader only hands out stream ranges and the workers decompress them
+   start_time = datetime.utcnow()
+   next_doc_id = cfg['first_doc_id']
+   batch_count = 0
+   #batches already in the checkpoints of a resumed build are not handed out again
+   skip_doc_ranges = cfg['skip_doc_ranges']
+   skip_doc_starts = [doc_range[0] for doc_range in skip_doc_ranges]
+   skipped_pages = 0
+   if multistream_index_file is not None:
+      print('[INFO] decompressing the bz2 streams in parallel using index %s' % multistream_index_file)
+      batches = read_multistream_index(xml_dump_file, multistream_index_file, cfg['dispatch_streams_per_batch'])
+   else:
+      batches = read_dump_pages(xml_dump_file, cfg['dispatch_chunk_size'])
+   for page_count, pages in batches:
+      if page_count == 0:
+         continue
+      if len(skip_doc_ranges) > 0 and in_doc_ranges(skip_doc_ranges, skip_doc_starts, next_doc_id, next_doc_id + page_count - 1):
+         next_doc_id += page_count
+         skipped_pages += page_count
+         continue
+      if not put_task(task_queue, (next_doc_id, pages), process_handlers):
+         print('[ERROR] every worker process exited, the dispatch stopped at doc id %d' % next_doc_id)
+         break
+      next_doc_id += page_count
+      batch_count += 1
+   #one stop signal per worker
+   for _ in range(cfg['offset']):
+      if not put_task(task_queue, None, process_handlers):
+         break
+   time_delta = (datetime.utcnow() - start_time).total_seconds()
+   print('[INFO] dispatched %d pages in %d batches in %.2f seconds' % (next_doc_id - cfg['first_doc_id'] - skipped_pages, batch_count, time_delta))
+   if skipped_pages > 0:
+      print('[INFO] skipped %d pages indexed before the last checkpoints' % skipped_pages)
+   return next_doc_id - cfg['first_doc_id']
+
+def create_secondary_index(task_queue, process_configuration, process_stats):
+   # create an incremental XMLReader, the page batches are fed into one document
    parser = xml.sax.make_parser()
    # turn off namepsaces
    parser.setFeature(xml.sax.handler.feature_namespaces, 0)
@@ -559,34 +1526,57 @@ def create_secondary_index(xml_dump_file, process_configuration, process_stats):
    # override the default ContextHandler
    Handler = WikiPageHandler(process_configuration, process_stats)
    parser.setContentHandler(Handler)
-   parser.parse(xml_dump_file)
+   #only needed when the reader hands out bz2 stream ranges
+   dump_file = None
+   parser.feed(b'<pages>')
+   while True:
+      task = task_queue.get()
+      if task is None:
+         break
+      first_doc_id, pages = task
+      if isinstance(pages, tuple):
+         if dump_file is None:
+            dump_file = open(process_configuration['xml_dump_file'], 'rb')
+         pages = read_multistream_pages(dump_file, pages)
+      Handler.doc_id = first_doc_id
+      parser.feed(pages)
+   parser.feed(b'</pages>')
+   parser.close()
+   if dump_file is not None:
+      dump_file.close()
    #writing the last block
-   if len(process_stats['inverted_index']) > 0:
-      time_elapsed = (datetime.utcnow() - process_stats['index_start_time']).total_seconds()
-      process_stats['end_index'] += process_configuration['offset']
-      print(">process_id[%s] : [%s] processed the block with %d words in %.2f seconds" % (process_configuration['process_id'], process_stats['end_index'], len(process_stats['inverted_index']), time_elapsed))
-      store_partial_index_offline(process_configuration['process_id'], process_stats['inverted_index'], process_configuration['offline_index_storage'], process_configuration['inverted_index_file'], process_stats['end_index'])
-      store_partial_title_map_offline(process_configuration['process_id'], process_stats['end_index'], process_stats['doc_id_title_hash'], process_configuration['offline_index_storage'], process_configuration['doc_title_map'])
-      process_stats['inverted_index'] = {}
-      process_stats['doc_id_title_hash'] = {}
+   Handler.flush_block()
    
    #store the statistics
    total_index_bytes = 0
-   for file_index in range(process_stats['start_index'], process_stats['end_index']+process_configuration['offset'], process_configuration['offset']):
+   for file_index in process_stats['index_blocks']:
       file_name =  process_configuration['inverted_index_file']+'-'+str(file_index)
       file_size = os.path.getsize(os.path.join(process_configuration['offline_index_storage'], file_name))
       total_index_bytes += file_size
    stats_file_name = process_configuration['stats_file_name']+'-'+str(process_configuration['process_id'])
+   stem_hits, stem_misses, _ = process_configuration['stemmer'].cache_stats()
    with open(os.path.join(process_configuration['offline_index_storage'], stats_file_name), 'w+') as stats_file:
-      stats_file.write("%d %d %d\n" % (process_stats['start_index'], process_stats['end_index'], total_index_bytes))
+      stats_file.write("%d %d %d %d %d\n" % (process_stats['start_index'], process_stats['end_index'], total_index_bytes, stem_hits, stem_misses))
+      #one line per block : block id, pages, estimated index bytes, rss high-water mark
+      for block_memory in process_stats['block_memory']:
+         stats_file.write("%d %d %d %d\n" % tuple(block_memory))
 
 def get_configuration(offline_index_storage):
    config = {
       'offset':2,
       'debug_mode': False,
-      'offline_block_size': 10000,
+      #a block is written once the in-memory index of a worker reaches worker_memory_budget bytes,
+      #offline_block_size optionally caps the pages per block as well
+      'offline_block_size': None,
+      'worker_memory_budget': 512<<20,
+      'memory_check_interval': 100,
+      'block_sample_interval': 128,
+      'dispatch_chunk_size': 4<<20,
+      'dispatch_queue_size': 16,
+      'dispatch_streams_per_batch': 20,
       'inverted_index_file': 'inverted_index_file',
       'doc_title_map': 'doc_title_map',
+      'doc_field_lengths_name': 'doc_field_lengths',
       'offline_index_storage': offline_index_storage,
       'wiki_pattern_matching': {
          "information": "{{information",
@@ -601,13 +1591,54 @@ def get_configuration(offline_index_storage):
          "url": "http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\(\), ]|(?:%[0-9a-fA-F][0-9a-fA-F]))+",
          "www": "www\.(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\(\), ]|(?:%[0-9a-fA-F][0-9a-fA-F]))+"
       },
-      'stemmer' : PorterStemmer(), 
+      'stemmer' : CachedStemmer(PorterStemmer(), 1<<18), 
       'stop_words' : stopwords.words("english"),
+      #'nltk' (word_tokenize) or 'regex' (regex_tokenize)
+      'tokenizer' : 'nltk',
       'stats_file_name' : 'process-stats',
       'primary_index_file_name' : 'prime_index_file',
       'primary_index_offset_name' : 'primary_index_file_offset',
       'primary_index_size': 100000,
+      #the term_dictionary front codes groups of term_dictionary_group_size terms
+      'term_dictionary_name': 'term_dictionary',
+      'term_dictionary_group_size': 16,
+      #champion tier : the champion_list_size best postings of every longer posting list, searched
+      #instead of the full lists by the approximate top-k of the search
+      'champion_list_size': 256,
+      'champion_index_file_name': 'champion_index_file',
+      'champion_dictionary_name': 'champion_dictionary',
+      #merge : per block read buffer and write buffer of the prime_index_file-* files
+      'merge_processes': multiprocessing.cpu_count(),
+      'merge_read_buffer_size': 256<<10,
+      'merge_write_buffer_size': 16<<20,
       'primary_stats_file_name': 'merge_stats',
+      'first_doc_id': 1,
+      #checkpoints : the build, every worker and every merge range keep a checkpoint-* file, resumed builds
+      #skip the pages of skip_doc_ranges
+      'checkpoint_name': 'checkpoint',
+      'build_run': 0,
+      'worker_checkpoint': None,
+      'skip_doc_ranges': [],
+      #segments : delta dumps are indexed as segment-* folders of the index, listed oldest first in the
+      #segment list. older versions of their pages are tombstoned, and runs of segment_merge_factor
+      #segments of the same size tier are merged, as are the newest ones past max_segments
+      'segment_name': 'segment',
+      'segment_list_name': 'segments',
+      'tombstone_file_name': 'tombstones',
+      'segment_merge_factor': 4,
+      'segment_tier_floor': 1<<20,
+      'max_segments': 10,
+      #merged segments stay on disk for segment_retire_seconds, listed in the retired segment list
+      'retired_segment_list_name': 'retired_segments',
+      'segment_retire_seconds': 600,
+      #lock files, one guards the segment list, tombstones and retired segments, the other serializes merges
+      'segment_lock_name': 'segments.lock',
+      'segment_merge_lock_name': 'segments.merge.lock',
+      #search : largest k a search server request may ask for
+      'max_result_count': 1000,
+      #search : memory budget of the decoded posting list cache and of the query result cache
+      'posting_cache_bytes': 256<<20,
+      'result_cache_bytes': 16<<20,
    }
    return config
 
@@ -626,85 +1657,203 @@ def clean_index_directory(offline_index_storage):
       except Exception as e:
          print("unable to delete path %s. error : %s" % (the_file, str(e)))
 
-def build_secondary_index(xml_dump_file, offline_index_storage, empty_dir=True):
+def build_secondary_index(xml_dump_file, offline_index_storage, empty_dir=True, multistream_index_file=None, first_doc_id=1, resume=False):
+   #returns True once every worker completed, an interrupted build can be continued with resume
    index_start_time = datetime.utcnow()
    cfg = get_configuration(offline_index_storage)
-   display_cfg_fields = ['offset', 'debug_mode', 'offline_block_size', 'inverted_index_file', 'doc_title_map', 'offline_index_storage', 'stats_file_name']
+   cfg['first_doc_id'] = first_doc_id
+   if multistream_index_file is None:
+      multistream_index_file = find_multistream_index(xml_dump_file)
+   display_cfg_fields = ['offset', 'debug_mode', 'offline_block_size', 'worker_memory_budget', 'dispatch_chunk_size', 'tokenizer', 'inverted_index_file', 'doc_title_map', 'offline_index_storage', 'stats_file_name', 'build_run']
    print("[INFO] creating inverted index using %s , please wait..." % xml_dump_file)
-   if empty_dir:
-      print("[INIT] cleaning the index directory.")
-      clean_index_directory(offline_index_storage)
-      print("[INFO] directory cleaned")
-   #clean the primary index files and primary index offset
-   delete_files = []
-   for target_file_name in os.listdir(offline_index_storage):
-      if cfg['inverted_index_file'] in target_file_name or cfg['doc_title_map'] in target_file_name or cfg['stats_file_name'] in target_file_name:
-         delete_files.append(target_file_name)
-   #actually deletes the files
-   delete_temporary_index_files(offline_index_storage, delete_files, verbose=True)
+   build_checkpoint = None
+   worker_checkpoints = {}
+   if resume:
+      build_checkpoint, worker_checkpoints = restore_build_checkpoint(cfg)
+      if build_checkpoint is None:
+         print("[INFO] no checkpoint found in %s, starting a new build" % offline_index_storage)
+      elif build_checkpoint['secondary_index_done']:
+         print("[INFO] secondary index already complete")
+         return True
+   if build_checkpoint is None:
+      if empty_dir:
+         print("[INIT] cleaning the index directory.")
+         clean_index_directory(offline_index_storage)
+         print("[INFO] directory cleaned")
+      #clean the primary index files and primary index offset
+      delete_files = []
+      for target_file_name in os.listdir(offline_index_storage):
+         if cfg['inverted_index_file'] in target_file_name or cfg['doc_title_map'] in target_file_name or cfg['stats_file_name'] in target_file_name or cfg['checkpoint_name'] in target_file_name or cfg['doc_field_lengths_name'] in target_file_name:
+            delete_files.append(target_file_name)
+      #actually deletes the files
+      delete_temporary_index_files(offline_index_storage, delete_files, verbose=True)
+   build_checkpoint_file = os.path.join(offline_index_storage, cfg['checkpoint_name'])
+   build_checkpoint = {'offset': cfg['offset'], 'first_doc_id': cfg['first_doc_id'], 'build_run': cfg['build_run'], 'secondary_index_done': False}
+   write_checkpoint(build_checkpoint_file, build_checkpoint)
    
    print("[CONFIG] secondary index creation running with configuration :")
    display_config(cfg, display_cfg_fields)
    print('\n[CRTICAL] spawning %d processes for secondary index creation.' % (cfg['offset']))
+   #bounded so the reader never runs too far ahead of the workers
+   task_queue = multiprocessing.Queue(cfg['dispatch_queue_size'])
    process_handlers = []
    for process_id in range(1, cfg['offset']+1):
-      cfg = get_configuration(offline_index_storage)
-      cfg['process_id'] = process_id
-      prc = multiprocessing.Process(target=create_secondary_index, args=(xml_dump_file, cfg, {}))
+      process_cfg = get_configuration(offline_index_storage)
+      process_cfg['process_id'] = process_id
+      process_cfg['xml_dump_file'] = xml_dump_file
+      process_cfg['offset'] = cfg['offset']
+      process_cfg['build_run'] = cfg['build_run']
+      process_cfg['skip_doc_ranges'] = cfg['skip_doc_ranges']
+      process_cfg['worker_checkpoint'] = worker_checkpoints.get(process_id, None)
+      prc = multiprocessing.Process(target=create_secondary_index, args=(task_queue, process_cfg, {}))
       process_handlers.append(prc)
    #execute the process
    for prc in process_handlers:
       prc.start()
+   #read the dump once and feed the workers
+   dispatch_dump_pages(xml_dump_file, task_queue, cfg, multistream_index_file=multistream_index_file, process_handlers=process_handlers)
    #wait for the process to complete
    for prc in process_handlers:
       prc.join()
+   failed_processes = [process_id for process_id, prc in enumerate(process_handlers, 1) if prc.exitcode != 0]
+   if len(failed_processes) > 0:
+      #pages left in the queue are dropped, they are dispatched again on resume
+      task_queue.cancel_join_thread()
+      print('[ERROR] worker processes %s failed, the pages after their last checkpoint are missing. resume the build to index them' % failed_processes)
+      return False
+   build_checkpoint['secondary_index_done'] = True
+   write_checkpoint(build_checkpoint_file, build_checkpoint)
    index_time_delta = (datetime.utcnow() - index_start_time).total_seconds()
    print('[INFO] secondary index creation done in %f seconds' % index_time_delta)
+   return True
+
+def read_checkpoint(checkpoint_file):
+   #the last checkpoint written to checkpoint_file, None without one
+   if not os.path.isfile(checkpoint_file):
+      return None
+   with open(checkpoint_file, 'r', encoding='utf-8') as txt_file:
+      return json.loads(txt_file.read())
 
-def extract_secondary_index_counter(cfg):
-   start_index = (1<<32) - 1
-   end_index = -(1<<32)
+def write_checkpoint(checkpoint_file, checkpoint):
+   write_index_file(checkpoint_file, [json.dumps(checkpoint)])
+
+def merge_doc_ranges(doc_ranges):
+   #sorted [first doc id, last doc id] ranges, adjacent and overlapping ranges joined
+   merged_ranges = []
+   for first_doc_id, last_doc_id in sorted(doc_ranges):
+      if len(merged_ranges) > 0 and first_doc_id <= merged_ranges[-1][1] + 1:
+         merged_ranges[-1][1] = max(merged_ranges[-1][1], last_doc_id)
+      else:
+         merged_ranges.append([first_doc_id, last_doc_id])
+   return merged_ranges
+
+def in_doc_ranges(doc_ranges, range_starts, first_doc_id, last_doc_id):
+   #whether first_doc_id to last_doc_id lies within one of the merged doc_ranges
+   index = bisect.bisect_right(range_starts, first_doc_id) - 1
+   return index >= 0 and doc_ranges[index][1] >= last_doc_id
+
+def restore_build_checkpoint(cfg):
+   #restores the configuration of an interrupted build and drops the blocks and titles its workers wrote
+   #after their last checkpoint. returns the build checkpoint and the worker checkpoints
+   offline_index_storage = cfg['offline_index_storage']
+   build_checkpoint = read_checkpoint(os.path.join(offline_index_storage, cfg['checkpoint_name']))
+   if build_checkpoint is None:
+      return None, {}
+   cfg['offset'] = build_checkpoint['offset']
+   cfg['first_doc_id'] = build_checkpoint['first_doc_id']
+   cfg['build_run'] = build_checkpoint['build_run'] + 1
+   worker_checkpoints = {}
+   block_ids = set()
+   title_map_sizes = {}
+   doc_ranges = []
    for process_id in range(1, cfg['offset']+1):
-      file_name = cfg['stats_file_name']+'-'+str(process_id)
-      file_path = os.path.join(cfg['offline_index_storage'], file_name)
-      with open(file_path, 'r') as txt_file:
-         temp_entry = txt_file.readline().strip()
-         data = temp_entry.split()
-         start_index = min(start_index, int(data[0]))
-         end_index = max(end_index, int(data[1]))
+      checkpoint = read_checkpoint(os.path.join(offline_index_storage, cfg['checkpoint_name']+'-'+str(process_id)))
+      worker_checkpoints[process_id] = checkpoint
+      if checkpoint is None:
+         continue
+      block_ids.update([block[0] for block in checkpoint['blocks']])
+      for title_map in checkpoint['title_maps']:
+         title_map_sizes[title_map[0]] = title_map[1:]
+      doc_ranges.extend(checkpoint['doc_ranges'])
+   if build_checkpoint['secondary_index_done']:
+      return build_checkpoint, worker_checkpoints
+   delete_files = []
+   for block_id in list_numbered_files(offline_index_storage, cfg['inverted_index_file']):
+      if block_id not in block_ids:
+         delete_files.append(cfg['inverted_index_file']+'-'+str(block_id))
+         delete_files.append(cfg['inverted_index_file']+'-'+str(block_id)+'-sample')
+   for title_map_id in list_numbered_files(offline_index_storage, cfg['doc_title_map']):
+      title_map_file = cfg['doc_title_map']+'-'+str(title_map_id)
+      if title_map_id not in title_map_sizes:
+         delete_files.append(title_map_file)
+         continue
+      #titles appended after the last checkpoint belong to pages that are indexed again
+      with open(os.path.join(offline_index_storage, title_map_file), 'r+b') as title_file:
+         title_file.truncate(title_map_sizes[title_map_id][0])
+   for title_map_id in list_numbered_files(offline_index_storage, cfg['doc_field_lengths_name']):
+      field_lengths_file = cfg['doc_field_lengths_name']+'-'+str(title_map_id)
+      if title_map_id not in title_map_sizes:
+         delete_files.append(field_lengths_file)
+         continue
+      with open(os.path.join(offline_index_storage, field_lengths_file), 'r+b') as field_file:
+         field_file.truncate(title_map_sizes[title_map_id][1])
+   delete_temporary_index_files(offline_index_storage, delete_files, verbose=True)
+   cfg['skip_doc_ranges'] = merge_doc_ranges(doc_ranges)
+   indexed_pages = sum([last_doc_id - first_doc_id + 1 for first_doc_id, last_doc_id in cfg['skip_doc_ranges']])
+   print("[INFO] resuming run %d of the build, %d pages in %d blocks are already indexed" % (cfg['build_run'], indexed_pages, len(block_ids)))
+   return build_checkpoint, worker_checkpoints
 
-   if start_index == ((1<<32) - 1) and end_index == -(1<<32):
-      return 0
-   return start_index, end_index
+def list_secondary_index_blocks(cfg):
+   #block ids of the inverted_index_file-* blocks written by the workers
+   return list_numbered_files(cfg['offline_index_storage'], cfg['inverted_index_file'])
 
-def build_primary_index(offline_index_storage, purge_secondary_index):
+def list_numbered_files(offline_index_storage, file_name):
+   #sorted ids of the <file_name>-<id> files of the folder
+   file_ids = []
+   prefix = file_name + '-'
+   for target_file_name in os.listdir(offline_index_storage):
+      if target_file_name.startswith(prefix) and target_file_name[len(prefix):].isdigit():
+         file_ids.append(int(target_file_name[len(prefix):]))
+   return sorted(file_ids)
+
+def build_primary_index(offline_index_storage, purge_secondary_index, resume=False):
    cfg = get_configuration(offline_index_storage)
-   low, high = extract_secondary_index_counter(cfg)
-   cfg['offline_index_counter'] = high - low + 1
-   allowed_fields = ['primary_index_file_name', 'primary_index_offset_name', 'offline_index_counter', 'primary_index_size', 'debug_mode', 'offline_index_storage']
+   cfg['secondary_index_blocks'] = list_secondary_index_blocks(cfg)
+   cfg['offline_index_counter'] = len(cfg['secondary_index_blocks'])
+   cfg['merge_input_files'] = [[os.path.join(offline_index_storage, cfg['inverted_index_file'] + '-' + str(block_id))] for block_id in cfg['secondary_index_blocks']]
+   cfg['merge_input_dictionaries'] = None
+   cfg['merge_tombstones'] = None
+   allowed_fields = ['primary_index_file_name', 'primary_index_offset_name', 'offline_index_counter', 'primary_index_size', 'merge_processes', 'merge_read_buffer_size', 'merge_write_buffer_size', 'debug_mode', 'offline_index_storage']
    print("[CONFIG] primary index creation running with configuration :")
    display_config(cfg, allowed_fields)
    start_time = datetime.utcnow()
-   #merge the title maps
+   #merge the title maps and the field lengths, the idf of the terms depends on the page count
    total_pages = merge_title_map_files(cfg)
+   merge_field_length_files(cfg)
+   cfg['merge_document_count'] = total_pages
    #merge the secondary indexes
-   total_unique_tokens, primary_index_counter, total_primary_index_size = merge_all_index_files(cfg, delete_temp_files=purge_secondary_index)
+   merge_start_time = datetime.utcnow()
+   total_unique_tokens, primary_index_counter, total_primary_index_size, total_secondary_index_size = merge_all_index_files(cfg, delete_temp_files=purge_secondary_index, resume=resume)
+   merge_time = (datetime.utcnow() - merge_start_time).total_seconds()
+   print('[INFO] merged %.2f MB of temporary index blocks in %.2f seconds -- [%.2f MB/s, %.0f tokens/s]' % (total_secondary_index_size, merge_time, total_secondary_index_size/max(merge_time, 1e-6), total_unique_tokens/max(merge_time, 1e-6)))
+   build_champion_index(cfg)
    #finally write to stats file
    stats_file_path = os.path.join(offline_index_storage, cfg['primary_stats_file_name'])
-   print
    with open(stats_file_path, 'w', encoding='utf-8') as txt_file:
-      txt_file.write("%s %s %s %s\n" % (total_pages, total_unique_tokens, primary_index_counter, total_primary_index_size))
+      txt_file.write("%s %s %s %s %s %s %s %s\n" % (total_pages, total_unique_tokens, primary_index_counter, total_primary_index_size, cfg['tokenizer'], merge_time, total_secondary_index_size, new_build_id()))
+   #the index is complete, a new build starts over
+   delete_files = [cfg['checkpoint_name']] + [cfg['checkpoint_name']+'-'+str(process_id) for process_id in list_numbered_files(offline_index_storage, cfg['checkpoint_name'])]
+   delete_temporary_index_files(offline_index_storage, delete_files)
    time_delta = (datetime.utcnow() - start_time).total_seconds()
    print('[INFO] primary index creation done in %.2f seconds' % (time_delta))
 
 def display_stats(offline_index_storage, start_time):
    cfg = get_configuration(offline_index_storage)
-   temp_start, temp_end = extract_secondary_index_counter(cfg)
    secondary_index_size = 0.0    #in MB
    primary_index_size = 0.0      #in MB
    title_map_size = 0.0          #in MB
    primary_index_file_count = 0
-   secondary_index_file_count = temp_end - temp_start + 1
+   secondary_index_file_count = len(list_secondary_index_blocks(cfg))
    total_page_count = 0
    total_unique_word_count = 0
    time_delta = (datetime.utcnow() - start_time).total_seconds()
@@ -717,20 +1866,40 @@ def display_stats(offline_index_storage, start_time):
       total_unique_word_count = int(data[1])
       primary_index_file_count = int(data[2])
       primary_index_size = float(data[3])
+      merge_time = None
+      if len(data) >= 7:
+         merge_time = float(data[5])
+         merge_input_size = float(data[6])
    
    #read stats for secondary index
+   stem_hits = 0
+   stem_misses = 0
+   block_index_peak = 0
+   block_rss_peak = 0
    for i in range(1, cfg['offset']+1):
       file_name = cfg['stats_file_name']+'-'+str(i)
       with open(os.path.join(cfg['offline_index_storage'], file_name)) as txt_file:
          temp_entry = txt_file.readline().strip()
          data = temp_entry.split()
          secondary_index_size += int(data[2])/float(1<<20)
+         if len(data) >= 5:
+            stem_hits += int(data[3])
+            stem_misses += int(data[4])
+         for line in txt_file:
+            data = line.split()
+            block_index_peak = max(block_index_peak, int(data[2]))
+            block_rss_peak = max(block_rss_peak, int(data[3]))
 
    #read stats for title map file
    title_file_size = os.path.getsize(os.path.join(cfg['offline_index_storage'], cfg['doc_title_map']))/float(1<<20)
 
    print("[INFO] temporary index file count : %s, primary index file count : %s" % (secondary_index_file_count, primary_index_file_count))
    print("[INFO] created inverted index with %s words in %s documents in %.2f seconds" % (total_unique_word_count, total_page_count, time_delta))
+   print("[INFO] block memory high-water mark : %.2f MB estimated index, %.2f MB worker rss" % (block_index_peak/float(1<<20), block_rss_peak/float(1<<20)))
+   if merge_time is not None:
+      print("[INFO] merge throughput : %.2f MB/s, %.0f tokens/s (%.2f MB in %.2f seconds)" % (merge_input_size/max(merge_time, 1e-6), total_unique_word_count/max(merge_time, 1e-6), merge_input_size, merge_time))
+   if stem_hits + stem_misses > 0:
+      print("[INFO] stemmer cache hit rate : %.2f%% (%d hits, %d misses)" % (100.0*stem_hits/(stem_hits+stem_misses), stem_hits, stem_misses))
    
    if secondary_index_size < (1<<10):
       print("[INFO] total temporary index file size : %.2f MB" % secondary_index_size)
@@ -747,23 +1916,347 @@ def display_stats(offline_index_storage, start_time):
    else:
       print("[INFO] total primary index file size : %.2f GB" % (primary_index_size/float(1<<10)))
 
+def read_segment_list(index_folder, cfg):
+   #[segment folder, first doc id, last doc id] of the segments of an index, oldest first. an index
+   #without a segment list is a single segment, the index folder itself
+   segment_list_file = os.path.join(index_folder, cfg['segment_list_name'])
+   segments = []
+   if os.path.isfile(segment_list_file):
+      with open(segment_list_file, 'r', encoding='utf-8') as txt_file:
+         for line in txt_file:
+            data = line.split()
+            if len(data) == 3:
+               segments.append([data[0], int(data[1]), int(data[2])])
+      return segments
+   return [['.', 1, read_merge_stats(index_folder, cfg)[0]]]
+
+def read_merge_stats(offline_index_storage, cfg):
+   #(pages, tokens, tokenizer, build id) of a merged index, the build id is None for older indexes
+   stats_file_path = os.path.join(offline_index_storage, cfg['primary_stats_file_name'])
+   if not os.path.isfile(stats_file_path):
+      return 0, 0, cfg['tokenizer'], None
+   with open(stats_file_path, 'r', encoding='utf-8') as txt_file:
+      data = txt_file.readline().split()
+   return int(data[0]), int(data[1]), data[4] if len(data) >= 5 else cfg['tokenizer'], data[7] if len(data) >= 8 else None
+
+def new_build_id():
+   #tells the builds of an index apart, a search drops its cached results when it changes
+   return os.urandom(8).hex()
+
+def write_index_file(file_path, lines):
+   #searches running on the index either read the old or the new file, never a partial one
+   temp_file_path = file_path + '.tmp'
+   with open(temp_file_path, 'w', encoding='utf-8') as txt_file:
+      for line in lines:
+         txt_file.write(line + '\n')
+      txt_file.flush()
+      os.fsync(txt_file.fileno())
+   os.replace(temp_file_path, file_path)
+
+def read_tombstones(index_folder, cfg):
+   #sorted doc ids of the deleted and replaced pages
+   tombstone_file = os.path.join(index_folder, cfg['tombstone_file_name'])
+   if not os.path.isfile(tombstone_file):
+      return np.zeros(0, dtype=np.int64)
+   with open(tombstone_file, 'r', encoding='utf-8') as txt_file:
+      doc_ids = [int(line) for line in txt_file if len(line.strip()) > 0]
+   return np.unique(np.array(doc_ids, dtype=np.int64))
+
+def write_tombstones(index_folder, doc_ids, cfg):
+   write_index_file(os.path.join(index_folder, cfg['tombstone_file_name']), ['%d' % doc_id for doc_id in sorted(doc_ids)])
+
+def segment_folder_path(index_folder, segment):
+   return os.path.join(index_folder, segment[0])
+
+def segment_primary_files(index_folder, segment, cfg):
+   #the prime_index_file-* files of a segment, in term order
+   segment_folder = segment_folder_path(index_folder, segment)
+   offset_file = os.path.join(segment_folder, cfg['primary_index_offset_name'])
+   if not os.path.isfile(offset_file):
+      return []
+   with open(offset_file, 'r', encoding='utf-8') as txt_file:
+      return [os.path.join(segment_folder, line.split()[0]) for line in txt_file if len(line.strip()) > 0]
+
+def segment_index_size(index_folder, segment, cfg):
+   return sum([os.path.getsize(file_path) for file_path in segment_primary_files(index_folder, segment, cfg)])
+
+def find_superseded_documents(index_folder, segments, titles, cfg):
+   #doc ids of the pages of the given segments whose title is in titles
+   doc_ids = []
+   for segment in segments:
+      title_map_file = os.path.join(segment_folder_path(index_folder, segment), cfg['doc_title_map'])
+      if not os.path.isfile(title_map_file):
+         continue
+      for doc_id, entry in read_title_map_entries(title_map_file):
+         data = entry.split(' ', 1)
+         if len(data) == 2 and data[1] in titles:
+            doc_ids.append(doc_id)
+   return doc_ids
+
+def select_segment_merge(segment_sizes, merge_factor, max_segments, tier_floor):
+   #tiered merge policy over the segment sizes, oldest first. a segment belongs to the tier of the power of
+   #merge_factor its size falls in, merge_factor adjacent segments of one tier are folded into a segment of
+   #the next tier. returns the [start, end) run of segments to merge or None
+   tiers = [int(math.log(max(size, tier_floor)/float(tier_floor), merge_factor)) for size in segment_sizes]
+   end = len(tiers)
+   while end > 0:
+      start = end - 1
+      while start > 0 and tiers[start-1] == tiers[end-1]:
+         start -= 1
+      if end - start >= merge_factor:
+         return [end - merge_factor, end]
+      end = start
+   if len(segment_sizes) > max_segments:
+      return [len(segment_sizes) - merge_factor, len(segment_sizes)]
+   return None
+
+def next_segment_name(index_folder, segments, cfg):
+   #the folders of the segments being merged are not listed yet and the retired ones not anymore,
+   #so the names on disk are never handed out again either
+   segment_names = [name for name, _, _ in segments] + os.listdir(index_folder)
+   segment_ids = [int(name.rsplit('-', 1)[1]) for name in segment_names if name.startswith(cfg['segment_name'] + '-') and name.rsplit('-', 1)[1].isdigit()]
+   return cfg['segment_name'] + '-' + str(max(segment_ids + [0]) + 1)
+
+@contextmanager
+def index_file_lock(index_folder, lock_file_name):
+   #exclusive lock between the processes updating an index, released when the block is left
+   with open(os.path.join(index_folder, lock_file_name), 'a') as lock_file:
+      fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+      try:
+         yield
+      finally:
+         fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+def add_index_segment(xml_dump_file, index_folder, multistream_index_file=None, deleted_titles_file=None):
+   #indexes a delta dump as a new segment of the index. the older versions of its pages, and the
+   #pages listed in deleted_titles_file, are tombstoned. returns the background merge process or None
+   cfg = get_configuration(index_folder)
+   #the segment list can't change while the segment is built, a merge finishing meanwhile waits for it
+   with index_file_lock(index_folder, cfg['segment_lock_name']):
+      segments = read_segment_list(index_folder, cfg)
+      first_doc_id = max([segment[2] for segment in segments] + [0]) + 1
+      segment_name = next_segment_name(index_folder, segments, cfg)
+      segment_folder = os.path.join(index_folder, segment_name)
+      print("[INFO] indexing %s as %s of %s, doc ids from %d" % (xml_dump_file, segment_name, index_folder, first_doc_id))
+      os.makedirs(segment_folder, exist_ok=True)
+      if not build_secondary_index(xml_dump_file, segment_folder, empty_dir=True, multistream_index_file=multistream_index_file, first_doc_id=first_doc_id):
+         return None
+      build_primary_index(segment_folder, purge_secondary_index=True)
+      total_pages = read_merge_stats(segment_folder, cfg)[0]
+      new_segment = [segment_name, first_doc_id, first_doc_id + total_pages - 1]
+
+      titles = set()
+      for _, entry in read_title_map_entries(os.path.join(segment_folder, cfg['doc_title_map'])):
+         data = entry.split(' ', 1)
+         if len(data) == 2:
+            titles.add(data[1])
+      if deleted_titles_file is not None:
+         with open(deleted_titles_file, 'r', encoding='utf-8') as txt_file:
+            titles.update([line.strip() for line in txt_file if len(line.strip()) > 0])
+      superseded = find_superseded_documents(index_folder, segments, titles, cfg)
+
+      #the segment is listed before its tombstones are, so a search never misses both versions of a page
+      write_segment_list(index_folder, segments + [new_segment], cfg)
+      tombstones = set(read_tombstones(index_folder, cfg).tolist())
+      tombstones.update(superseded)
+      write_tombstones(index_folder, tombstones, cfg)
+      print("[INFO] added %s with %d pages, %d older pages tombstoned" % (segment_name, total_pages, len(superseded)))
+
+      segment_sizes = [segment_index_size(index_folder, segment, cfg) for segment in segments + [new_segment]]
+   if select_segment_merge(segment_sizes, cfg['segment_merge_factor'], cfg['max_segments'], cfg['segment_tier_floor']) is None:
+      return None
+   #searches keep running on the current segments while they are merged
+   merge_process = multiprocessing.Process(target=merge_index_segments, args=(index_folder,))
+   merge_process.start()
+   return merge_process
+
+def write_segment_list(index_folder, segments, cfg):
+   write_index_file(os.path.join(index_folder, cfg['segment_list_name']), ['%s %d %d' % (name, first_doc_id, last_doc_id) for name, first_doc_id, last_doc_id in segments])
+
+def merge_index_segments(index_folder):
+   #tiered merge, folds runs of segments together until the merge policy is met. one merge runs at a
+   #time, a merge started meanwhile waits and then merges whatever is left
+   cfg = get_configuration(index_folder)
+   with index_file_lock(index_folder, cfg['segment_merge_lock_name']):
+      with index_file_lock(index_folder, cfg['segment_lock_name']):
+         delete_retired_segments(index_folder, cfg)
+      while True:
+         segments = read_segment_list(index_folder, cfg)
+         segment_sizes = [segment_index_size(index_folder, segment, cfg) for segment in segments]
+         merge_run = select_segment_merge(segment_sizes, cfg['segment_merge_factor'], cfg['max_segments'], cfg['segment_tier_floor'])
+         if merge_run is None:
+            break
+         merge_segment_run(index_folder, segments[merge_run[0]:merge_run[1]], cfg)
+
+def merge_segment_run(index_folder, merged_segments, cfg):
+   #merges adjacent segments into a new one, the postings and titles of their tombstoned pages are dropped
+   start_time = datetime.utcnow()
+   with index_file_lock(index_folder, cfg['segment_lock_name']):
+      segments = read_segment_list(index_folder, cfg)
+      segment_name = next_segment_name(index_folder, segments, cfg)
+      segment_folder = os.path.join(index_folder, segment_name)
+      os.makedirs(segment_folder, exist_ok=True)
+   first_doc_id = merged_segments[0][1]
+   last_doc_id = merged_segments[-1][2]
+   tombstones = read_tombstones(index_folder, cfg)
+   dropped = tombstones[(tombstones >= first_doc_id) & (tombstones <= last_doc_id)]
+   print("[INFO] merging segments %s into %s, dropping %d tombstoned pages" % (' '.join([segment[0] for segment in merged_segments]), segment_name, len(dropped)))
+
+   merge_cfg = get_configuration(segment_folder)
+   merge_cfg['secondary_index_blocks'] = []
+   merged_inputs = [[segment_primary_files(index_folder, segment, cfg), os.path.join(segment_folder_path(index_folder, segment), cfg['term_dictionary_name'])] for segment in merged_segments]
+   merged_inputs = [merged_input for merged_input in merged_inputs if len(merged_input[0]) > 0]
+   merge_cfg['merge_input_files'] = [input_files for input_files, _ in merged_inputs]
+   merge_cfg['merge_input_dictionaries'] = [dictionary_file for _, dictionary_file in merged_inputs]
+   merge_cfg['merge_tombstones'] = dropped if len(dropped) > 0 else None
+   title_map_files = [os.path.join(segment_folder_path(index_folder, segment), cfg['doc_title_map']) for segment in merged_segments]
+   total_pages = merge_title_map_files(merge_cfg, title_map_files=title_map_files, deleted_doc_ids=set(dropped.tolist()))
+   merge_field_length_files(merge_cfg, field_length_files=[os.path.join(segment_folder_path(index_folder, segment), cfg['doc_field_lengths_name']) for segment in merged_segments], deleted_doc_ids=dropped)
+   merge_cfg['merge_document_count'] = total_pages
+   merge_start_time = datetime.utcnow()
+   total_unique_tokens, primary_index_counter, total_primary_index_size, total_input_size = merge_all_index_files(merge_cfg)
+   merge_time = (datetime.utcnow() - merge_start_time).total_seconds()
+   build_champion_index(merge_cfg)
+   tokenizer_name = read_merge_stats(segment_folder_path(index_folder, merged_segments[0]), cfg)[2]
+   with open(os.path.join(segment_folder, cfg['primary_stats_file_name']), 'w', encoding='utf-8') as txt_file:
+      txt_file.write("%s %s %s %s %s %s %s %s\n" % (total_pages, total_unique_tokens, primary_index_counter, total_primary_index_size, tokenizer_name, merge_time, total_input_size, new_build_id()))
+
+   #segments added meanwhile are kept, the dropped pages leave the tombstones
+   merged_names = [segment[0] for segment in merged_segments]
+   with index_file_lock(index_folder, cfg['segment_lock_name']):
+      segments = read_segment_list(index_folder, cfg)
+      merged_position = [segment[0] for segment in segments].index(merged_names[0])
+      segments = [segment for segment in segments if segment[0] not in merged_names]
+      segments.insert(merged_position, [segment_name, first_doc_id, last_doc_id])
+      write_segment_list(index_folder, segments, cfg)
+      tombstones = set(read_tombstones(index_folder, cfg).tolist()).difference(dropped.tolist())
+      write_tombstones(index_folder, tombstones, cfg)
+      retire_segments(index_folder, merged_segments, cfg)
+   time_delta = (datetime.utcnow() - start_time).total_seconds()
+   print("[INFO] merged %d segments into %s with %d pages and %d tokens in %.2f seconds" % (len(merged_segments), segment_name, total_pages, total_unique_tokens, time_delta))
+
+#utc time a segment was retired at, in the retired segment list
+retire_time_format = '%Y-%m-%dT%H:%M:%S'
+
+def segment_build_id(index_folder, segment_name, cfg):
+   #tells a segment apart from a later one built in the same folder, the build id of its merge stats or,
+   #for older indexes, their modification time
+   stats_file_path = os.path.join(index_folder, segment_name, cfg['primary_stats_file_name'])
+   if not os.path.isfile(stats_file_path):
+      return None
+   build_id = read_merge_stats(os.path.join(index_folder, segment_name), cfg)[3]
+   return build_id if build_id is not None else str(os.stat(stats_file_path).st_mtime_ns)
+
+def read_retired_segments(index_folder, cfg):
+   #[segment folder, build id, retire time] of the merged segments still on disk
+   retired_list_file = os.path.join(index_folder, cfg['retired_segment_list_name'])
+   retired_segments = []
+   if os.path.isfile(retired_list_file):
+      with open(retired_list_file, 'r', encoding='utf-8') as txt_file:
+         for line in txt_file:
+            data = line.split()
+            if len(data) == 3:
+               retired_segments.append([data[0], data[1], datetime.strptime(data[2], retire_time_format)])
+   return retired_segments
+
+def write_retired_segments(index_folder, retired_segments, cfg):
+   write_index_file(os.path.join(index_folder, cfg['retired_segment_list_name']), ['%s %s %s' % (name, build_id, retire_time.strftime(retire_time_format)) for name, build_id, retire_time in retired_segments])
+
+def retire_segments(index_folder, segments, cfg):
+   #merged segments are deleted by a later merge, searches that loaded the segment list before the merge
+   #still open their prime_index_file-* blocks on first use
+   retire_time = datetime.utcnow()
+   retired_segments = read_retired_segments(index_folder, cfg)
+   for segment in segments:
+      retired_segments.append([segment[0], segment_build_id(index_folder, segment[0], cfg), retire_time])
+   write_retired_segments(index_folder, retired_segments, cfg)
+
+def delete_retired_segments(index_folder, cfg):
+   #deletes the segments retired more than segment_retire_seconds ago. a segment whose build id changed
+   #since, as the index folder itself after a rebuild in place, is left alone
+   now = datetime.utcnow()
+   kept_segments = []
+   for name, build_id, retire_time in read_retired_segments(index_folder, cfg):
+      if (now - retire_time).total_seconds() < cfg['segment_retire_seconds']:
+         kept_segments.append([name, build_id, retire_time])
+         continue
+      if segment_build_id(index_folder, name, cfg) != build_id:
+         continue
+      print("[INFO] deleting retired segment %s" % name)
+      delete_segment_files(index_folder, name, cfg)
+   write_retired_segments(index_folder, kept_segments, cfg)
+
+def delete_segment_files(index_folder, segment_name, cfg):
+   if segment_name != '.':
+      shutil.rmtree(segment_folder_path(index_folder, [segment_name]), ignore_errors=True)
+      return
+   #the original index lives in the index folder itself, next to the segment list
+   delete_files = []
+   for target_file_name in os.listdir(index_folder):
+      if not os.path.isfile(os.path.join(index_folder, target_file_name)):
+         continue
+      for file_name in [cfg['primary_index_file_name'], cfg['primary_index_offset_name'], cfg['term_dictionary_name'], cfg['champion_index_file_name'], cfg['champion_dictionary_name'], cfg['doc_title_map'], cfg['doc_field_lengths_name'], cfg['primary_stats_file_name'], cfg['stats_file_name'], cfg['inverted_index_file']]:
+         if target_file_name.startswith(file_name):
+            delete_files.append(target_file_name)
+            break
+   delete_temporary_index_files(index_folder, delete_files)
+
+def update_index():
+   #add-segment <delta xml dump> <index folder> [deleted titles file] | merge-segments <index folder>
+   if len(sys.argv) in [4, 5] and sys.argv[1] == 'add-segment':
+      deleted_titles_file = os.path.abspath(sys.argv[4]) if len(sys.argv) == 5 else None
+      merge_process = add_index_segment(os.path.abspath(sys.argv[2]), os.path.abspath(sys.argv[3]), deleted_titles_file=deleted_titles_file)
+      if merge_process is not None:
+         print("[INFO] merging segments in the background, process id %d" % merge_process.pid)
+      return 0
+   if len(sys.argv) == 3 and sys.argv[1] == 'merge-segments':
+      merge_index_segments(os.path.abspath(sys.argv[2]))
+      return 0
+   print("error : usage : add-segment <path to delta xml dump> <path to index_folder> [file of deleted page titles] | merge-segments <path to index_folder>")
+   return -1
+
 def initialize(create_secondary_index=True, create_primary_index=True, purge_secondary_index=False):
    #check for the runtime arguments
-   if len(sys.argv) != 3:
-      print("error : invalid number of argument passed [2] arguments required, need path to xml dump file and path to index_folder")
+   if len(sys.argv) not in [3, 4]:
+      print("error : invalid number of argument passed [2] arguments required, need path to xml dump file (.xml or .xml.bz2) and path to index_folder, optionally followed by the multistream index file")
       return -1
    
    start_time = datetime.utcnow()
    xml_dump_file = os.path.abspath(sys.argv[1])
    offline_index_storage = os.path.abspath(sys.argv[2])
+   multistream_index_file = None
+   if len(sys.argv) == 4:
+      multistream_index_file = os.path.abspath(sys.argv[3])
 
    if create_secondary_index:
-      build_secondary_index(xml_dump_file, offline_index_storage, empty_dir=False)
+      if not build_secondary_index(xml_dump_file, offline_index_storage, empty_dir=False, multistream_index_file=multistream_index_file):
+         return -1
    
    if create_primary_index:
       build_primary_index(offline_index_storage, purge_secondary_index)
 
    display_stats(offline_index_storage, start_time)
 
+def resume_index(purge_secondary_index=False):
+   #resume <xml dump> <index folder> [multistream index], continues an interrupted build from its checkpoints
+   if len(sys.argv) not in [4, 5]:
+      print("error : usage : resume <path to xml dump file> <path to index_folder> [multistream index file]")
+      return -1
+   start_time = datetime.utcnow()
+   xml_dump_file = os.path.abspath(sys.argv[2])
+   offline_index_storage = os.path.abspath(sys.argv[3])
+   multistream_index_file = None
+   if len(sys.argv) == 5:
+      multistream_index_file = os.path.abspath(sys.argv[4])
+   if not build_secondary_index(xml_dump_file, offline_index_storage, empty_dir=False, multistream_index_file=multistream_index_file, resume=True):
+      return -1
+   build_primary_index(offline_index_storage, purge_secondary_index, resume=True)
+   display_stats(offline_index_storage, start_time)
+
 if __name__ == "__main__":
-   initialize(create_secondary_index=False, create_primary_index=True)
\ No newline at end of file
+   if len(sys.argv) > 1 and sys.argv[1] in ['add-segment', 'merge-segments']:
+      update_index()
+   elif len(sys.argv) > 1 and sys.argv[1] == 'resume':
+      resume_index()
+   else:
+      initialize(create_secondary_index=True, create_primary_index=True)
\ No newline at end of file
@@ -1,101 +1,278 @@
 import sys
 import os
 import re
+import mmap
+import json
+import threading
+from collections import OrderedDict
+from bisect import bisect_right
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+from urllib.parse import urlparse, parse_qs
 from datetime import datetime
 from nltk import word_tokenize
-from nltk.corpus import stopwords
-from nltk.stem import PorterStemmer
-import math
-
-def fast_retrieval(offline_index_storage, file_name, offset_list, target_token, numeric=False):
-    file_ptr = open(os.path.join(offline_index_storage, file_name), 'r', encoding='utf-8')
-    low = 0
-    high = len(offset_list) - 1
-    result = ""
-    while(low <= high):
-        mid = int(low + ((high - low)/2))
-        mid_offset = offset_list[mid]
-        file_ptr.seek(mid_offset, 0)
-        text = file_ptr.readline().strip()
-        data = text.split(' ', 1)
-        present_token = data[0]
-        if numeric:
-            present_token = float(present_token)
-        if present_token == target_token:
-            result = text
-            break
-        elif present_token < target_token:
-            low = mid + 1
-        else:
-            high = mid - 1
-    return result
+import struct
+import numpy as np
 
-def load_index_offset(index_folder, file_name, debug=False):
-    offset_file_name = file_name+'-offset'
-    offset_list = []
-    if debug:
-        print('[DEBUG] loading the offset list : %s' % offset_file_name)
-    start_time = datetime.utcnow()
-    with open(os.path.join(index_folder, offset_file_name), 'r') as offset_file:
-        while True:
-            line = offset_file.readline().strip()
-            if not line or len(line)==0:
-                break
-            offset_list.append(int(line))
-    time_delta = (datetime.utcnow() - start_time).total_seconds()
-    if debug:
-        print('[DEBUG] offset list : %s is loaded in %.2f seconds' % (offset_file_name, time_delta))
-    return offset_list
+from inv_index_generator import get_configuration, get_tokenizer, field_alias, bm25_idf, average_field_lengths, field_length_norms, calculate_bm25f_weight, bm25f_upper_bound, read_field_length_table, lookup_field_lengths, field_length_dtype, term_idf_format, decode_varint, decode_varints, decode_posting_header, decode_posting_list, decode_posting_skips, decode_posting_blocks, posting_block_size, read_block_samples, primary_offset_dtype, missing_title_offset, read_segment_list, read_tombstones, read_merge_stats
 
-def load_primary_index_offset(index_folder, offset_file, debug=False):
-    offset_file_path = os.path.join(os.path.abspath(index_folder), offset_file)
-    primary_index_offset = []
-    if debug:
-        print("[DEBUG] loading primary index offset data from file -- %s " % offset_file_path)
-    start_time = datetime.utcnow()
-    with open(offset_file_path, 'r', encoding='utf-8') as txt_file:
-        for line in txt_file.readlines():
-            data = line.strip().split()
-            primary_index_offset.append([data[0], data[1], data[2]])
-    time_delta = (datetime.utcnow() - start_time).total_seconds()
-    if debug:
-        print("[DEBUG] loaded primary index offset in %4.2f seconds" % (time_delta))
-    return primary_index_offset
+class TitleMapReader(object):
+    #memory maps the title map and its offsets, indexed by doc id. a title lookup is one read at its offset
+    def __init__(self, index_folder, file_name):
+        self.title_file = open(os.path.join(index_folder, file_name), 'rb')
+        self.data = b''
+        if os.path.getsize(os.path.join(index_folder, file_name)) > 0:
+            self.data = mmap.mmap(self.title_file.fileno(), 0, access=mmap.ACCESS_READ)
+        offset_file = os.path.join(index_folder, file_name+'-offset')
+        self.first_doc_id = 0
+        self.offsets = np.zeros(0, dtype=primary_offset_dtype)
+        if os.path.getsize(offset_file) > 0:
+            offsets = np.memmap(offset_file, dtype=primary_offset_dtype, mode='r')
+            self.first_doc_id = int(offsets[0])
+            self.offsets = offsets[1:]
+
+    def title(self, doc_id):
+        #returns the title of the doc id or None
+        index = doc_id - self.first_doc_id
+        if index < 0 or index >= len(self.offsets):
+            return None
+        offset = int(self.offsets[index])
+        if offset == missing_title_offset:
+            return None
+        end = self.data.find(b'\n', offset)
+        if end < 0:
+            end = len(self.data)
+        data = self.data[offset:end].decode('utf-8').split(' ', 1)
+        if len(data) < 2:
+            return ''
+        return data[1]
+
+class PrimaryIndexReader(object):
+    #memory maps a prime_index_file-* block, a posting list is read at the offset the term dictionary gives
+    def __init__(self, index_folder, file_name):
+        self.file_name = file_name
+        self.index_file = open(os.path.join(index_folder, file_name), 'rb')
+        self.data = mmap.mmap(self.index_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def record(self, offset, length):
+        return memoryview(self.data)[offset:offset+length]
+
+class TermDictionary(object):
+    #the front coded term dictionary of the primary index, see TermDictionaryWriter. the first term of
+    #every group is held in memory, a lookup decodes the one group that can hold the term
+    def __init__(self, index_folder, file_name, primary_index_file_name):
+        self.primary_index_file_name = primary_index_file_name
+        dictionary_file = os.path.join(index_folder, file_name)
+        self.dictionary_file = open(dictionary_file, 'rb')
+        self.data = b''
+        if os.path.getsize(dictionary_file) > 0:
+            self.data = mmap.mmap(self.dictionary_file.fileno(), 0, access=mmap.ACCESS_READ)
+        samples = read_block_samples(dictionary_file + '-sample')
+        self.group_terms = [sample[0] for sample in samples]
+        self.group_offsets = [sample[1] for sample in samples] + [len(self.data)]
+
+    def __len__(self):
+        return len(self.group_terms)
+
+    def find(self, token):
+        #returns (prime_index_file-* name, offset, length, document count, idf) of the token or None
+        group = bisect_right(self.group_terms, token) - 1
+        if group < 0:
+            return None
+        target_term = token.encode('utf-8')
+        term = b''
+        position = self.group_offsets[group]
+        while position < self.group_offsets[group+1]:
+            shared, position = decode_varint(self.data, position)
+            suffix_length, position = decode_varint(self.data, position)
+            term = term[:shared] + self.data[position:position+suffix_length]
+            entry, position = decode_varints(self.data, position+suffix_length, 5)
+            position += struct.calcsize(term_idf_format)
+            if term == target_term:
+                range_id, block_id, offset, length, doc_count = [int(value) for value in entry]
+                idf = struct.unpack_from(term_idf_format, self.data, position - struct.calcsize(term_idf_format))[0]
+                return '%s-%d-%d' % (self.primary_index_file_name, range_id, block_id), offset, length, doc_count, idf
+            if term > target_term:
+                return None
+        return None
+
+class PostingListCache(object):
+    #lru cache of decoded posting lists, bounded by the bytes of the cached arrays
+    #since a single common term can be hundreds of MB. it holds the lists of a single index
+    #generation, and empties once lists of another one are stored
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.resident_bytes = 0
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, generation, token, fields=None):
+        #a cached list only counts as a hit if the columns of the given fields were decoded
+        with self.lock:
+            entry = self.entries.get(token, None) if generation == self.generation else None
+            if entry is None or (fields is not None and not set(fields).issubset(entry[0]['decoded_fields'])):
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(token)
+            return entry[0]
+
+    def put(self, generation, token, index_entry):
+        entry_bytes = index_entry['doc_ids'].nbytes + index_entry['field_counts'].nbytes
+        #lists larger than the whole budget are never cached
+        if entry_bytes > self.max_bytes:
+            return
+        with self.lock:
+            if generation != self.generation:
+                self.entries.clear()
+                self.resident_bytes = 0
+                self.generation = generation
+            previous = self.entries.pop(token, None)
+            if previous is not None:
+                self.resident_bytes -= previous[1]
+            self.entries[token] = (index_entry, entry_bytes)
+            self.resident_bytes += entry_bytes
+            #evict the least recently used lists
+            while self.resident_bytes > self.max_bytes:
+                _, (_, evicted_bytes) = self.entries.popitem(last=False)
+                self.resident_bytes -= evicted_bytes
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / lookups if lookups > 0 else 0.0,
+                'entries': len(self.entries),
+                'resident_bytes': self.resident_bytes,
+                'max_bytes': self.max_bytes,
+            }
+
+class QueryResultCache(object):
+    #lru cache of the results of analyzed queries, bounded by an estimate of the bytes of the results.
+    #it holds the results of a single index generation, and empties once queries run on a newer one
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.resident_bytes = 0
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __contains__(self, generation_key):
+        #lookup that leaves the statistics and the lru order alone
+        generation, key = generation_key
+        with self.lock:
+            return generation == self.generation and key in self.entries
+
+    def get(self, generation, key):
+        with self.lock:
+            entry = self.entries.get(key, None) if generation == self.generation else None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, generation, key, search_results):
+        entry_bytes = sys.getsizeof(key) + sum([sys.getsizeof(token) + sys.getsizeof(fields) for token, fields in key[0]])
+        entry_bytes += sum([sys.getsizeof(doc_title) + result_entry_bytes for _, doc_title, _ in search_results])
+        if entry_bytes > self.max_bytes:
+            return
+        with self.lock:
+            if generation != self.generation:
+                self.entries.clear()
+                self.resident_bytes = 0
+                self.generation = generation
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.resident_bytes -= previous[1]
+            self.entries[key] = (search_results, entry_bytes)
+            self.resident_bytes += entry_bytes
+            while self.resident_bytes > self.max_bytes:
+                _, (_, evicted_bytes) = self.entries.popitem(last=False)
+                self.resident_bytes -= evicted_bytes
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / lookups if lookups > 0 else 0.0,
+                'entries': len(self.entries),
+                'resident_bytes': self.resident_bytes,
+                'max_bytes': self.max_bytes,
+            }
+
+#rough size of a [doc_id, title, score] result without its title
+result_entry_bytes = sys.getsizeof([0, '', 0.0]) + sys.getsizeof(1<<40) + sys.getsizeof(0.0)
+
+def query_cache_key(final_search_query, result_count, mode='or'):
+    #queries that differ in case, word order, stop words or field order analyze to the same key. a field
+    #given twice for a token counts twice in its score, so the fields are only sorted
+    return (tuple(sorted([(token, ''.join(sorted(fields))) for token, fields in final_search_query])), result_count, mode)
 
-def load_primary_index(index_folder, f_index_name, target_tokens, debug=False):
-    index_dump_file = os.path.join(os.path.abspath(index_folder), f_index_name)
-    
+def get_primary_index_reader(index_folder, file_name, index_readers):
+    #readers are opened once and kept for the life of the process
+    reader = index_readers.get(file_name, None)
+    if reader is None:
+        reader = PrimaryIndexReader(index_folder, file_name)
+        index_readers[file_name] = reader
+    return reader
+
+def load_index_tokenizer(index_folder, cfg, stats_file='merge_stats'):
+    #the tokenizer the index was built with, recorded in the merge stats
+    tokenizer_name = cfg['tokenizer']
+    stats_file_path = os.path.join(os.path.abspath(index_folder), stats_file)
+    if os.path.isfile(stats_file_path):
+        with open(stats_file_path, 'r', encoding='utf-8') as txt_file:
+            data = txt_file.readline().split()
+            if len(data) >= 5:
+                tokenizer_name = data[4]
+    return get_tokenizer(tokenizer_name)
+
+def load_primary_index(index_folder, term_dictionary, target_tokens, debug=False, index_readers=None, target_fields=None):
+    #target_fields maps a token to the field aliases whose counts are needed, all of them by default.
+    #a token costs a term dictionary lookup and one read of its posting list
     inverted_index = {}
-    index_offset = load_index_offset(index_folder, f_index_name, debug=debug)
-    if debug:
-        print("[DEBUG] loading targeted inverted index from file -- %s " % index_dump_file)
+    if index_readers is None:
+        index_readers = {}
     start_time = datetime.utcnow()
     for token in target_tokens:
-        result = fast_retrieval(index_folder, f_index_name, index_offset, token).strip()
-        entries = result.split()
-        if len(entries) < 3:
+        fields = ''.join(field_alias)
+        if target_fields is not None:
+            fields = ''.join(sorted(set(target_fields[token])))
+        location = term_dictionary.find(token)
+        if location is None:
             if debug:
-                print("[ERROR] no posting entry found for token : %s in index file : %s" % (token, f_index_name))
+                print("[DEBUG] no posting entry found for token : %s in %s" % (token, index_folder))
             continue
-        #initialize the entry in inverted list
-        inverted_index[entries[0]] = {
-            'total_frequency': int(entries[1]),
-            'posting_list': [],
+        file_name, offset, length, doc_count, idf = location
+        reader = get_primary_index_reader(index_folder, file_name, index_readers)
+        term, total_frequency, doc_ids, field_counts, max_field_counts = decode_posting_list(reader.record(offset, length), fields)
+        #doc ids and the (postings x fields) counts are decoded into integer arrays
+        inverted_index[term] = {
+            'total_frequency': total_frequency,
+            'doc_ids': doc_ids,
+            'field_counts': field_counts,
+            'max_field_counts': max_field_counts,
+            'decoded_fields': fields,
+            'document_count': doc_count,
+            'idf': idf,
         }
-        count = 0
-        for posting_data in entries[2:]:
-            if count % 2 == 0:
-                posting_entry = [posting_data]
-            else:
-                posting_entry.append(posting_data)
-                inverted_index[entries[0]]['posting_list'].append(posting_entry)
-            count +=1
     time_delta = (datetime.utcnow() - start_time).total_seconds()
     if debug:
-        print("[DEBUG] loaded targeted inverted index in %4.2f seconds" % (time_delta))
+        print("[DEBUG] loaded %d posting lists in %4.2f seconds" % (len(inverted_index), time_delta))
     return inverted_index
 
-def search_within_indexes(stemmer, stop_words, query, inv_index, title_index, threshold=10):
+def search_within_indexes(stemmer, stop_words, query, inv_index, title_index, threshold=10, tokenize=word_tokenize):
     #find the category search
     category_regex = re.compile('\s*\w+:(\w+)\s*')
     relevant_words = re.findall(category_regex, query)
@@ -105,7 +282,7 @@ def search_within_indexes(stemmer, stop_words, query, inv_index, title_index, th
     search_query += ' '.join(relevant_words)
     #print("search query : %s" % search_query)
     #word tokenization
-    search_query = word_tokenize(search_query)
+    search_query = tokenize(search_query)
     #stopword removal
     search_query = list(set(search_query).difference(set(stop_words)))
     #stemming of words and case folding
@@ -113,8 +290,8 @@ def search_within_indexes(stemmer, stop_words, query, inv_index, title_index, th
     #print("final search query : %s" % search_query)
     search_ids = []
     for token in search_query:
-        intermediate_ids = inv_index.get(token, '')
-        intermediate_ids = [x[0] for x in intermediate_ids]
+        index_entry = inv_index.get(token, None)
+        intermediate_ids = [] if index_entry is None else index_entry['doc_ids'].tolist()
         search_ids = list(set(search_ids).union(set(intermediate_ids)))
     search_results = []
     for doc_id in search_ids[:threshold]:
@@ -123,187 +300,777 @@ def search_within_indexes(stemmer, stop_words, query, inv_index, title_index, th
             search_results.append(title)
     return search_results
 
-def locate_primary_index_files(word_desc, primary_index_offset, debug=True):
-    index_hits = {}
-    for word_info in word_desc:
-        word = word_info[0]
-        low = 0
-        high = len(primary_index_offset)
-        hit = False
-        while(low <= high):
-            mid = low + int((high - low)/2)
-            #bucket found
-            if word == primary_index_offset[mid][1] or word == primary_index_offset[mid][2] or (primary_index_offset[mid][1] < word and word < primary_index_offset[mid][2]): 
-                index_bucket = index_hits.get(primary_index_offset[mid][0], None)
-                # create new entry
-                if index_bucket is None:
-                    index_hits[primary_index_offset[mid][0]] = [word_info]
-                else:
-                    index_hits[primary_index_offset[mid][0]].append(word_info)
-                hit = True
-                break
-            elif word < primary_index_offset[mid][1]:
-                high = mid-1
+def load_postings(context, index, word_desc):
+    #returns {token: index entry} of the [token, fields] pairs over all the segments of the index,
+    #without the postings of tombstoned documents
+    postings = {}
+    missing_words = []
+    for token, field_activation in word_desc:
+        index_entry = context['posting_cache'].get(index['generation'], token, field_activation)
+        if index_entry is not None:
+            postings[token] = index_entry
+        else:
+            missing_words.append([token, field_activation])
+    if len(missing_words) == 0:
+        return postings
+    segment_entries = {}
+    for segment in index['segments']:
+        target_tokens = [word[0] for word in missing_words]
+        target_fields = dict((word[0], word[1]) for word in missing_words)
+        inverted_index = load_primary_index(segment['folder'], segment['term_dictionary'], target_tokens, debug=context['debug'], index_readers=segment['index_readers'], target_fields=target_fields)
+        for token, index_entry in inverted_index.items():
+            segment_entries.setdefault(token, []).append(index_entry)
+    for token, field_activation in missing_words:
+        entries = segment_entries.get(token, None)
+        if entries is None:
+            continue
+        postings[token] = combine_segment_postings(entries, index)
+        context['posting_cache'].put(index['generation'], token, postings[token])
+    return postings
+
+def combine_segment_postings(entries, index):
+    #segments hold increasing doc id ranges, so their posting lists concatenate in doc id order
+    tombstones = index['tombstones']
+    if len(entries) == 1 and len(tombstones) == 0:
+        combined = dict(entries[0])
+    else:
+        doc_ids = np.concatenate([entry['doc_ids'] for entry in entries])
+        field_counts = np.concatenate([entry['field_counts'] for entry in entries])
+        if len(tombstones) > 0:
+            live = ~np.isin(doc_ids, tombstones)
+            doc_ids = doc_ids[live]
+            field_counts = field_counts[live]
+        combined = {
+            'total_frequency': sum([entry['total_frequency'] for entry in entries]),
+            'doc_ids': doc_ids,
+            'field_counts': field_counts,
+            #still an upper bound once tombstoned postings are gone
+            'max_field_counts': np.max([entry['max_field_counts'] for entry in entries], axis=0),
+            'decoded_fields': entries[0]['decoded_fields'],
+            #the live postings, total_document_count leaves the tombstoned pages out as well
+            'document_count': len(doc_ids),
+        }
+    combined['idf'] = index_idf(index, combined['document_count'], entries[0]['idf'])
+    return combined
+
+def index_idf(index, document_count, stored_idf):
+    #the idf stored in the term dictionary holds for an index of a single segment without tombstones,
+    #otherwise document_count has to be the count of the live postings of the term
+    if len(index['segments']) == 1 and len(index['tombstones']) == 0:
+        return stored_idf
+    return bm25_idf(index['total_document_count'], document_count)
+
+def document_norms(index, doc_ids):
+    #bm25f length norms of the documents, from the field lengths of the segments holding them
+    segments = index['segments']
+    if len(segments) == 1:
+        field_lengths = lookup_field_lengths(segments[0]['field_lengths'], doc_ids)
+    else:
+        field_lengths = np.zeros((len(doc_ids), len(field_alias)), dtype=field_length_dtype)
+        positions = np.searchsorted(index['segment_first_doc_ids'], doc_ids, side='right') - 1
+        for position in np.unique(positions).tolist():
+            in_segment = positions == position
+            field_lengths[in_segment] = lookup_field_lengths(segments[max(position, 0)]['field_lengths'], doc_ids[in_segment])
+    return field_length_norms(field_lengths, index['average_field_lengths'])
+
+def live_document_count(index, segment, token, location):
+    #document count of the posting list of the token at its term dictionary location in the segment,
+    #without the tombstoned postings. only the blocks that can hold a tombstoned doc id are decoded, and
+    #the count is kept for the life of the index
+    key = (segment['folder'], token)
+    document_count = index['live_document_counts'].get(key, None)
+    if document_count is not None:
+        return document_count
+    file_name, offset, length, doc_count = location[:4]
+    tombstones = index['tombstones']
+    tombstones = tombstones[(tombstones >= segment['first_doc_id']) & (tombstones <= segment['last_doc_id'])]
+    document_count = doc_count
+    if len(tombstones) > 0:
+        record = get_primary_index_reader(segment['folder'], file_name, segment['index_readers']).record(offset, length)
+        if doc_count <= posting_block_size:
+            doc_ids = decode_posting_list(record, '')[2]
+        else:
+            skips = decode_posting_skips(record)
+            blocks = np.unique(np.searchsorted(skips['last_doc_ids'], tombstones))
+            blocks = blocks[blocks < len(skips['last_doc_ids'])]
+            doc_ids, _ = decode_posting_blocks(record, skips, blocks, '')
+        document_count -= int(np.isin(doc_ids, tombstones).sum())
+    index['live_document_counts'][key] = document_count
+    return document_count
+
+def open_postings(context, index, word_desc):
+    #returns {token: index entry} like load_postings, except that the lists missing from the posting cache
+    #are left undecoded. such an entry holds the records of its segments and their skip tables, see
+    #posting_arrays, its live document count and its idf
+    postings = {}
+    for token, field_activation in word_desc:
+        index_entry = context['posting_cache'].get(index['generation'], token, field_activation)
+        if index_entry is not None:
+            postings[token] = index_entry
+            continue
+        index_entry = {
+            'total_frequency': 0,
+            'doc_ids': None,
+            'field_counts': None,
+            'max_field_counts': np.zeros(len(field_alias), dtype=np.int64),
+            'decoded_fields': ''.join(sorted(set(field_activation))),
+            'document_count': 0,
+            'records': [],
+            'tombstones': index['tombstones'],
+        }
+        for segment in index['segments']:
+            location = segment['term_dictionary'].find(token)
+            if location is None:
+                continue
+            file_name, offset, length, doc_count = location[:4]
+            record = get_primary_index_reader(segment['folder'], file_name, segment['index_readers']).record(offset, length)
+            skips = None
+            if doc_count > posting_block_size:
+                skips = decode_posting_skips(record)
+                total_frequency, max_field_counts = skips['total_frequency'], skips['max_field_counts']
             else:
-                low = mid+1
-        if not hit and debug:
-            print("[DEBUG] no index file found for word : %s" % word)
+                _, total_frequency, _, max_field_counts, _ = decode_posting_header(record)
+            index_entry['total_frequency'] += total_frequency
+            #still an upper bound once tombstoned postings are gone
+            index_entry['max_field_counts'] = np.maximum(index_entry['max_field_counts'], max_field_counts)
+            index_entry['document_count'] += live_document_count(index, segment, token, location)
+            index_entry['idf'] = location[4]
+            index_entry['records'].append([segment, record, skips])
+        if len(index_entry['records']) == 0:
+            if context['debug']:
+                print("[DEBUG] no posting entry found for token : %s" % token)
+            continue
+        index_entry['idf'] = index_idf(index, index_entry['document_count'], index_entry['idf'])
+        postings[token] = index_entry
+    return postings
+
+def posting_arrays(index_entry, candidate_ids=None):
+    #returns (doc_ids, field_counts) of the live postings of an index entry. an entry of open_postings is
+    #decoded in full on first use and becomes a plain index entry, unless sorted candidate_ids are given,
+    #then only the blocks that can hold one of the candidates are decoded
+    if index_entry['doc_ids'] is not None:
+        return index_entry['doc_ids'], index_entry['field_counts']
+    fields = index_entry['decoded_fields']
+    segment_ids = []
+    segment_counts = []
+    for segment, record, skips in index_entry['records']:
+        if skips is None:
+            _, _, doc_ids, field_counts, _ = decode_posting_list(record, fields)
+        else:
+            blocks = None
+            if candidate_ids is not None:
+                segment_candidates = candidate_ids[np.searchsorted(candidate_ids, segment['first_doc_id']):np.searchsorted(candidate_ids, segment['last_doc_id'], side='right')]
+                #the first block ending at or after a candidate is the only one that can hold it
+                blocks = np.unique(np.searchsorted(skips['last_doc_ids'], segment_candidates))
+                blocks = blocks[blocks < len(skips['last_doc_ids'])]
+            doc_ids, field_counts = decode_posting_blocks(record, skips, blocks, fields)
+        segment_ids.append(doc_ids)
+        segment_counts.append(field_counts)
+    doc_ids = np.concatenate(segment_ids)
+    field_counts = np.concatenate(segment_counts)
+    tombstones = index_entry['tombstones']
+    if len(tombstones) > 0:
+        live = ~np.isin(doc_ids, tombstones)
+        doc_ids = doc_ids[live]
+        field_counts = field_counts[live]
+    if candidate_ids is None:
+        index_entry['doc_ids'] = doc_ids
+        index_entry['field_counts'] = field_counts
+        del index_entry['records']
+        del index_entry['tombstones']
+    return doc_ids, field_counts
+
+def calculate_rank(context, index, word_desc, threshold=10):
+    #returns [doc_id, score] of the best threshold documents for the [token, fields] pairs of a query
+    debug = context['debug']
+    postings = open_postings(context, index, word_desc)
+    opened_tokens = [token for token, index_entry in postings.items() if index_entry['doc_ids'] is None]
+    term_entries = []
+    for token, field_activation in word_desc:
+        index_entry = postings.get(token, None)
+        if index_entry is not None:
+            term_entries.append([index_entry, field_activation])
+    rank_stats = {}
+    final_results = select_top_results(term_entries, index, threshold, rank_stats)
+    #the lists that were decoded in full are cached, the ones that were only probed are not
+    for token in opened_tokens:
+        if postings[token]['doc_ids'] is not None:
+            context['posting_cache'].put(index['generation'], token, postings[token])
     if debug:
-        print("[DEBUG] intermediate primary index search : %s" % index_hits)
-    hit_results = []
-    for key, value in sorted(index_hits.items(), key=lambda kv: len(kv[1]), reverse=True):
-        hit_results.append([key, value])
-    return hit_results
-
-def calculate_rank(path_to_index_folder, file_locations, results, total_documents, threshold=10, debug=False):
-    for entry in file_locations:
-        index_file = entry[0]
-        word_desc = entry[1]
-        target_tokens = [word[0] for word in word_desc]
-        inverted_index = load_primary_index(path_to_index_folder, index_file, target_tokens, debug=debug)
-        for word in word_desc:
-            token = word[0]
-            field_activation = word[1]
-            index_entry = inverted_index.get(token, None)
-            if index_entry is not None:
-                calculate_weight(index_entry, results, field_activation, total_documents)
-    final_result_id = []
-    count = 0
-    for key, value in sorted(results.items(), key=lambda kv: kv[1], reverse=True):
-        if count >=threshold:
-            break
-        final_result_id.append(key)
-        count += 1
-    return final_result_id
-    
-
-def calculate_weight(index_entry, results, field_activation, total_documents):
-    total_frequency = float(index_entry['total_frequency'])
-    posting_list = index_entry['posting_list']
-    total_docs = float(len(posting_list))
-    for entry in posting_list:
-        doc_id = entry[0]
-        field = entry[1]
-        weight = calculate_field_weight(field_activation, field) * math.log(total_documents/float(total_docs))
-        
-        result_entry = results.get(doc_id, None)
-        if result_entry is None:
-            results[doc_id] = weight
+        print("[DEBUG] scored %d of %d postings" % (rank_stats['scored_postings'], rank_stats['total_postings']))
+    return final_results
+
+def load_champion_postings(context, index, word_desc):
+    #returns {token: index entry} like load_postings, read from the champion lists of the tokens that
+    #have one and from the full posting lists of the others. the document count and idf of an entry are
+    #the ones of the live postings of the full lists
+    segment_entries = {}
+    for segment in index['segments']:
+        for token, field_activation in word_desc:
+            full_location = segment['term_dictionary'].find(token)
+            if full_location is None:
+                continue
+            location = None
+            if segment['champion_dictionary'] is not None:
+                location = segment['champion_dictionary'].find(token)
+            champion = location is not None
+            if location is None:
+                location = full_location
+            file_name, offset, length, doc_count, idf = location
+            reader = get_primary_index_reader(segment['folder'], file_name, segment['index_readers'])
+            fields = ''.join(sorted(set(field_activation)))
+            _, total_frequency, doc_ids, field_counts, max_field_counts = decode_posting_list(reader.record(offset, length), fields)
+            segment_entries.setdefault(token, []).append({
+                'total_frequency': total_frequency,
+                'doc_ids': doc_ids,
+                'field_counts': field_counts,
+                'max_field_counts': max_field_counts,
+                'decoded_fields': fields,
+                'document_count': live_document_count(index, segment, token, full_location),
+                'idf': idf,
+                'champion': champion,
+            })
+    postings = {}
+    for token, entries in segment_entries.items():
+        postings[token] = combine_segment_postings(entries, index)
+        postings[token]['champion'] = any([entry['champion'] for entry in entries])
+        #a champion list is only part of the postings of its term
+        postings[token]['document_count'] = sum([entry['document_count'] for entry in entries])
+        postings[token]['idf'] = index_idf(index, postings[token]['document_count'], entries[0]['idf'])
+    return postings
+
+def calculate_champion_rank(context, index, word_desc, threshold=10, rank_stats=None):
+    #approximate [doc_id, score] of the best threshold documents, scored over the champion lists only.
+    #the full posting lists are only read when the champion lists don't hold threshold documents
+    debug = context['debug']
+    postings = load_champion_postings(context, index, word_desc)
+    term_entries = []
+    for token, field_activation in word_desc:
+        index_entry = postings.get(token, None)
+        if index_entry is not None:
+            term_entries.append([index_entry, field_activation])
+    final_results = select_top_results(term_entries, index, threshold)
+    #without any champion list the results are already the exact ones
+    fallback = len(final_results) < threshold and any([index_entry['champion'] for index_entry, _ in term_entries])
+    if rank_stats is not None:
+        rank_stats['fallback'] = fallback
+    if fallback:
+        if debug:
+            print("[DEBUG] %d results from the champion lists, ranking the full posting lists" % len(final_results))
+        return calculate_rank(context, index, word_desc, threshold=threshold)
+    return final_results
+
+def calculate_conjunctive_rank(context, index, word_desc, threshold=10):
+    #returns [doc_id, score] of the best threshold documents holding every token of a query, scored the
+    #same way as calculate_rank
+    debug = context['debug']
+    if len(word_desc) == 0 or threshold <= 0:
+        return []
+    #the idf of a term comes from its live postings over all the segments, as in calculate_rank, also
+    #from the segments that don't hold every term
+    document_counts = [0]*len(word_desc)
+    stored_idfs = [0.0]*len(word_desc)
+    segment_matches = []
+    rank_stats = {'decoded_blocks': 0, 'total_blocks': 0}
+    for segment in index['segments']:
+        locations = [segment['term_dictionary'].find(token) for token, _ in word_desc]
+        for i, location in enumerate(locations):
+            if location is not None:
+                document_counts[i] += live_document_count(index, segment, word_desc[i][0], location)
+                stored_idfs[i] = location[4]
+        if any([location is None for location in locations]):
+            continue
+        segment_matches.append(intersect_segment_postings(segment, word_desc, locations, index['tombstones'], rank_stats))
+    if debug:
+        print("[DEBUG] decoded %d of %d posting blocks" % (rank_stats['decoded_blocks'], rank_stats['total_blocks']))
+    if len(segment_matches) == 0 or min(document_counts) == 0:
+        return []
+    candidate_ids = np.concatenate([doc_ids for doc_ids, _ in segment_matches])
+    candidate_scores = np.zeros(len(candidate_ids))
+    for i, (token, field_activation) in enumerate(word_desc):
+        field_counts = np.concatenate([term_counts[i] for _, term_counts in segment_matches])
+        candidate_scores += calculate_bm25f_weight(field_activation, field_counts, document_norms(index, candidate_ids)) * index_idf(index, document_counts[i], stored_idfs[i])
+    if len(candidate_scores) > threshold:
+        best = np.argpartition(candidate_scores, len(candidate_scores) - threshold)[len(candidate_scores) - threshold:]
+    else:
+        best = np.arange(len(candidate_scores))
+    best = best[np.argsort(-candidate_scores[best], kind='stable')]
+    return [[doc_id, score] for doc_id, score in zip(candidate_ids[best].tolist(), candidate_scores[best].tolist())]
+
+def intersect_segment_postings(segment, word_desc, locations, tombstones, rank_stats):
+    #returns (doc_ids, field counts of every token) of the documents of a segment holding every token.
+    #the rarest posting list gives the candidates, every longer list is only decoded in the blocks whose
+    #skip table entry says they can hold one of the remaining candidates
+    doc_ids = None
+    term_counts = [None]*len(word_desc)
+    for i in sorted(range(len(word_desc)), key=lambda i: locations[i][3]):
+        file_name, offset, length, doc_count, _ = locations[i]
+        field_activation = word_desc[i][1]
+        fields = ''.join(sorted(set(field_activation)))
+        record = get_primary_index_reader(segment['folder'], file_name, segment['index_readers']).record(offset, length)
+        if doc_ids is None or doc_count <= posting_block_size:
+            _, _, term_ids, field_counts, _ = decode_posting_list(record, fields)
+            block_count = (doc_count + posting_block_size - 1) // posting_block_size
+            rank_stats['decoded_blocks'] += block_count
+            rank_stats['total_blocks'] += block_count
         else:
-            results[doc_id] += weight 
-
-def calculate_field_weight(field_activation, entry_field):
-    result = 0.0
-    factor = {
-        't': 0.25,
-        'b': 0.25,
-        'i': 0.20,
-        'c': 0.1,
-        'l': 0.1,
-    }
-    entry_field = entry_field.strip()
-    for field in field_activation:
-        if field in entry_field:
-            index = entry_field.find(field)
-            weight = extract_number(index+1, entry_field)
-            result += float(factor[field] * (1+math.log(float(weight)))) 
-    return result
-
-def extract_number(index, word):
-    res = 0.0
-    while(index < len(word)):
-        if '0'<=word[index] and word[index]<='9':
-            res = res*10 + float(ord(word[index]) - ord('0'))
-            index+=1
+            skips = decode_posting_skips(record)
+            #the first block ending at or after a candidate is the only one that can hold it
+            blocks = np.unique(np.searchsorted(skips['last_doc_ids'], doc_ids))
+            blocks = blocks[blocks < len(skips['last_doc_ids'])]
+            term_ids, field_counts = decode_posting_blocks(record, skips, blocks, fields)
+            rank_stats['decoded_blocks'] += len(blocks)
+            rank_stats['total_blocks'] += len(skips['last_doc_ids'])
+        #a posting without any of the query fields of the token doesn't match, as in select_top_results
+        if not set(field_alias).issubset(field_activation):
+            present = (field_counts[:, [field_alias.index(field) for field in field_activation]] != 0).any(axis=1)
+            term_ids = term_ids[present]
+            field_counts = field_counts[present]
+        if doc_ids is None:
+            live = ~np.isin(term_ids, tombstones)
+            doc_ids = term_ids[live]
+            term_counts[i] = field_counts[live]
+        elif len(term_ids) == 0:
+            doc_ids = doc_ids[:0]
+        else:
+            positions = np.minimum(np.searchsorted(term_ids, doc_ids), len(term_ids) - 1)
+            matched = term_ids[positions] == doc_ids
+            doc_ids = doc_ids[matched]
+            for j in range(len(word_desc)):
+                if term_counts[j] is not None:
+                    term_counts[j] = term_counts[j][matched]
+            term_counts[i] = field_counts[positions[matched]]
+        if len(doc_ids) == 0:
+            return doc_ids, [np.zeros((0, len(field_alias)), dtype=np.int64)]*len(word_desc)
+    return doc_ids, term_counts
+
+def select_top_results(term_entries, index, threshold=10, rank_stats=None):
+    #term at a time maxscore over [index_entry, field_activation] of the query terms, scored as arrays.
+    #terms go from the highest score upper bound down, once the bounds of the remaining terms add up
+    #to no more than the current k-th best score they can't bring in a new result, so from then on
+    #they are only probed for the candidates that can still make it
+    terms = []
+    total_postings = 0
+    for index_entry, field_activation in term_entries:
+        document_count = index_entry['document_count']
+        if document_count == 0:
             continue
-        break
-    return res+1e-3
+        total_postings += document_count
+        #a champion list only holds some of the postings of the term, its idf is the one of the full list
+        idf = index_entry['idf']
+        upper_bound = bm25f_upper_bound(field_activation, index_entry['max_field_counts'], index['average_field_lengths']) * idf
+        terms.append([upper_bound, index_entry, field_activation, idf])
+    if threshold <= 0:
+        terms = []
+    terms.sort(key=lambda term: term[0], reverse=True)
+    #remaining_bounds[i] is the best score terms[i..] can add to a document
+    remaining_bounds = np.cumsum([term[0] for term in terms][::-1])[::-1]
 
-def print_results_from_title_map(results, offset_list, index_folder, title_map_name, debug=False):
-    count = 0
+    candidate_ids = np.empty(0, dtype=np.int64)
+    candidate_scores = np.empty(0, dtype=np.float64)
+    kth_score = float('-inf')
+    scored_postings = 0
+    for i, (upper_bound, index_entry, field_activation, idf) in enumerate(terms):
+        if remaining_bounds[i] > kth_score:
+            #the term can still bring in new documents, all of its postings are scored and added in,
+            #except for the ones that have none of the fields of the query
+            doc_ids, field_counts = posting_arrays(index_entry)
+            if not set(field_alias).issubset(field_activation):
+                present = (field_counts[:, [field_alias.index(field) for field in field_activation]] != 0).any(axis=1)
+                doc_ids = doc_ids[present]
+                field_counts = field_counts[present]
+            term_scores = calculate_bm25f_weight(field_activation, field_counts, document_norms(index, doc_ids)) * idf
+            scored_postings += len(doc_ids)
+            candidate_ids, inverse = np.unique(np.concatenate((candidate_ids, doc_ids)), return_inverse=True)
+            candidate_scores = np.bincount(inverse, weights=np.concatenate((candidate_scores, term_scores)), minlength=len(candidate_ids))
+        else:
+            keep = candidate_scores + remaining_bounds[i] >= kth_score
+            candidate_ids = candidate_ids[keep]
+            candidate_scores = candidate_scores[keep]
+            #only the postings that can be the ones of a candidate are decoded
+            doc_ids, field_counts = posting_arrays(index_entry, candidate_ids)
+            if len(doc_ids) == 0:
+                continue
+            positions = np.minimum(np.searchsorted(doc_ids, candidate_ids), len(doc_ids) - 1)
+            matched = doc_ids[positions] == candidate_ids
+            positions = positions[matched]
+            candidate_scores[matched] += calculate_bm25f_weight(field_activation, field_counts[positions], document_norms(index, candidate_ids[matched])) * idf
+            scored_postings += len(positions)
+        if len(candidate_scores) >= threshold > 0:
+            #partial scores only grow, so the k-th best of them is a safe threshold
+            kth_score = np.partition(candidate_scores, len(candidate_scores) - threshold)[len(candidate_scores) - threshold]
+    if rank_stats is not None:
+        rank_stats['scored_postings'] = scored_postings
+        rank_stats['total_postings'] = total_postings
+    if len(candidate_scores) > threshold:
+        best = np.argpartition(candidate_scores, len(candidate_scores) - threshold)[len(candidate_scores) - threshold:]
+    else:
+        best = np.arange(len(candidate_scores))
+    best = best[np.argsort(-candidate_scores[best], kind='stable')]
+    return [[doc_id, score] for doc_id, score in zip(candidate_ids[best].tolist(), candidate_scores[best].tolist())]
+
+def lookup_title(context, index, doc_id):
+    #the title map of the segment holding the doc id
+    segment = index['segments'][max(bisect_right(index['segment_first_doc_ids'], doc_id) - 1, 0)]
+    return segment['title_map'].title(int(doc_id))
+
+def print_results(search_results, debug=False):
     print("Results >> ")
-    for doc_id in results:
-        data = fast_retrieval(index_folder, title_map_name, offset_list, int(doc_id), numeric=True).strip()
-        if len(data) > 0:
-            doc_title = data.split(' ', 1)[1] 
-            count += 1
-            if debug:
-                print(">>%s %s" %(doc_id, doc_title))
-            else:
-                print(">>%s" % (doc_title))
+    for doc_id, doc_title, score in search_results:
+        if debug:
+            print(">>%s %s" %(doc_id, doc_title))
+        else:
+            print(">>%s" % (doc_title))
+    if len(search_results) == 0 :
+        print(">> No results found !!!")
+
+def print_result_cache_stats(result_cache, prefix='[INFO]'):
+    cache_stats = result_cache.stats()
+    print("%s query result cache : %.2f%% hit rate (%d hits, %d misses), %d queries, %.2f of %.2f MB resident" % (prefix, 100.0*cache_stats['hit_rate'], cache_stats['hits'], cache_stats['misses'], cache_stats['entries'], cache_stats['resident_bytes']/float(1<<20), cache_stats['max_bytes']/float(1<<20)))
+
+def print_posting_cache_stats(posting_cache, prefix='[INFO]'):
+    cache_stats = posting_cache.stats()
+    print("%s posting list cache : %.2f%% hit rate (%d hits, %d misses), %d lists, %.2f of %.2f MB resident" % (prefix, 100.0*cache_stats['hit_rate'], cache_stats['hits'], cache_stats['misses'], cache_stats['entries'], cache_stats['resident_bytes']/float(1<<20), cache_stats['max_bytes']/float(1<<20)))
+
+def load_search_context(path_to_index_folder, debug=False):
+    #everything a query needs, loaded once and shared by all the queries of the process
+    context = {
+        'index_folder': path_to_index_folder,
+        'title_map_name': "doc_title_map",
+        'debug': debug,
+    }
+    # load utilities, shared with the indexer so that query terms are stemmed the same way
+    cfg = get_configuration(path_to_index_folder)
+    context['cfg'] = cfg
+    context['stop_words'] = set(cfg['stop_words'])
+    context['stemmer'] = cfg['stemmer']
+    context['max_result_count'] = cfg['max_result_count']
+    context['posting_cache'] = PostingListCache(cfg['posting_cache_bytes'])
+    context['result_cache'] = QueryResultCache(cfg['result_cache_bytes'])
+    context['index_lock'] = threading.Lock()
+    #load indexes
+    context['index'] = load_index_segments(context)
+    context['total_document_count'] = context['index']['total_document_count']
+    context['tokenize'] = load_index_tokenizer(context['index']['segments'][0]['folder'], cfg)
+    return context
+
+def index_version(context):
+    #changes whenever a segment is added or merged, pages are tombstoned or the index is built again
+    version = []
+    for file_name in [context['cfg']['segment_list_name'], context['cfg']['tombstone_file_name'], context['cfg']['primary_stats_file_name']]:
+        file_path = os.path.join(context['index_folder'], file_name)
+        if os.path.isfile(file_path):
+            file_stat = os.stat(file_path)
+            version.append((file_stat.st_mtime_ns, file_stat.st_size))
         else:
+            version.append(None)
+    return version
+
+def load_index_segments(context):
+    #title map and term dictionary of every segment, and the tombstoned doc ids
+    debug = context['debug']
+    index = {'version': index_version(context), 'segments': []}
+    total_document_count = 0
+    for name, first_doc_id, last_doc_id in read_segment_list(context['index_folder'], context['cfg']):
+        segment_folder = os.path.join(context['index_folder'], name)
+        segment = {
+            'folder': segment_folder,
+            'first_doc_id': first_doc_id,
+            'last_doc_id': last_doc_id,
+            'title_map': TitleMapReader(segment_folder, context['title_map_name']),
+            'term_dictionary': TermDictionary(segment_folder, context['cfg']['term_dictionary_name'], context['cfg']['primary_index_file_name']),
+            'champion_dictionary': None,
+            #memory mapped prime_index_file-* blocks, opened on first use
+            'index_readers': {},
+        }
+        #indexes built before the champion tier have no champion dictionary
+        if os.path.isfile(os.path.join(segment_folder, context['cfg']['champion_dictionary_name'])):
+            segment['champion_dictionary'] = TermDictionary(segment_folder, context['cfg']['champion_dictionary_name'], context['cfg']['champion_index_file_name'])
+        segment_pages, _, _, segment['build_id'] = read_merge_stats(segment_folder, context['cfg'])
+        total_document_count += segment_pages
+        if debug:
+            print("[DEBUG] loaded segment %s, %d term dictionary groups in memory" % (name, len(segment['term_dictionary'])))
+        index['segments'].append(segment)
+    index['segment_first_doc_ids'] = [segment['first_doc_id'] for segment in index['segments']]
+    index['tombstones'] = read_tombstones(context['index_folder'], context['cfg'])
+    index['total_document_count'] = total_document_count - len(index['tombstones'])
+    #(segment folder, token) : live document count, see live_document_count
+    index['live_document_counts'] = {}
+    load_field_lengths(context, index)
+    #the build ids of the segments, and the segment list and tombstones they were loaded with
+    index['generation'] = [index['version'], [segment['build_id'] for segment in index['segments']]]
+    return index
+
+def load_field_lengths(context, index):
+    #memory maps the field length table of every segment, a query looks up the lengths of its postings.
+    #the average field lengths of the live pages come from the totals of the tables, less the lengths of
+    #the tombstoned pages
+    page_count = 0
+    length_totals = np.zeros(len(field_alias), dtype=np.int64)
+    for segment in index['segments']:
+        table = read_field_length_table(os.path.join(segment['folder'], context['cfg']['doc_field_lengths_name']))
+        if table is None:
+            table = [segment['first_doc_id'], np.zeros((0, len(field_alias)), dtype=field_length_dtype), 0, np.zeros(len(field_alias), dtype=np.int64)]
+        segment['field_lengths'] = table
+        tombstoned = lookup_field_lengths(table, index['tombstones'])
+        tombstoned = tombstoned[tombstoned.any(axis=1)]
+        page_count += table[2] - len(tombstoned)
+        length_totals += table[3] - tombstoned.sum(axis=0, dtype=np.int64)
+    index['average_field_lengths'] = average_field_lengths(page_count, length_totals)
+
+def refresh_search_context(context):
+    #picks up added, merged and tombstoned segments, returns the index to run the next query on
+    index = context['index']
+    if index_version(context) == index['version']:
+        return index
+    with context['index_lock']:
+        if index_version(context) != context['index']['version']:
+            context['index'] = load_index_segments(context)
+            context['total_document_count'] = context['index']['total_document_count']
+            if context['debug']:
+                print("[DEBUG] reloaded %d index segments" % len(context['index']['segments']))
+        return context['index']
+
+def analyze_query(context, query):
+    #returns the [stemmed token, fields] pairs of the query
+    tokenize = context['tokenize']
+    stop_words = context['stop_words']
+    stemmer = context['stemmer']
+    #find the category search
+    category_regex = re.compile('\s*\w+:(\w+)\s*')
+    relevant_words = re.findall(category_regex, query)
+    final_search_query = []
+    #field queries
+    if len(relevant_words) > 0:
+        group_field = {}
+        if context['debug']:
+            print("working with field query search :")
+        global_words = re.findall(r'[t|i|c|l|b]:([^:]*)(?!\S)', query)
+        global_fields = re.findall(r'([t|i|c|l|b]):', query)
+        for index, word in enumerate(global_words):
+            #case folding and word tokenization, the stop words are lower case
+            search_query = tokenize(word.lower())
+            #stopword removal
+            search_query = list(set(search_query).difference(stop_words))
+            #stemming of words
+            search_query = [stemmer.stem(w) for w in search_query]
+            for query_token in search_query:
+                isPresent = group_field.get(query_token, None)
+                if isPresent is not None:
+                    group_field[query_token] += global_fields[index]
+                else:
+                    group_field[query_token] = global_fields[index]
+
+        for key, value in group_field.items():
+            final_search_query.append([key, value])
+    else:
+        #case folding and word tokenization, the stop words are lower case
+        search_query = tokenize(query.lower())
+        #stopword removal
+        search_query = list(set(search_query).difference(stop_words))
+        #stemming of words
+        search_query = [stemmer.stem(w) for w in search_query]
+        for query_token in search_query:
+            final_search_query.append([query_token, 'ticlb'])
+    return final_search_query
+
+def execute_query(context, query, result_count=10, mode='or'):
+    #returns [doc_id, title, score] of the best result_count documents, in 'and' mode only the documents
+    #holding every term of the query are ranked, 'champion' mode ranks the champion lists
+    debug = context['debug']
+    index = refresh_search_context(context)
+    final_search_query = analyze_query(context, query)
+    cache_key = query_cache_key(final_search_query, result_count, mode)
+    search_results = context['result_cache'].get(index['generation'], cache_key)
+    if search_results is not None:
+        return search_results
+    if mode == 'and':
+        final_results = calculate_conjunctive_rank(context, index, final_search_query, threshold=result_count)
+    elif mode == 'champion':
+        final_results = calculate_champion_rank(context, index, final_search_query, threshold=result_count)
+    else:
+        final_results = calculate_rank(context, index, final_search_query, threshold=result_count)
+    search_results = []
+    for doc_id, score in final_results:
+        doc_title = lookup_title(context, index, doc_id)
+        if doc_title is None:
             if debug:
                 print(">> !!! error encountered for %d" % doc_id)
-    if count == 0 :
-        print(">> No results found !!!")
+            continue
+        search_results.append([doc_id, doc_title, score])
+    context['result_cache'].put(index['generation'], cache_key, search_results)
+    return search_results
 
 def search(path_to_index_folder, result_count=10):
-    search_results = []
-    title_map_name = "doc_title_map"
-    
-    primary_index_offset_file = "primary_index_file_offset"
     debugMode = True
-    # load utilities
-    stop_words = stopwords.words("english")
-    stemmer = PorterStemmer()
-    #load indexes
-    title_map_offset = load_index_offset(path_to_index_folder, title_map_name, debug=debugMode)
-    total_document_count = len(title_map_offset) 
-    
-    primary_index_offset = load_primary_index_offset(path_to_index_folder, primary_index_offset_file, debug=debugMode)
-    print('Search across %s pages ...' % (total_document_count))
+    context = load_search_context(path_to_index_folder, debug=debugMode)
+    stemmer = context['stemmer']
+    print('Search across %s pages ...' % (context['total_document_count']))
     while True:
         query = input('\nType in your query:\n')
         start = datetime.utcnow()
-        # query = query.lower()
-        #find the category search
-        category_regex = re.compile('\s*\w+:(\w+)\s*')
-        relevant_words = re.findall(category_regex, query)
-        final_search_query = []
-        #field queries
-        if len(relevant_words) > 0:
-            group_field = {}
-            print("working with field query search :")
-            global_words = re.findall(r'[t|i|c|l|b]:([^:]*)(?!\S)', query)
-            global_fields = re.findall(r'([t|i|c|l|b]):', query)
-            for index, word in enumerate(global_words):
-                #word tokenization
-                search_query = word_tokenize(word)
-                #stopword removal
-                search_query = list(set(search_query).difference(set(stop_words)))
-                #stemming of words and case folding
-                search_query = [stemmer.stem(w.lower()) for w in search_query]
-                for query_token in search_query:
-                    isPresent = group_field.get(query_token, None)
-                    if isPresent is not None:
-                        group_field[query_token] += global_fields[index]
-                    else:
-                        group_field[query_token] = global_fields[index]
-
-            for key, value in group_field.items():
-                final_search_query.append([key, value])
-        else:
-            #word tokenization
-            search_query = word_tokenize(query)
-            #stopword removal
-            search_query = list(set(search_query).difference(set(stop_words)))
-            #stemming of words and case folding
-            search_query = [stemmer.stem(w.lower()) for w in search_query]
-            for query_token in search_query:
-                final_search_query.append([query_token, 'ticlb'])
-        file_locations = locate_primary_index_files(final_search_query, primary_index_offset, debug=debugMode)
-        results = {}
-        final_results = calculate_rank(path_to_index_folder, file_locations, results, total_document_count, threshold=10, debug=debugMode)
-        print_results_from_title_map(final_results, title_map_offset, path_to_index_folder, title_map_name, debug=debugMode)
+        search_results = execute_query(context, query, result_count=result_count)
+        print_results(search_results, debug=debugMode)
         time_elapsed = (datetime.utcnow() - start).total_seconds()
         print("[INFO] : search completed in %.2f seconds" % time_elapsed)
+        if debugMode:
+            stem_hits, stem_misses, stem_size = stemmer.cache_stats()
+            print("[DEBUG] stemmer cache : %d hits, %d misses, %d entries" % (stem_hits, stem_misses, stem_size))
+            print_posting_cache_stats(context['posting_cache'], prefix='[DEBUG]')
+            print_result_cache_stats(context['result_cache'], prefix='[DEBUG]')
+
+def load_batch_postings(context, index, analyzed_queries):
+    #every distinct term of the batch is looked up once, with the union of the fields the queries
+    #of the batch need from it
+    unique_terms = {}
+    for final_search_query in analyzed_queries:
+        for word_info in final_search_query:
+            unique_terms[word_info[0]] = [word_info[0], unique_terms.get(word_info[0], [None, ''])[1] + word_info[1]]
+    return load_postings(context, index, list(unique_terms.values()))
+
+def batch_search(path_to_index_folder, query_file, output_file, result_count=10, batch_size=10000):
+    #runs every line of query_file as a query and writes one json line per query to output_file
+    context = load_search_context(path_to_index_folder, debug=False)
+    with open(query_file, 'r', encoding='utf-8') as txt_file:
+        queries = [line.strip() for line in txt_file if len(line.strip()) > 0]
+    print('[INFO] running %d queries across %s pages ...' % (len(queries), context['total_document_count']))
+    start_time = datetime.utcnow()
+    total_fetch_time = 0.0
+    with open(output_file, 'w', encoding='utf-8') as jsonl_file:
+        for batch_start in range(0, len(queries), batch_size):
+            batch = queries[batch_start:batch_start+batch_size]
+            index = refresh_search_context(context)
+            analyze_times = []
+            analyzed_queries = []
+            for query in batch:
+                start = datetime.utcnow()
+                analyzed_queries.append(analyze_query(context, query))
+                analyze_times.append((datetime.utcnow() - start).total_seconds())
+            #the posting lists of the whole batch are read once and shared by its queries, the queries
+            #already in the result cache don't need theirs
+            start = datetime.utcnow()
+            postings = load_batch_postings(context, index, [final_search_query for final_search_query in analyzed_queries if (index['generation'], query_cache_key(final_search_query, result_count)) not in context['result_cache']])
+            fetch_time = (datetime.utcnow() - start).total_seconds()
+            total_fetch_time += fetch_time
+            for query, final_search_query, analyze_time in zip(batch, analyzed_queries, analyze_times):
+                start = datetime.utcnow()
+                search_results = context['result_cache'].get(index['generation'], query_cache_key(final_search_query, result_count))
+                if search_results is None:
+                    term_entries = []
+                    for token, field_activation in final_search_query:
+                        index_entry = postings.get(token, None)
+                        if index_entry is not None:
+                            term_entries.append([index_entry, field_activation])
+                    search_results = []
+                    for doc_id, score in select_top_results(term_entries, index, result_count):
+                        doc_title = lookup_title(context, index, doc_id)
+                        if doc_title is not None:
+                            search_results.append([doc_id, doc_title, score])
+                    context['result_cache'].put(index['generation'], query_cache_key(final_search_query, result_count), search_results)
+                latency = analyze_time + (datetime.utcnow() - start).total_seconds()
+                jsonl_file.write(json.dumps({'query': query, 'results': [{'doc_id': int(doc_id), 'title': doc_title, 'score': float(score)} for doc_id, doc_title, score in search_results], 'latency_ms': latency * 1000.0}) + '\n')
+            print('[INFO] %d queries done, %d distinct terms fetched in %.2f seconds' % (batch_start + len(batch), len(postings), fetch_time))
+    time_delta = (datetime.utcnow() - start_time).total_seconds()
+    print('[INFO] %d queries completed in %.2f seconds (%.2f seconds reading posting lists), results written to %s' % (len(queries), time_delta, total_fetch_time, output_file))
+    print_posting_cache_stats(context['posting_cache'])
+    print_result_cache_stats(context['result_cache'])
+
+class SearchRequestHandler(BaseHTTPRequestHandler):
+    #GET /search?q=<query>&k=<result count>&mode=<or | and | champion> answers with the results as json,
+    #GET /stats with the cache and index segment statistics
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        request = urlparse(self.path)
+        if request.path == '/stats':
+            index = refresh_search_context(self.server.context)
+            self.send_json(200, {'posting_cache': self.server.context['posting_cache'].stats(), 'result_cache': self.server.context['result_cache'].stats(), 'segments': len(index['segments']), 'tombstones': len(index['tombstones']), 'pages': index['total_document_count']})
+            return
+        if request.path != '/search':
+            self.send_json(404, {'error': 'unknown path %s, use /search?q=<query>' % request.path})
+            return
+        params = parse_qs(request.query)
+        query = params.get('q', [''])[0]
+        if len(query.strip()) == 0:
+            self.send_json(400, {'error': 'missing query parameter q'})
+            return
+        try:
+            result_count = int(params.get('k', ['10'])[0])
+        except ValueError:
+            self.send_json(400, {'error': 'k has to be an integer'})
+            return
+        if result_count < 1:
+            self.send_json(400, {'error': 'k has to be at least 1'})
+            return
+        result_count = min(result_count, self.server.context['max_result_count'])
+        mode = params.get('mode', ['or'])[0]
+        if mode not in ['or', 'and', 'champion']:
+            self.send_json(400, {'error': 'mode has to be or | and | champion'})
+            return
+        start = datetime.utcnow()
+        search_results = execute_query(self.server.context, query, result_count=result_count, mode=mode)
+        latency = (datetime.utcnow() - start).total_seconds()
+        self.send_json(200, {
+            'query': query,
+            'results': [{'doc_id': int(doc_id), 'title': doc_title, 'score': float(score)} for doc_id, doc_title, score in search_results],
+            'latency_ms': latency * 1000.0,
+        })
+
+    def send_json(self, status, content):
+        body = json.dumps(content).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.context['debug']:
+            sys.stderr.write("[DEBUG] %s\n" % (format % args))
+
+class UnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    #BaseHTTPRequestHandler expects a (host, port) client address
+    def get_request(self):
+        request, _ = super(UnixHTTPServer, self).get_request()
+        return request, ('unix', 0)
+
+def serve(path_to_index_folder, address='127.0.0.1:8080'):
+    #long running server, the index offsets, analyzer and readers are loaded once at startup
+    context = load_search_context(path_to_index_folder, debug=False)
+    if address.startswith('unix:'):
+        socket_path = address[len('unix:'):]
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = UnixHTTPServer(socket_path, SearchRequestHandler)
+    else:
+        host, port = address.rsplit(':', 1)
+        server = ThreadingHTTPServer((host, int(port)), SearchRequestHandler)
+        server.daemon_threads = True
+    server.context = context
+    print('[INFO] serving %s pages on %s, GET /search?q=<query>&k=<result count>&mode=<or | and | champion>' % (context['total_document_count'], address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
 
 def main():
-    if len(sys.argv) != 2:
-      print("error : invalid number of argument passed [1] arguments required, need path to index_folder")
-      return -1
-    path_to_index = sys.argv[1]
-    search(path_to_index)
+    mode = sys.argv[2] if len(sys.argv) > 2 else 'interactive'
+    if len(sys.argv) == 2:
+        search(sys.argv[1])
+    elif mode == 'serve' and len(sys.argv) in [3, 4]:
+        serve(sys.argv[1], *sys.argv[3:])
+    elif mode == 'batch' and len(sys.argv) in [5, 6]:
+        result_count = 10
+        if len(sys.argv) == 6:
+            result_count = int(sys.argv[5])
+        batch_search(sys.argv[1], sys.argv[3], sys.argv[4], result_count=result_count)
+    else:
+        print("error : invalid number of argument passed, need path to index_folder, optionally followed by : serve [host:port | unix:/path/to/socket] or batch <query file> <output jsonl file> [result count]")
+        return -1
 
 if __name__ == '__main__':
     main()
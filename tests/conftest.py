@@ -0,0 +1,78 @@
+import os
+import sys
+import random
+from contextlib import contextmanager
+from xml.sax.saxutils import escape
+
+import pytest
+
+#the modules live at the root of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import inv_index_generator
+
+WORDS = ("india war army river city music film album game state king queen party election science physics "
+         "history football club season league team player world country capital population language culture "
+         "school university church temple mountain island ocean company bank market energy computer network "
+         "system software engine search index paper book novel author poet painter museum bridge road railway").split()
+
+def make_pages(page_count, seed=0, first_wiki_id=1):
+    #synthetic (wiki_id, title, text) pages, the words follow a zipf like distribution so that
+    #posting lists range from a handful of documents to most of them
+    rng = random.Random(seed)
+    weights = [1.0/(rank + 1) for rank in range(len(WORDS))]
+    def words(count):
+        return ' '.join(rng.choices(WORDS, weights, k=count))
+    pages = []
+    for wiki_id in range(first_wiki_id, first_wiki_id + page_count):
+        title = words(rng.randint(1, 3)).title()
+        parts = []
+        if rng.random() < 0.5:
+            parts.append("{{Infobox %s\n| name = %s\n| capital = [[%s]]\n| website = http://www.%s.org/x\n}}" % (words(1), title, words(1), words(1)))
+        for _ in range(rng.randint(1, 6)):
+            sentence = words(rng.randint(3, 25)).capitalize() + '.'
+            sentence += " See [[%s]] and [[%s|%s]]." % (words(1), words(1), words(1))
+            if rng.random() < 0.3:
+                sentence += "<ref>{{cite web |url=https://example.com/%d |title=%s}}</ref>" % (wiki_id, words(3))
+            parts.append(sentence)
+        parts.append("== References ==\n{{reflist}}")
+        for _ in range(rng.randint(0, 3)):
+            parts.append("[[Category:%s]]" % words(2))
+        pages.append((wiki_id, title, '\n\n'.join(parts)))
+    return pages
+
+def write_dump(dump_file, pages):
+    with open(dump_file, 'w', encoding='utf-8') as dump:
+        dump.write('<mediawiki xmlns="http://www.mediawiki.org/xml/export-0.10/">\n')
+        for wiki_id, title, text in pages:
+            dump.write("  <page>\n    <title>%s</title>\n    <ns>0</ns>\n    <id>%d</id>\n    <revision>\n      <id>%d</id>\n"
+                       "      <text xml:space=\"preserve\">%s</text>\n    </revision>\n  </page>\n" % (escape(title), wiki_id, 1000 + wiki_id, escape(text)))
+        dump.write('</mediawiki>\n')
+
+@contextmanager
+def index_configuration(**settings):
+    #settings override the values of get_configuration, for the indexer and the processes it forks
+    get_configuration = inv_index_generator.get_configuration
+    def configuration(offline_index_storage):
+        cfg = get_configuration(offline_index_storage)
+        cfg.update(settings)
+        return cfg
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setattr(inv_index_generator, 'get_configuration', configuration)
+        yield
+
+def build_index(dump_file, index_folder, **settings):
+    os.makedirs(index_folder, exist_ok=True)
+    with index_configuration(**settings):
+        inv_index_generator.build_secondary_index(dump_file, index_folder, empty_dir=False)
+        inv_index_generator.build_primary_index(index_folder, False)
+
+@pytest.fixture(scope='session')
+def sample_index(tmp_path_factory):
+    #several secondary blocks and prime_index_file-* files, so lookups and merges cross file boundaries
+    folder = tmp_path_factory.mktemp('sample_index')
+    dump_file = str(folder / 'dump.xml')
+    write_dump(dump_file, make_pages(400))
+    index_folder = str(folder / 'index')
+    build_index(dump_file, index_folder, offline_block_size=120, primary_index_size=40)
+    return index_folder
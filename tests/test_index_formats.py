@@ -0,0 +1,119 @@
+import io
+
+import numpy as np
+import pytest
+
+from inv_index_generator import field_alias, varint_numpy_threshold, posting_block_size, encode_varint, decode_varint, encode_varints, decode_varints, encode_posting_list, decode_posting_list, decode_posting_skips, decode_posting_blocks, decode_posting_term, decode_document_count, read_posting_record, TermDictionaryWriter
+from search import TermDictionary
+
+def make_postings(doc_count, seed=0):
+    #sorted doc ids with gaps of every width, and sparse per field counts with some large values
+    rng = np.random.RandomState(seed)
+    doc_ids = np.cumsum(rng.randint(1, 5000, size=doc_count)).astype(np.int64)
+    field_counts = rng.randint(0, 4, size=(doc_count, len(field_alias))) * (rng.rand(doc_count, len(field_alias)) < 0.4)
+    field_counts[::7, 4] = rng.randint(100, 100000, size=len(field_counts[::7]))
+    #the category field is never set, so its column is left out of the record
+    field_counts[:, 2] = 0
+    #every posting holds the term in at least one field
+    field_counts[field_counts.sum(axis=1) == 0, 0] = 1
+    return doc_ids, field_counts.astype(np.int64)
+
+def record_body(content):
+    record_length, position = decode_varint(content, 0)
+    assert position + record_length == len(content)
+    return content[position:]
+
+@pytest.mark.parametrize('count', [1, varint_numpy_threshold - 1, varint_numpy_threshold, 1000])
+def test_varints_round_trip(count):
+    #the plain python and the numpy coders have to agree byte for byte
+    rng = np.random.RandomState(count)
+    values = rng.randint(0, 1 << 40, size=count) >> rng.randint(0, 40, size=count)
+    content = encode_varints(values)
+    assert content == b''.join([encode_varint(int(value)) for value in values])
+    decoded, position = decode_varints(content, 0, count)
+    assert position == len(content)
+    assert np.array_equal(decoded, values)
+
+@pytest.mark.parametrize('doc_count', [1, 2, varint_numpy_threshold - 1, varint_numpy_threshold, posting_block_size, posting_block_size + 1, 3*posting_block_size, 5*posting_block_size + 17])
+def test_posting_list_round_trip(doc_count):
+    doc_ids, field_counts = make_postings(doc_count, seed=doc_count)
+    record = record_body(encode_posting_list('river', int(field_counts.sum()), doc_ids, field_counts))
+    assert decode_posting_term(record) == 'river'
+    assert decode_document_count(record) == doc_count
+    term, total_frequency, decoded_ids, decoded_counts, max_field_counts = decode_posting_list(record)
+    assert term == 'river'
+    assert total_frequency == int(field_counts.sum())
+    assert np.array_equal(decoded_ids, doc_ids)
+    assert np.array_equal(decoded_counts, field_counts)
+    assert np.array_equal(max_field_counts, field_counts.max(axis=0))
+
+def test_read_posting_records():
+    #records are read back one after the other until the end of the file
+    terms = ['album', 'river', 'été']
+    postings = [make_postings(3 + 40*i, seed=i) for i in range(len(terms))]
+    content = b''.join([encode_posting_list(term, int(counts.sum()), doc_ids, counts) for term, (doc_ids, counts) in zip(terms, postings)])
+    file_ptr = io.BytesIO(content)
+    for term, (doc_ids, field_counts) in zip(terms, postings):
+        decoded_term, _, decoded_ids, decoded_counts, _ = decode_posting_list(read_posting_record(file_ptr))
+        assert decoded_term == term
+        assert np.array_equal(decoded_ids, doc_ids)
+        assert np.array_equal(decoded_counts, field_counts)
+    assert read_posting_record(file_ptr) is None
+
+@pytest.mark.parametrize('doc_count', [varint_numpy_threshold - 1, 4*posting_block_size + 3])
+def test_posting_list_field_columns(doc_count):
+    #the columns of the fields that aren't asked for are left as zeros
+    doc_ids, field_counts = make_postings(doc_count, seed=1)
+    record = record_body(encode_posting_list('album', int(field_counts.sum()), doc_ids, field_counts))
+    for fields in ['t', 'tb', 'il', '']:
+        _, _, decoded_ids, decoded_counts, _ = decode_posting_list(record, fields)
+        assert np.array_equal(decoded_ids, doc_ids)
+        for field_index, field in enumerate(field_alias):
+            expected = field_counts[:, field_index] if field in fields else np.zeros(doc_count, dtype=np.int64)
+            assert np.array_equal(decoded_counts[:, field_index], expected)
+
+def test_posting_blocks():
+    doc_count = 6*posting_block_size + 40
+    doc_ids, field_counts = make_postings(doc_count, seed=2)
+    record = record_body(encode_posting_list('footbal', int(field_counts.sum()), doc_ids, field_counts))
+    skips = decode_posting_skips(record)
+    assert skips['term'] == 'footbal'
+    assert skips['doc_count'] == doc_count
+    block_ends = np.minimum(np.arange(1, len(skips['last_doc_ids']) + 1) * posting_block_size, doc_count)
+    assert len(skips['last_doc_ids']) == (doc_count + posting_block_size - 1) // posting_block_size
+    assert np.array_equal(skips['last_doc_ids'], doc_ids[block_ends - 1])
+
+    all_ids, all_counts = decode_posting_blocks(record, skips)
+    assert np.array_equal(all_ids, doc_ids)
+    assert np.array_equal(all_counts, field_counts)
+
+    #any subset of the blocks, the last short block included
+    for blocks in [[0], [3], [len(block_ends) - 1], [1, 2, 5], [0, len(block_ends) - 1]]:
+        positions = np.concatenate([np.arange(block*posting_block_size, block_ends[block]) for block in blocks])
+        block_ids, block_counts = decode_posting_blocks(record, skips, np.array(blocks), 'bt')
+        assert np.array_equal(block_ids, doc_ids[positions])
+        assert np.array_equal(block_counts[:, [0, 4]], field_counts[positions][:, [0, 4]])
+        assert not block_counts[:, 1:4].any()
+
+def test_term_dictionary_round_trip(tmp_path):
+    terms = sorted(set(['a', 'ab', 'abc', 'abd', 'album', 'albums', 'river', 'rivera', 'riverb', 'zebra', 'été', 'x'*300]))
+    entries = {}
+    writer = TermDictionaryWriter(str(tmp_path / 'term_dictionary'), 4, 1<<16)
+    for i, term in enumerate(terms):
+        entries[term] = (i % 3, i // 3, 1000*i + 7, 50 + i, 1 + 2*i, 0.25*i + 0.5)
+        writer.add(term, *entries[term])
+    writer.close()
+
+    dictionary = TermDictionary(str(tmp_path), 'term_dictionary', 'prime_index_file')
+    assert len(dictionary) == (len(terms) + 3) // 4
+    for term, (range_id, block_id, offset, length, doc_count, idf) in entries.items():
+        assert dictionary.find(term) == ('prime_index_file-%d-%d' % (range_id, block_id), offset, length, doc_count, pytest.approx(idf))
+    #before the first term, between terms of a group, past a group and past the last term
+    for token in ['', '0', 'aa', 'abcd', 'alb', 'riverc', 'zz']:
+        assert dictionary.find(token) is None
+
+def test_empty_term_dictionary(tmp_path):
+    TermDictionaryWriter(str(tmp_path / 'term_dictionary'), 4, 1<<16).close()
+    dictionary = TermDictionary(str(tmp_path), 'term_dictionary', 'prime_index_file')
+    assert len(dictionary) == 0
+    assert dictionary.find('river') is None
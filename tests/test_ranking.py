@@ -0,0 +1,92 @@
+import math
+
+import pytest
+
+from inv_index_generator import field_alias, bm25f_field_weights, bm25f_k1
+from search import load_search_context, analyze_query, load_postings, execute_query, document_norms
+
+QUERIES = ['river', 'india river', 'the world music album', 'season league team player', 'army king queen party war', 't:river b:album', 'b:market i:capital c:poet', 'xylophone', 'river xylophone']
+AND_QUERIES = ['india river', 'world music album', 'war army', 'season league team player', 'river poet', 't:river b:album', 'b:market i:capital', 'river xylophone']
+
+@pytest.fixture(scope='module')
+def context(sample_index):
+    return load_search_context(sample_index)
+
+def field_weight(field_activation, field_counts, norms):
+    #saturated bm25f term frequency of a single posting
+    weighted = 0.0
+    for field in field_activation:
+        column = field_alias.index(field)
+        weighted += field_counts[column] * bm25f_field_weights[column] / norms[column]
+    return weighted / (bm25f_k1 + weighted)
+
+def brute_force_scores(context, query, mode='or'):
+    #scores every live posting of every query term, without any pruning. a document matches a term
+    #if it holds it in one of the fields of the query, in 'and' mode it has to match every term
+    scores = {}
+    matches = {}
+    final_search_query = analyze_query(context, query)
+    postings = load_postings(context, context['index'], final_search_query)
+    for token, field_activation in final_search_query:
+        index_entry = postings.get(token)
+        if index_entry is None:
+            continue
+        document_count = len(index_entry['doc_ids'])
+        idf = math.log(1.0 + (context['total_document_count'] - document_count + 0.5)/(document_count + 0.5))
+        norms = document_norms(context['index'], index_entry['doc_ids'])
+        for doc_id, field_counts, doc_norms in zip(index_entry['doc_ids'].tolist(), index_entry['field_counts'], norms):
+            weight = field_weight(field_activation, field_counts, doc_norms)
+            if weight == 0:
+                continue
+            scores[doc_id] = scores.get(doc_id, 0.0) + weight * idf
+            matches[doc_id] = matches.get(doc_id, 0) + 1
+    if mode == 'and':
+        scores = dict([(doc_id, score) for doc_id, score in scores.items() if matches[doc_id] == len(final_search_query)])
+    return scores
+
+@pytest.mark.parametrize('query', QUERIES)
+@pytest.mark.parametrize('result_count', [1, 10, 50])
+def test_top_results_match_brute_force(context, query, result_count):
+    scores = brute_force_scores(context, query)
+    results = execute_query(context, query, result_count=result_count)
+    expected = sorted(scores.values(), reverse=True)[:result_count]
+    assert [score for _, _, score in results] == pytest.approx(expected)
+    for doc_id, _, score in results:
+        assert score == pytest.approx(scores[doc_id])
+
+@pytest.mark.parametrize('query', AND_QUERIES)
+@pytest.mark.parametrize('result_count', [1, 10, 50])
+def test_and_results_match_brute_force(context, query, result_count):
+    scores = brute_force_scores(context, query, mode='and')
+    results = execute_query(context, query, result_count=result_count, mode='and')
+    expected = sorted(scores.values(), reverse=True)[:result_count]
+    assert [score for _, _, score in results] == pytest.approx(expected)
+    for doc_id, _, score in results:
+        assert score == pytest.approx(scores[doc_id])
+
+def test_non_essential_lists_are_probed(sample_index):
+    #on a cold cache the lists only probed for candidates stay out of the posting cache, and the
+    #results are the same once every list is cached
+    context = load_search_context(sample_index)
+    query = 'the world music album river poet'
+    results = execute_query(context, query, result_count=1)
+    final_search_query = analyze_query(context, query)
+    cached_tokens = [token for token, fields in final_search_query if context['posting_cache'].get(context['index']['generation'], token, fields) is not None]
+    assert 0 < len(cached_tokens) < len(final_search_query)
+    load_postings(context, context['index'], final_search_query)
+    assert execute_query(context, query, result_count=1) == results
+
+def test_equivalent_queries_share_a_cached_result(sample_index):
+    #case, word order, stop words and field order don't change the analyzed query
+    context = load_search_context(sample_index)
+    results = execute_query(context, 'river album', result_count=10)
+    for query in ['Album River', 'the river and an ALBUM', 'river album album']:
+        assert execute_query(context, query, result_count=10) == results
+    assert execute_query(context, 'b:album i:river', result_count=10) == execute_query(context, 'i:river b:album', result_count=10)
+    cache_stats = context['result_cache'].stats()
+    assert cache_stats['hits'] == 4
+    assert cache_stats['entries'] == 2
+    #the result count and the mode are part of the key
+    execute_query(context, 'river album', result_count=5)
+    execute_query(context, 'river album', result_count=10, mode='and')
+    assert context['result_cache'].stats()['entries'] == 4
@@ -0,0 +1,97 @@
+import os
+
+import pytest
+
+import inv_index_generator
+from conftest import make_pages, write_dump, build_index, index_configuration
+from inv_index_generator import build_secondary_index, build_primary_index, read_posting_record
+
+SETTINGS = {'offline_block_size': 40, 'primary_index_size': 30, 'dispatch_chunk_size': 20000}
+
+def index_content(index_folder):
+    #every record of the primary index in term order, and the merged title map
+    records = []
+    with open(os.path.join(index_folder, 'primary_index_file_offset'), 'r', encoding='utf-8') as txt_file:
+        file_names = [line.split()[0] for line in txt_file if len(line.strip()) > 0]
+    for file_name in file_names:
+        with open(os.path.join(index_folder, file_name), 'rb') as file_ptr:
+            while True:
+                record = read_posting_record(file_ptr)
+                if record is None:
+                    break
+                records.append(record)
+    with open(os.path.join(index_folder, 'doc_title_map'), 'r', encoding='utf-8') as txt_file:
+        return records, txt_file.read()
+
+@pytest.fixture(scope='module')
+def clean_build(tmp_path_factory):
+    folder = tmp_path_factory.mktemp('resume')
+    dump_file = str(folder / 'dump.xml')
+    write_dump(dump_file, make_pages(300, seed=4))
+    build_index(dump_file, str(folder / 'clean'), **SETTINGS)
+    return dump_file, index_content(str(folder / 'clean'))
+
+def resume(dump_file, index_folder, capsys):
+    capsys.readouterr()
+    assert build_secondary_index(dump_file, index_folder, empty_dir=False, resume=True)
+    build_primary_index(index_folder, False, resume=True)
+    return capsys.readouterr().out
+
+@pytest.mark.parametrize('crash_block', [1, 3])
+def test_resume_after_a_worker_died_after_its_checkpoint(clean_build, tmp_path, monkeypatch, capsys, crash_block):
+    dump_file, expected = clean_build
+    index_folder = str(tmp_path)
+    flush_block = inv_index_generator.WikiPageHandler.flush_block
+    call_count = [0]
+    def flush_and_crash(handler):
+        flush_block(handler)
+        call_count[0] += 1
+        if handler.process_id == 1 and call_count[0] == crash_block:
+            os._exit(1)
+    with index_configuration(**SETTINGS):
+        monkeypatch.setattr(inv_index_generator.WikiPageHandler, 'flush_block', flush_and_crash)
+        assert not build_secondary_index(dump_file, index_folder, empty_dir=False)
+        monkeypatch.undo()
+        assert 'skipped' in resume(dump_file, index_folder, capsys)
+    assert index_content(index_folder) == expected
+
+def test_resume_after_a_worker_died_before_its_checkpoint(clean_build, tmp_path, monkeypatch, capsys):
+    #the block of the lost checkpoint is on disk already, it is dropped and its pages indexed again
+    dump_file, expected = clean_build
+    index_folder = str(tmp_path)
+    write_checkpoint = inv_index_generator.write_checkpoint
+    call_count = [0]
+    def write_or_crash(checkpoint_file, checkpoint):
+        if os.path.basename(checkpoint_file) == 'checkpoint-2':
+            call_count[0] += 1
+            if call_count[0] == 2:
+                os._exit(1)
+        write_checkpoint(checkpoint_file, checkpoint)
+    with index_configuration(**SETTINGS):
+        monkeypatch.setattr(inv_index_generator, 'write_checkpoint', write_or_crash)
+        assert not build_secondary_index(dump_file, index_folder, empty_dir=False)
+        monkeypatch.undo()
+        assert 'skipped' in resume(dump_file, index_folder, capsys)
+    assert index_content(index_folder) == expected
+
+@pytest.mark.parametrize('merge_processes', [2, 3])
+def test_resume_after_a_merge_range_died(clean_build, tmp_path, monkeypatch, capsys, merge_processes):
+    #every range process dies after its first checkpointed primary block, a range without a full block completes
+    dump_file, expected = clean_build
+    index_folder = str(tmp_path)
+    write_checkpoint = inv_index_generator.write_checkpoint
+    def write_and_crash(checkpoint_file, checkpoint):
+        write_checkpoint(checkpoint_file, checkpoint)
+        if '-merge-' in os.path.basename(checkpoint_file):
+            os._exit(1)
+    with index_configuration(merge_processes=merge_processes, **SETTINGS):
+        assert build_secondary_index(dump_file, index_folder, empty_dir=False)
+        monkeypatch.setattr(inv_index_generator, 'write_checkpoint', write_and_crash)
+        with pytest.raises(RuntimeError):
+            build_primary_index(index_folder, False)
+        monkeypatch.undo()
+        #the ranges continue after their checkpointed blocks
+        assert any([file_name.startswith('checkpoint-merge-') for file_name in os.listdir(index_folder)])
+        resume(dump_file, index_folder, capsys)
+    assert index_content(index_folder) == expected
+    assert not any([file_name.startswith('checkpoint') for file_name in os.listdir(index_folder)])
@@ -0,0 +1,139 @@
+import os
+
+import pytest
+
+from conftest import make_pages, write_dump, build_index, index_configuration
+from inv_index_generator import get_configuration, add_index_segment, merge_index_segments, read_segment_list, read_tombstones, read_retired_segments, next_segment_name
+from search import load_search_context, analyze_query, load_postings, execute_query
+
+SETTINGS = {'offline_block_size': 60, 'primary_index_size': 40}
+QUERIES = ['river', 'india river album', 'b:market i:capital', 'season league team player']
+
+def page_scores(context, query, mode='or'):
+    #every result of the query, by title since doc ids differ from one build to the other
+    return sorted([(title, score) for _, title, score in execute_query(context, query, result_count=1000, mode=mode)])
+
+def assert_same_results(results, expected):
+    #the float32 length norms of the two indexes differ in their last bits
+    assert [title for title, _ in results] == [title for title, _ in expected]
+    assert [score for _, score in results] == pytest.approx([score for _, score in expected])
+
+@pytest.fixture
+def segmented_index(tmp_path):
+    #a base index, a delta dump holding new pages and new versions of some base pages, a list of deleted
+    #titles, and a reference index built from scratch over the pages left live
+    base_pages = make_pages(150, seed=1)
+    updated_pages = [(wiki_id, base_pages[i][1], text) for i, (wiki_id, _, text) in zip(range(0, 100, 10), make_pages(10, seed=3, first_wiki_id=2001))]
+    delta_pages = make_pages(40, seed=2, first_wiki_id=1001) + updated_pages
+    deleted_titles = [base_pages[i][1] for i in range(5, 30, 5)]
+    replaced_titles = set([title for _, title, _ in delta_pages] + deleted_titles)
+    live_pages = [page for page in base_pages if page[1] not in replaced_titles] + delta_pages
+
+    paths = {}
+    for name, pages in [('base', base_pages), ('delta', delta_pages), ('live', live_pages)]:
+        paths[name] = str(tmp_path / (name + '.xml'))
+        write_dump(paths[name], pages)
+    paths['deleted'] = str(tmp_path / 'deleted_titles')
+    with open(paths['deleted'], 'w', encoding='utf-8') as txt_file:
+        txt_file.write('\n'.join(deleted_titles) + '\n')
+    paths['index'] = str(tmp_path / 'index')
+    build_index(paths['base'], paths['index'], **SETTINGS)
+    paths['reference'] = str(tmp_path / 'reference')
+    build_index(paths['live'], paths['reference'], **SETTINGS)
+    paths['tombstoned_count'] = len([page for page in base_pages if page[1] in replaced_titles])
+    paths['live_count'] = len(live_pages)
+    return paths
+
+def add_delta_segment(paths, **settings):
+    with index_configuration(**dict(SETTINGS, **settings)):
+        merge_process = add_index_segment(paths['delta'], paths['index'], deleted_titles_file=paths['deleted'])
+        if merge_process is not None:
+            merge_process.join()
+    return merge_process
+
+def test_add_segment_tombstones_older_versions(segmented_index):
+    assert add_delta_segment(segmented_index) is None
+    cfg = get_configuration(segmented_index['index'])
+    assert read_segment_list(segmented_index['index'], cfg) == [['.', 1, 150], ['segment-1', 151, 200]]
+    tombstones = read_tombstones(segmented_index['index'], cfg)
+    assert len(tombstones) == segmented_index['tombstoned_count']
+    assert tombstones.max() <= 150
+
+    context = load_search_context(segmented_index['index'])
+    reference = load_search_context(segmented_index['reference'])
+    assert context['total_document_count'] == segmented_index['live_count']
+    for query in QUERIES:
+        assert_same_results(page_scores(context, query), page_scores(reference, query))
+        #the idf of the and mode leaves the tombstoned postings out as well
+        assert_same_results(page_scores(context, query, mode='and'), page_scores(reference, query, mode='and'))
+
+def test_merge_drops_tombstoned_pages(segmented_index):
+    add_delta_segment(segmented_index)
+    context = load_search_context(segmented_index['index'])
+    reference = load_search_context(segmented_index['reference'])
+    unmerged_index = context['index']
+    with index_configuration(**dict(SETTINGS, segment_merge_factor=2)):
+        merge_index_segments(segmented_index['index'])
+
+    cfg = get_configuration(segmented_index['index'])
+    assert read_segment_list(segmented_index['index'], cfg) == [['segment-2', 1, 200]]
+    assert len(read_tombstones(segmented_index['index'], cfg)) == 0
+    assert [segment[0] for segment in read_retired_segments(segmented_index['index'], cfg)] == ['.', 'segment-1']
+    for query in QUERIES:
+        assert_same_results(page_scores(context, query), page_scores(reference, query))
+    assert len(context['index']['segments']) == 1
+
+    #queries that started on the segments before the merge can still read them
+    final_search_query = analyze_query(context, 'river album')
+    assert len(load_postings(context, unmerged_index, final_search_query)) == 2
+
+    #the next merge deletes the retired segments once they are old enough
+    with index_configuration(**dict(SETTINGS, segment_merge_factor=2, segment_retire_seconds=0)):
+        merge_index_segments(segmented_index['index'])
+    assert not os.path.exists(os.path.join(segmented_index['index'], 'segment-1'))
+    assert not os.path.exists(os.path.join(segmented_index['index'], cfg['primary_index_offset_name']))
+    assert len(read_retired_segments(segmented_index['index'], cfg)) == 0
+    assert next_segment_name(segmented_index['index'], read_segment_list(segmented_index['index'], cfg), cfg) == 'segment-3'
+    for query in QUERIES:
+        assert_same_results(page_scores(load_search_context(segmented_index['index']), query), page_scores(reference, query))
+
+def test_posting_cache_follows_the_index_version(segmented_index):
+    context = load_search_context(segmented_index['index'])
+    reference = load_search_context(segmented_index['reference'])
+    for query in QUERIES:
+        page_scores(context, query)
+    base_index = context['index']
+    add_delta_segment(segmented_index)
+    #the first query after the segment was added reloads the index
+    assert_same_results(page_scores(context, 'album'), page_scores(reference, 'album'))
+    assert context['index'] is not base_index
+    #queries still running on the base index store their lists after the reload, they must not be used
+    for query in QUERIES:
+        load_postings(context, base_index, analyze_query(context, query))
+    for query in QUERIES:
+        assert_same_results(page_scores(context, query), page_scores(reference, query))
+
+def test_result_cache_follows_the_index_generation(segmented_index):
+    context = load_search_context(segmented_index['index'])
+    reference = load_search_context(segmented_index['reference'])
+    base_results = dict([(query, page_scores(context, query)) for query in QUERIES])
+    for query in QUERIES:
+        page_scores(reference, query)
+    #a new segment and its tombstones drop the cached results
+    add_delta_segment(segmented_index)
+    for query in QUERIES:
+        assert_same_results(page_scores(context, query), page_scores(reference, query))
+    #so does an index built again in place
+    generation = reference['index']['generation']
+    build_index(segmented_index['base'], segmented_index['reference'], **SETTINGS)
+    for query in QUERIES:
+        assert_same_results(page_scores(reference, query), base_results[query])
+    assert reference['index']['generation'] != generation
+
+def test_merged_segment_names_are_not_reused(tmp_path):
+    cfg = get_configuration(str(tmp_path))
+    segments = [['.', 1, 10], ['segment-4', 11, 20]]
+    assert next_segment_name(str(tmp_path), segments, cfg) == 'segment-5'
+    #a merge in progress or a retired segment still holds its folder
+    os.makedirs(str(tmp_path / 'segment-7'))
+    assert next_segment_name(str(tmp_path), segments, cfg) == 'segment-8'
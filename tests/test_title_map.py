@@ -0,0 +1,48 @@
+import os
+
+from conftest import make_pages
+from inv_index_generator import get_configuration, merge_title_map_files
+from search import TitleMapReader, load_search_context, lookup_title
+
+def write_title_maps(folder, title_maps):
+    #one partial title map per worker, each sorted by doc id
+    title_map_files = []
+    for worker_id, titles in enumerate(title_maps):
+        title_map_file = os.path.join(folder, 'titles-%d' % worker_id)
+        with open(title_map_file, 'w', encoding='utf-8') as txt_file:
+            for doc_id, title in titles:
+                txt_file.write("%d %s\n" % (doc_id, title))
+        title_map_files.append(title_map_file)
+    return title_map_files
+
+def test_title_offsets_follow_the_doc_ids(tmp_path):
+    #the workers got their pages in interleaved batches, some pages were deleted since
+    titles = dict([(doc_id, 'Title %d été' % doc_id) for doc_id in range(5, 60)])
+    titles[20] = ''
+    title_maps = [[(doc_id, titles[doc_id]) for doc_id in sorted(titles) if (doc_id // 8) % 3 == worker_id] for worker_id in range(3)]
+    deleted_doc_ids = set([5, 17, 18, 19, 40, 59])
+    cfg = get_configuration(str(tmp_path))
+    assert merge_title_map_files(cfg, write_title_maps(str(tmp_path), title_maps), deleted_doc_ids) == len(titles) - len(deleted_doc_ids)
+
+    title_map = TitleMapReader(str(tmp_path), cfg['doc_title_map'])
+    assert title_map.first_doc_id == 6
+    assert len(title_map.offsets) == 58 - 6 + 1
+    for doc_id in range(0, 70):
+        if doc_id in titles and doc_id not in deleted_doc_ids:
+            assert title_map.title(doc_id) == titles[doc_id]
+        else:
+            assert title_map.title(doc_id) is None
+
+def test_empty_title_map(tmp_path):
+    cfg = get_configuration(str(tmp_path))
+    assert merge_title_map_files(cfg, write_title_maps(str(tmp_path), [[(1, 'River')]]), set([1])) == 0
+    title_map = TitleMapReader(str(tmp_path), cfg['doc_title_map'])
+    assert title_map.title(0) is None
+    assert title_map.title(1) is None
+
+def test_lookup_title_of_every_page(sample_index):
+    context = load_search_context(sample_index)
+    pages = make_pages(400)
+    for doc_id, (_, title, _) in enumerate(pages, 1):
+        assert lookup_title(context, context['index'], doc_id) == title
+    assert lookup_title(context, context['index'], len(pages) + 1) is None
@@ -0,0 +1,13 @@
+from benchmark import SAMPLE_DUMP, FIELD_NAMES, load_pages, create_page_handler, ReferencePageCleaner
+
+def test_sample_pages_match_reference_fields():
+    #every field of every sample page holds the same terms as with the extraction chain the cleaner replaced
+    pages = load_pages(SAMPLE_DUMP)
+    assert len(pages) == 7
+    handler = create_page_handler()
+    reference = ReferencePageCleaner(handler)
+    for wiki_id, title, text in pages:
+        expected = reference.post_processing(text, wiki_id)
+        actual = handler.clean_page(text, wiki_id)
+        for index, field_name in enumerate(FIELD_NAMES):
+            assert sorted(actual[index]) == sorted(expected[index]), '%s field of %s' % (field_name, title)